@@ -4,12 +4,15 @@ import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 import camoco.PCCUP as PCCUP
+import camoco.RefGenDist as RefGenDist
 
 from .Camoco import Camoco
 from .RefGen import RefGen
 from .Locus import Locus,Gene
 from .Expr import Expr
-from .Tools import memoize,available_datasets
+from .Tools import memoize,available_datasets,read_expr_table,file_lock
+from .Config import cf
+from .Exceptions import CamocoAccessionNameError
 from .Term import Term
 from .Ontology import Ontology
 
@@ -19,6 +22,7 @@ from collections import defaultdict, Counter
 from itertools import chain
 from matplotlib.collections import LineCollection
 from subprocess import Popen, PIPE
+from scipy import sparse
 from scipy.spatial.distance import squareform
 from scipy.misc import comb
 from scipy.stats import norm,pearsonr
@@ -46,6 +50,20 @@ import sys
 import pdb
 import json
 import gc
+import time
+import hashlib
+import os
+import shutil
+import bcolz as bcz
+
+
+# The per pair sufficient statistics stored by
+# COB.from_Expr(..., store_pair_stats=True)
+PAIR_STATS = ('count', 'sum_u', 'sum_v', 'sum_u2', 'sum_v2', 'sum_uv')
+
+# The stages run by COB.from_Expr, in order. The stages
+# after coexpression are all calculated from the coex table.
+BUILD_STAGES = ('coexpression', 'degree', 'leaves', 'clusters')
 
 
 class COB(Expr):
@@ -67,6 +85,11 @@ class COB(Expr):
         cob : COB
             A COB object
         '''
+        # Gene coordinates used to calculate distances, see _gene_coordinates
+        self._gene_coordinate_cache = None
+        # Clusters are loaded on first access, see COB.clusters
+        self._clusters = None
+        self._MCL = None
         super().__init__(name=name)
         self.log('Loading Coex table')
         self.coex = self._bcolz('coex',blaze=True)
@@ -79,16 +102,39 @@ class COB(Expr):
         self.degree = self._bcolz('degree')
         if self.degree is None:
             self.log("{} is empty", name)
-        if not available_datasets('Ontology','{}MCL'.format(name))\
-            and self.coex is not None:
-            self._calculate_clusters()
-        self.log('Loading Clusters')
-        self.clusters = self._bcolz('clusters')
-        if self.clusters is None:
-            self.log('Clusters not loaded for: {} ()', name)
-            self.MCL = None
-        else:
-            self.MCL = Ontology('{}MCL'.format(self.name))
+        if not self.has_clusters():
+            self.log(
+                'Clusters for {} will be calculated when first used', name
+            )
+
+    @property
+    def clusters(self):
+        '''
+            A DataFrame with the MCL cluster of each gene. Clusters
+            are loaded on first access and calculated if the network
+            does not have them yet (see COB.has_clusters).
+        '''
+        if self._clusters is None:
+            self._load_clusters()
+        return self._clusters
+
+    @clusters.setter
+    def clusters(self, clusters):
+        self._clusters = clusters
+
+    @property
+    def MCL(self):
+        '''
+            An Ontology with a term for each MCL cluster. Like
+            COB.clusters, it is calculated on first access if needed.
+        '''
+        if self._MCL is None:
+            self._load_clusters()
+        return self._MCL
+
+    @MCL.setter
+    def MCL(self, MCL):
+        self._MCL = MCL
 
 
     def __repr__(self):
@@ -144,6 +190,10 @@ class COB(Expr):
             ------------------
             Num clusters (size >= 10): {}
 
+            Build Stages
+            ------------------
+            {}
+
 
         '''.format(
             # Dataset
@@ -152,21 +202,27 @@ class COB(Expr):
             self.rawtype,
             self._transformation_log(),
             self.num_genes(),
-            (self.num_genes()/self.num_genes(raw=True))*100,
+            (self.num_genes()/max(self.num_genes(raw=True),1))*100,
             self.num_accessions(),
             len(self.coex),
             self._global('current_significance_threshold'),
             len(self.sigs),
             # Raw
-            len(self.expr(raw=True)),
-            len(self.expr(raw=True).columns),
+            self.num_genes(raw=True),
+            self.num_accessions(raw=True),
             # QC
             self._global('qc_min_expr'),
             self._global('qc_max_gene_missing_data'),
             self._global('qc_max_accession_missing_data'),
             self._global('qc_min_single_sample_expr'),
             # Clusters
-            sum(self.clusters.groupby('cluster').apply(len) >= 10)
+            sum(self.clusters.groupby('cluster').apply(len) >= 10) \
+                if self.has_clusters() else 'not calculated',
+            # Build
+            ', '.join(
+                '{}: {}'.format(stage,status) 
+                for stage,status in self.build_status().items()
+            )
         ), file=file)
 
     def qc_gene(self):
@@ -185,8 +241,12 @@ class COB(Expr):
         qc_gene = self._bcolz('qc_gene')
         # generate the parent refegen
         rg = self._parent_refgen
-        qc_gene['chrom'] = [rg[x].chrom if x in rg else 'None' for x in qc_gene.index]
-        return qc_gene.groupby('chrom').aggregate(sum, axis=0)
+        # look the chromosomes up in bulk rather than once per gene
+        chroms = rg._gene_positions().chrom
+        qc_gene['chrom'] = chroms.reindex(
+            [str(x).upper() for x in qc_gene.index]
+        ).fillna('None').values
+        return qc_gene.groupby('chrom').sum()
 
     @property
     @memoize
@@ -244,9 +304,11 @@ class COB(Expr):
                 self.coex.data.delcol(name='significant')
             except ValueError:
                 pass
-            # Add the column to the underlying data structure
+            # Add the column to the underlying data structure, networks
+            # without a stored distance column only have a score column
             self.coex.data.addcol(
-                self.coex.data.eval('score >= '+str(zscore)), pos=2, name='significant')
+                self.coex.data.eval('score >= '+str(zscore)), 
+                pos=min(2,len(self.coex.data.names)), name='significant')
             self.coex.data.flush()
             
             # Keep track of the current threshold
@@ -289,7 +351,10 @@ class COB(Expr):
             if sig_only:
                 ids = self.sigs
             else:
-                return self.coex.data.todataframe()
+                df = self.coex.data.todataframe()
+                if 'distance' not in df.columns:
+                    df.insert(1,'distance',self._coex_distance())
+                return df
         else:
             ids.sort()
             if sig_only:
@@ -299,7 +364,174 @@ class COB(Expr):
         df = pd.DataFrame.from_items(
             ((key, self.coex.data[key][ids]) for key in self.coex.data.names))
         df.set_index(ids,inplace=True)
+        if 'distance' not in df.columns:
+            # Calculate distances on the fly for just these edges
+            df.insert(1,'distance',self._coex_distance(ids))
         return df
+
+    def _gene_coordinates(self):
+        '''
+            Returns the chromosome (as an integer code), start and end
+            positions of the genes in the network, in the same order as
+            the expression matrix. Genes missing from the RefGen have a
+            chromosome code of -1.
+
+            Returns
+            -------
+                A tuple of numpy arrays: (chrom, start, end)
+        '''
+        if self._gene_coordinate_cache is None:
+            positions = self.refgen._gene_positions().reindex(self._expr_index)
+            self._gene_coordinate_cache = (
+                positions.chrom_code.fillna(-1).values.astype(np.int32),
+                positions.start.fillna(0).values.astype(np.int64),
+                positions.end.fillna(0).values.astype(np.int64)
+            )
+        return self._gene_coordinate_cache
+
+    def _coex_distance(self, ids=None):
+        '''
+            Calculates the distance between the genes of the
+            edges in the coexpression table from the gene
+            coordinates. This is used for networks that do
+            not store a distance column.
+
+            Parameters
+            ----------
+                ids : array-like of ints (default: None)
+                    Coex table indices to calculate distances for
+                    (see PCCUP.coex_index). If None, calculate the
+                    distance for every edge.
+
+            Returns
+            -------
+                A numpy array of distances (float32, trans 
+                distances are inf)
+        '''
+        chrom,start,end = self._gene_coordinates()
+        if ids is None:
+            return np.concatenate(
+                list(RefGenDist.distance_blocks(chrom,start,end))
+                or [np.empty(0,dtype='float32')]
+            )
+        if len(ids) == 0:
+            return np.empty(0,dtype='float32')
+        pairs = PCCUP.coex_expr_index(np.asarray(ids), len(chrom))
+        return RefGenDist.pair_distances(
+            chrom, start, end, pairs[:,0], pairs[:,1]
+        )
+
+    def _filter_min_distance(self, ids, min_distance):
+        '''
+            Removes coex table indices for edges between genes
+            closer than min_distance. Distances are calculated from
+            the gene coordinates so this happens before any data is
+            pulled from the coex table.
+
+            Parameters
+            ----------
+                ids : array-like of ints
+                    Coex table indices (see PCCUP.coex_index)
+                min_distance : int
+                    The minimum distance between genes. If None,
+                    ids are returned unchanged.
+
+            Returns
+            -------
+                A numpy array of the remaining indices
+        '''
+        ids = np.asarray(ids)
+        if min_distance is None or len(ids) == 0:
+            return ids
+        if 'distance' in self.coex.data.names:
+            # Use the stored distances instead of recalculating them
+            return ids[self.coex.data['distance'][ids] >= min_distance]
+        return ids[self._coex_distance(ids) >= min_distance]
+
+    def _coex_distance_blocks(self, block_size=2**24):
+        '''
+            Yields the distances for every edge in the coex table
+            in consecutive blocks. The stored distance column is
+            read when present, otherwise distances are calculated
+            from the gene coordinates.
+
+            Parameters
+            ----------
+                block_size : int (default: 2**24)
+                    The number of edges in each block.
+
+            Yields
+            ------
+                Tuples of (offset, distances) where offset is the
+                coex table index of the first edge in the block
+        '''
+        if 'distance' in self.coex.data.names:
+            distance = self.coex.data['distance']
+            blocks = (
+                distance[i:i+block_size]
+                for i in range(0, len(distance), block_size)
+            )
+        else:
+            chrom,start,end = self._gene_coordinates()
+            blocks = RefGenDist.distance_blocks(
+                chrom, start, end, block_size=block_size
+            )
+        offset = 0
+        for block in blocks:
+            yield offset, block
+            offset += len(block)
+
+    def _coex_DataFrame_min_distance(self, min_distance):
+        '''
+            Builds the coex DataFrame for every edge between genes
+            at least min_distance apart. The table is filtered block
+            by block so neither the full distance vector nor the
+            full set of indices is ever held in memory.
+
+            Parameters
+            ----------
+                min_distance : int
+                    The minimum distance between genes.
+
+            Returns
+            -------
+                A Pandas Dataframe (see _coex_DataFrame)
+        '''
+        keys = [key for key in self.coex.data.names if key != 'distance']
+        frames = []
+        for offset,distance in self._coex_distance_blocks():
+            keep = np.flatnonzero(distance >= min_distance)
+            if len(keep) == 0:
+                continue
+            block = slice(offset, offset+len(distance))
+            df = pd.DataFrame(
+                {key: self.coex.data[key][block][keep] for key in keys},
+                columns=keys, index=keep+offset
+            )
+            df.insert(1,'distance',distance[keep])
+            frames.append(df)
+        if len(frames) == 0:
+            df = pd.DataFrame(columns=keys)
+            df.insert(1,'distance',np.empty(0,dtype='float32'))
+            return df
+        return pd.concat(frames)
+
+    def drop_distance_column(self):
+        '''
+            Removes the stored distance column from the coexpression
+            table. Distances are then calculated on the fly from the
+            gene coordinates (see _coex_distance), which roughly
+            halves the size of the table.
+
+            Returns
+            -------
+            None
+        '''
+        if self.coex is None or 'distance' not in self.coex.data.names:
+            return
+        self.coex.data.delcol(name='distance')
+        self.coex.data.flush()
+        self.coex = self._bcolz('coex',blaze=True)
     
     def neighbors(self, gene, sig_only=True, names_as_index=True, 
                   names_as_cols=False, return_gene_set=False):
@@ -342,7 +574,7 @@ class COB(Expr):
             names_as_index = True
         # Find the indexes if necessary
         if names_as_index or names_as_cols:
-            names = self._expr.index.values
+            names = self._expr_index.values
             ids = edges.index.values
             ids = PCCUP.coex_expr_index(ids, self.num_genes())
             edges.insert(0,'gene_a', names[ids[:,0]])
@@ -515,26 +747,38 @@ class COB(Expr):
         '''
         num_genes = self.num_genes()
         if gene_list is None:
-            # Return the entire DataFrame
-            df = self._coex_DataFrame(sig_only=sig_only)
+            if min_distance is None:
+                # Return the entire DataFrame
+                df = self._coex_DataFrame(sig_only=sig_only)
+            else:
+                # Only fetch the edges far enough apart
+                if sig_only:
+                    ids = self._filter_min_distance(self.sigs, min_distance)
+                    df = self._coex_DataFrame(ids=ids,sig_only=sig_only)
+                    del ids
+                else:
+                    df = self._coex_DataFrame_min_distance(min_distance)
         else:
             # Extract the ids for each Gene
             gene_list = set(sorted(gene_list))
-            ids = np.array([self._expr_index[x.id] for x in gene_list])
+            ids = self._expr_index.get_indexer([x.id for x in gene_list])
             if filter_missing_gene_ids:
-                # filter out the Nones
-                ids = np.array([x for x in ids if x is not None])
+                # filter out the genes not in the network
+                ids = ids[ids >= 0]
+            elif np.any(ids < 0):
+                raise ValueError(
+                    'gene_list contains genes not in {}'.format(self.name)
+                )
             if len(ids) == 0:
                 df = pd.DataFrame(columns=['score','significant','distance'])
             else:
                 # Grab the coexpression indices for the genes
                 ids = PCCUP.coex_index(ids, num_genes)
+                ids = self._filter_min_distance(ids, min_distance)
                 df = self._coex_DataFrame(ids=ids,sig_only=sig_only)
                 del ids
-        if min_distance is not None:
-            df = df[df.distance >= min_distance]
         if names_as_index or names_as_cols or trans_locus_only:
-            names = self._expr.index.values
+            names = self._expr_index.values
             ids = df.index.values
             if len(ids) > 0:
                 ids = PCCUP.coex_expr_index(ids, num_genes)
@@ -761,7 +1005,7 @@ class COB(Expr):
             
             # Find the ids from those
             self.log("Finding the IDs")
-            names = self._expr.index.values
+            names = self._expr_index.values
             ids = PCCUP.coex_expr_index(score.index.values, self.num_genes())
             score.insert(0,'gene_a', names[ids[:,0]])
             score.insert(1,'gene_b', names[ids[:,1]])
@@ -784,7 +1028,7 @@ class COB(Expr):
         names_as_cols=False).index.values
         
         # Find the ids from those
-        names = self._expr.index.values
+        names = self._expr_index.values
         edges = PCCUP.coex_expr_index(edges, self.num_genes())
         df = pd.DataFrame(index=np.arange(edges.shape[0]))
         df['gene_a'] = names[edges[:,0]]
@@ -807,7 +1051,7 @@ class COB(Expr):
         if cluster_method == 'leaf':
             order = self._bcolz('leaves').sort('index').index.values
         elif cluster_method == 'mcl':
-            order = self._bcolz('clusters').loc[dm.index].\
+            order = self.clusters.loc[dm.index].\
                     fillna(np.inf).sort('cluster').index.values
         else:
             order = dm.index
@@ -1039,7 +1283,9 @@ class COB(Expr):
         '''
         # Inspired by https://github.com/networkx/networkx/blob/master/networkx/convert_matrix.py
         import markov_clustering as mc
-        matrix,gene_index = self.to_sparse_matrix(gene_list=gene_list)
+        matrix,gene_index = self.to_sparse_matrix(
+            gene_list=gene_list, min_distance=min_distance
+        )
         # Run MCL
         result = mc.run_mcl(matrix)
         clusters = mc.get_clusters(result)
@@ -1313,11 +1559,11 @@ class COB(Expr):
             'angle' : theta
         }
 
-    def cluster_expression(self,min_cluster_size=10,normalize=True):
+    def cluster_expression(self,min_cluster_size=10,normalize=True,method='mean'):
         '''
             Get a matrix of cluster x accession gene expression.
             Each row represents the average gene expression in each accession
-            for the genes in the cluster.
+            for the genes in the cluster (or the cluster eigengene).
 
             Parameters
             ----------
@@ -1329,6 +1575,12 @@ class COB(Expr):
                 0 will represent the average (mean) across all accessions
                 and the resultant values in the row will represent the number 
                 of standard deviations from the mean.
+            method : str (default: mean)
+                'mean' averages the expression of the genes in each cluster.
+                'eigengene' uses the first principal component of the
+                (standard normalized) expression of the genes in each
+                cluster, oriented so it correlates positively with the
+                cluster mean and scaled to unit variance.
 
             Returns
             -------
@@ -1338,18 +1590,79 @@ class COB(Expr):
             for each accession.
 
         '''
-        # Extract clusters
-        dm = self.clusters.groupby('cluster').\
-                filter(lambda x: len(x) >= min_cluster_size).\
-                groupby('cluster').\
-                apply(lambda x: self.expr(genes=self.refgen[x.index]).mean())
-        if normalize:
-            dm = dm.apply(lambda x: (x-x.mean())/x.std() ,axis=1)
-        if len(dm) == 0:
+        if method not in ('mean','eigengene'):
+            raise ValueError("method must be one of 'mean' or 'eigengene'")
+        # Map cluster labels onto expression matrix rows
+        labels,clusters = pd.factorize(self.clusters['cluster'], sort=True)
+        # genes without a cluster are labeled -1, leave them out
+        labeled = labels >= 0
+        sizes = np.bincount(labels[labeled], minlength=len(clusters))
+        rows = self._expr_index.get_indexer(self.clusters.index)
+        keep = labeled & (rows >= 0)
+        keep[keep] = sizes[labels[keep]] >= min_cluster_size
+        if not np.any(keep):
             self.log.warn('No clusters larger than {} ... skipping',min_cluster_size)
             return None
+        kept = np.flatnonzero(sizes >= min_cluster_size)
+        kept = kept[np.isin(kept, labels[keep])]
+        # renumber the kept clusters 0..k-1
+        codes = np.searchsorted(kept, labels[keep])
+        values = np.asarray(self._expr.values[rows[keep]], dtype=np.float64)
+        if method == 'mean':
+            dm = self._cluster_means(values, codes, len(kept))
+        else:
+            dm = self._cluster_eigengenes(values, codes, len(kept))
+        dm = pd.DataFrame(
+            dm, index=pd.Index(clusters[kept], name='cluster'),
+            columns=self.accessions()
+        )
+        if normalize:
+            dm = self._normalize_rows(dm)
         return dm
 
+    @staticmethod
+    def _cluster_means(values, codes, num_clusters):
+        '''
+            Averages the rows of values by cluster (ignoring nans)
+            using a sparse cluster by row indicator matrix.
+        '''
+        indicator = sparse.csr_matrix(
+            (np.ones(len(codes)), (codes, np.arange(len(codes)))),
+            shape=(num_clusters, len(codes))
+        )
+        missing = np.isnan(values)
+        sums = indicator @ np.where(missing, 0, values)
+        counts = indicator @ (~missing).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+
+    @classmethod
+    def _cluster_eigengenes(cls, values, codes, num_clusters):
+        '''
+            Calculates the eigengene (first principal component) of
+            the rows of values in each cluster. Rows are grouped with
+            a single sort and each cluster is decomposed in turn.
+        '''
+        means = cls._cluster_means(values, codes, num_clusters)
+        # standard normalize the genes, missing values become the mean
+        values = cls._zscore_rows(values)
+        values[~np.isfinite(values)] = 0
+        order = np.argsort(codes, kind='mergesort')
+        bounds = np.searchsorted(codes[order], np.arange(num_clusters+1))
+        eigengenes = np.full((num_clusters, values.shape[1]), np.nan)
+        for i in range(num_clusters):
+            block = values[order[bounds[i]:bounds[i+1]]]
+            _,_,vt = np.linalg.svd(block, full_matrices=False)
+            eigengene = vt[0]
+            # orient along the average expression of the cluster
+            mean = np.nan_to_num(means[i] - np.nanmean(means[i]))
+            if np.dot(eigengene, mean) < 0:
+                eigengene = -eigengene
+            std = eigengene.std(ddof=1)
+            if std > 0:
+                eigengenes[i] = (eigengene - eigengene.mean()) / std
+        return eigengenes
+
 
     def coordinates(self,iterations=50,force=False,max_edges=100000,lcc_only=True):
         ''' 
@@ -1749,25 +2062,504 @@ class COB(Expr):
         }
         return ans
 
+    def add_accessions(self, df, significance_thresh=None, norm_method=None,
+                       recalculate_clusters=False, block_size=None):
+        '''
+            Adds accessions to a network built with store_pair_stats=True
+            (see COB.from_Expr) without recalculating the correlations
+            from scratch. The new accessions are filtered and normalized
+            like the originals, their contribution is added to the stored
+            pair statistics in a single pass and the coex table and
+            degree are rebuilt from the updated PCCs.
+
+            Parameters
+            ----------
+            df : pandas.DataFrame
+                Raw expression values for the new accessions. Genes are in
+                the index and accessions in the columns, like the input
+                of COB.from_DataFrame. Only genes already in the network
+                are used.
+            significance_thresh : float (default: None)
+                The zscore cutoff for the network. Defaults to the
+                one the network was built with.
+            norm_method : python function (default: None)
+                The normalization applied to the new values. By default
+                it is inferred from the transformation log, it needs to
+                be passed in for custom normalizations.
+            recalculate_clusters : bool (default: False)
+                Also recalculate the leaves and MCL clusters. These
+                are left as they were by default.
+            block_size : int (default: None)
+                The number of genes per block used to update the pair
+                statistics (see COB._accumulate_pair_stats).
+
+            Returns
+            -------
+            self : COB Object
+
+            Notes
+            -----
+            The updated PCCs match those of a network built from all of
+            the accessions with store_pair_stats=True up to floating
+            point rounding. Networks built without pair statistics
+            accumulate the PCCs in single precision, the PCCs agree with
+            those within about 1e-5 (1e-3 for the z-scores). Gene QC is not repeated, the new
+            values are only filtered with the original min_expr,
+            presence_absence and max_accession_missing_data
+            settings, so a full rebuild
+            can keep a different set of genes. Quantile normalized
+            networks can not be updated since adding accessions
+            changes the normalization of the existing ones.
+        '''
+        stats = self._pair_stats(mode='r')
+        if stats is None:
+            raise ValueError(
+                f'{self.name} does not store pair statistics, '
+                'rebuild it with store_pair_stats=True'
+            )
+        if int(self._global('pair_stats_accessions') or -1) \
+            != self.num_accessions():
+            raise ValueError(
+                f'The pair statistics for {self.name} are out of date, '
+                'rebuild it with store_pair_stats=True'
+            )
+        # Figure out how the original accessions were normalized
+        steps = self._transformation_log().split('->')
+        if 'quantile' in steps:
+            raise ValueError(
+                'Accessions can not be added to quantile normalized networks'
+            )
+        if norm_method is None:
+            known = {'arcsinh':np.arcsinh, 'log2':np.log2}
+            unknown = [
+                x for x in steps if x not in known and not x.startswith('Raw')
+                and x not in ('raw', 'quality_control', 'DetectedPreNormalized',
+                              'add_accessions', 'raw_add_accessions')
+            ]
+            if len(unknown) > 0:
+                raise ValueError(
+                    'Could not guess the normalization from {}, pass it '
+                    'in through norm_method'.format(
+                        self._transformation_log()
+                    )
+                )
+            normalized = [x for x in steps if x in known]
+            if len(normalized) > 0:
+                norm_method = known[normalized[-1]]
+        # Compare names the way they are stored in the raw
+        # and the normalized tables
+        df = df.copy()
+        df.columns = self._clean_accession_names(df.columns)
+        short_names = self._clean_accession_names(df.columns, shorten=True)
+        if len(set(df.columns)) != len(df.columns) \
+            or len(set(short_names)) != len(short_names) \
+            or not set(self._raw_metadata()[1]).isdisjoint(df.columns) \
+            or not set(self.accessions()).isdisjoint(short_names):
+            raise CamocoAccessionNameError('Accession names must be unique')
+        if significance_thresh is None:
+            significance_thresh = float(self._global('significance_threshold'))
+        df.index = self._clean_gene_names(df.index)
+        self.log(
+            'Adding {} accessions to {}', len(df.columns), self.name
+        )
+        # Line the new values up with the network genes
+        new = df.reindex(self._expr_index).astype(self._expr_dtype)
+        self.log(
+            '{} genes are not in the network and were ignored',
+            len(df.index.difference(self._expr_index))
+        )
+        if self._global('qc_min_expr') is not None:
+            min_expr = float(self._global('qc_min_expr'))
+            presence_absence = bool(int(self._global('qc_presence_absence') or 0))
+            if presence_absence:
+                zeros = new == 0
+            with np.errstate(invalid='ignore'):
+                new[new < min_expr] = np.nan
+            if presence_absence:
+                new[zeros] = 0.001
+            max_missing = float(self._global('qc_max_accession_missing_data'))
+            passing = new.isnull().mean(axis=0) <= max_missing
+            self.log(
+                'Found {} accessions with > {} missing data',
+                sum(passing == False), max_missing
+            )
+            new = new.loc[:,passing]
+        if len(new.columns) == 0:
+            self.log.warn('No accessions passed QC')
+            return self
+        if norm_method is not None:
+            new = new.apply(lambda col: norm_method(col), axis=0)
+        # Update a copy of the statistics, it only replaces the
+        # stored statistics once both tables are written
+        del stats
+        filename = self._expr_file('pair_stats')
+        updated = self._expr_file('pair_stats_update')
+        shutil.copyfile(filename, updated)
+        try:
+            self.log('Updating pair statistics')
+            stats = np.load(updated, mmap_mode='r+')
+            pccs = self._accumulate_pair_stats(
+                new.values, stats, block_size=block_size
+            )
+            stats.flush()
+            del stats
+            self._log_memory('pair statistics')
+            # Store the raw and the normalized values
+            self._update_values(
+                pd.concat([self.expr(raw=True), df], axis=1, sort=False),
+                'raw_add_accessions', raw=True, reset=False
+            )
+            self._update_values(
+                pd.concat([self._expr, new], axis=1), 'add_accessions'
+            )
+            os.replace(updated, filename)
+        finally:
+            if os.path.exists(updated):
+                os.remove(updated)
+        self._global('pair_stats_accessions', self.num_accessions())
+        store_distance = 'distance' in self.coex.data.names
+        self._store_coexpression(
+            pccs, significance_thresh, store_distance=store_distance
+        )
+        # Bring the build manifest up to date, the stages
+        # after coexpression are run as usual
+        params = self._build_params(
+            significance_thresh=significance_thresh,
+            store_distance=store_distance,
+            store_pair_stats=True
+        )
+        self._record_stage(
+            'coexpression', 'done', params=params['coexpression'],
+            input_hash=self._stage_input_hashes(params)['coexpression']
+        )
+        stages = ['degree']
+        if recalculate_clusters:
+            stages += ['leaves', 'clusters']
+        else:
+            self.log.warn(
+                'The leaves and clusters were not updated, '
+                'pass recalculate_clusters=True to update them'
+            )
+        self._run_build_stages(params, stages)
+        return self
+
+    def has_clusters(self):
+        '''
+            Returns True if the MCL clusters have been calculated.
+            Unlike accessing COB.clusters, this never calculates them.
+        '''
+        return bool(available_datasets('Ontology','{}MCL'.format(self.name)))
+
+    def calculate_clusters(self, force=False):
+        '''
+            Calculates the MCL clusters, if the network does not have
+            them yet, and loads them. This holds a lock so when several
+            processes open the same network, only one calculates the
+            clusters while the others wait for it to finish.
+
+            Parameters
+            ----------
+            force : bool (default: False)
+                Recalculate the clusters even if they exist.
+
+            Returns
+            -------
+            self : COB Object
+        '''
+        with file_lock(self._clusters_lock()):
+            # Another process may have finished them while we waited
+            if force or not self.has_clusters():
+                self._run_build_stages(self._manifest_params(), ['clusters'])
+            else:
+                self._load_clusters(calculate=False)
+        return self
+
+    def _clusters_lock(self):
+        '''
+            The path of the lock file held while clusters are calculated.
+        '''
+        return os.path.expanduser(os.path.join(
+            cf.options.basedir,
+            'databases',
+            '{}.{}.clusters.lock'.format(self.type, self.name)
+        ))
+
+    def _clusters_stage(self):
+        '''
+            The clusters build stage. Clusters are calculated under the
+            clusters lock so processes opening the network while it is
+            being built wait for them instead of calculating them too.
+        '''
+        with file_lock(self._clusters_lock()):
+            self._calculate_clusters()
+
+    def _load_clusters(self, calculate=True):
+        '''
+            Loads the clusters and the MCL ontology. If the network does
+            not have them, they are calculated when calculate is True.
+        '''
+        if self.has_clusters():
+            self.log('Loading Clusters')
+            self._clusters = self._bcolz('clusters')
+            self._MCL = Ontology('{}MCL'.format(self.name))
+        elif calculate and self.coex is not None:
+            self.calculate_clusters()
+
+    def build_status(self):
+        '''
+            Returns the status of each build stage (see BUILD_STAGES):
+            one of 'done', 'running', 'failed', 'skipped', 'deferred'
+            or None if it never ran. Stages which are done but whose
+            inputs have changed since (e.g. after adding accessions)
+            are 'stale'. Networks built without a build manifest
+            are assumed to be done.
+        '''
+        manifest = self._build_manifest()
+        if manifest is None:
+            return {stage:'done' for stage in BUILD_STAGES}
+        status = {
+            stage:manifest.get(stage,{}).get('status') 
+            for stage in BUILD_STAGES
+        }
+        coex_hash = manifest.get('coexpression',{}).get('input_hash')
+        for stage in BUILD_STAGES[1:]:
+            entry = manifest.get(stage,{})
+            if status[stage] == 'done' and entry.get('input_hash') != \
+                self._stage_hash(coex_hash, stage, entry.get('params')):
+                status[stage] = 'stale'
+        return status
+
+    def complete_build(self, stages=None):
+        '''
+            Runs the build stages which were deferred, failed or are
+            stale, with the parameters recorded in the build manifest.
+
+            Parameters
+            ----------
+            stages : iterable of str (default: None)
+                The stages to run. By default all stages which are
+                not done, except for the ones that were skipped.
+
+            Returns
+            -------
+            self : COB Object
+        '''
+        status = self.build_status()
+        if stages is None:
+            stages = [
+                stage for stage in BUILD_STAGES
+                if status[stage] not in ('done', 'skipped')
+            ]
+        return self._run_build_stages(
+            self._manifest_params(), stages, resume=True
+        )
+
+    def _manifest_params(self):
+        '''
+            Returns the keyword arguments of each build stage recorded
+            in the build manifest, with defaults for missing ones.
+        '''
+        manifest = self._build_manifest() or self._legacy_manifest()
+        params = self._build_params()
+        for stage in BUILD_STAGES:
+            params[stage].update(manifest.get(stage,{}).get('params',{}))
+        return params
+
 
     ''' ----------------------------------------------------------------------
             Internal Methods
     '''
 
-    def _calculate_coexpression(self, significance_thresh=3):
+    def _build_manifest(self):
+        '''
+            Returns the build manifest, a dictionary with the status,
+            parameters, input hash and timestamps of each build stage
+            (see COB.from_Expr), or None if the network was built
+            without one.
+        '''
+        manifest = self._global('build_manifest')
+        if manifest is None:
+            return None
+        return json.loads(manifest)
+
+    def _record_stage(self, stage, status, **fields):
+        '''
+            Updates the status of a build stage in the build manifest,
+            along with any additional fields (e.g. params, input_hash).
+        '''
+        manifest = self._build_manifest()
+        if manifest is None:
+            manifest = self._legacy_manifest()
+        if status == 'running':
+            # forget about previous attempts
+            manifest[stage] = {}
+        entry = manifest.setdefault(stage, {})
+        entry.update(fields)
+        entry['status'] = status
+        timestamp = {'running':'started', 'done':'completed'}.get(status, status)
+        entry[timestamp] = time.strftime('%Y-%m-%d %H:%M:%S')
+        self._global('build_manifest', json.dumps(manifest))
+
+    def _legacy_manifest(self):
+        '''
+            Returns a build manifest for networks built before manifests
+            were recorded, with every stage done with the parameters the
+            network was built with.
+        '''
+        params = self._build_params(
+            significance_thresh=float(self._global('significance_threshold') or 3),
+            store_distance=self.coex is not None \
+                and 'distance' in self.coex.data.names,
+            store_pair_stats=self._pair_stats() is not None
+        )
+        hashes = self._stage_input_hashes(params)
+        return {
+            stage : {
+                'status' : 'done', 
+                'params' : params[stage], 
+                'input_hash' : hashes[stage]
+            } for stage in BUILD_STAGES
+        }
+
+    @staticmethod
+    def _build_params(significance_thresh=3, store_distance=False,
+                      store_pair_stats=False, leaves_method='single'):
+        '''
+            Returns the keyword arguments of each build stage.
+        '''
+        return {
+            'coexpression' : {
+                'significance_thresh' : float(significance_thresh),
+                'store_distance' : bool(store_distance),
+                'store_pair_stats' : bool(store_pair_stats)
+            },
+            'degree' : {},
+            'leaves' : {'method' : leaves_method},
+            'clusters' : {}
+        }
+
+    def _stage_input_hashes(self, params):
+        '''
+            Hashes the inputs of each build stage. The coexpression
+            stage depends on the expression matrix and its parameters,
+            the rest on the coexpression stage and their parameters.
+        '''
+        expr = self._expr
+        digest = hashlib.sha1()
+        digest.update(str(expr.values.dtype).encode())
+        digest.update(np.ascontiguousarray(expr.values))
+        digest.update(json.dumps([
+            [str(x) for x in expr.index], [str(x) for x in expr.columns]
+        ]).encode())
+        digest.update(json.dumps(params['coexpression'],sort_keys=True).encode())
+        hashes = {'coexpression' : digest.hexdigest()}
+        for stage in BUILD_STAGES[1:]:
+            hashes[stage] = self._stage_hash(
+                hashes['coexpression'], stage, params[stage]
+            )
+        return hashes
+
+    @staticmethod
+    def _stage_hash(coex_hash, stage, params):
+        '''
+            Hashes the inputs of a stage after coexpression.
+        '''
+        return hashlib.sha1(
+            json.dumps([coex_hash, stage, params], sort_keys=True).encode()
+        ).hexdigest()
+
+    def _run_build_stages(self, params, stages, resume=False, skip=(), defer=()):
+        '''
+            Runs build stages in order, recording their progress in the
+            build manifest. Stages not in stages are left alone.
+
+            Parameters
+            ----------
+            params : dict
+                The keyword arguments of each stage (see _build_params)
+            stages : iterable of str
+                The stages to run
+            resume : bool (default: False)
+                Do not run stages which the manifest records as
+                completed with the same input hash.
+            skip : iterable of str (default: ())
+                Stages which are recorded as skipped instead of run
+            defer : iterable of str (default: ())
+                Stages which are recorded as deferred instead of run
+        '''
+        methods = {
+            'coexpression' : self._calculate_coexpression,
+            'degree' : self._calculate_degree,
+            'leaves' : self._calculate_leaves,
+            'clusters' : self._clusters_stage
+        }
+        hashes = self._stage_input_hashes(params)
+        manifest = self._build_manifest() or {}
+        for stage in BUILD_STAGES:
+            if stage not in stages:
+                continue
+            fields = {'params' : params[stage], 'input_hash' : hashes[stage]}
+            if stage in skip or stage in defer:
+                status = 'skipped' if stage in skip else 'deferred'
+                self.log('Build stage {} was {}', stage, status)
+                self._record_stage(stage, status, **fields)
+                continue
+            previous = manifest.get(stage, {})
+            if resume and previous.get('status') == 'done' \
+                and previous.get('input_hash') == hashes[stage]:
+                self.log(
+                    'Build stage {} was completed on {}, skipping',
+                    stage, previous.get('completed')
+                )
+                continue
+            self._record_stage(stage, 'running', **fields)
+            try:
+                methods[stage](**params[stage])
+            except Exception as e:
+                self._record_stage(stage, 'failed', error=repr(e))
+                raise e
+            self._log_memory(stage)
+            self._record_stage(stage, 'done')
+        return self
+
+    def _calculate_coexpression(self, significance_thresh=3, store_distance=False,
+                                store_pair_stats=False):
         '''
             Generates pairwise PCCs for gene expression profiles in self._expr.
-            Also calculates pairwise gene distance.
+            If store_distance is True, also calculates and stores pairwise
+            gene distance, otherwise distances are calculated when needed.
+            If store_pair_stats is True, the PCCs are calculated from per
+            pair sufficient statistics which are kept so accessions can
+            be added later (see COB.add_accessions).
         '''
         # 1. Calculate the PCCs
         self.log("Calculating Coexpression")
-        pccs = (1 - PCCUP.pair_correlation(
-            np.ascontiguousarray(
-                # PCCUP expects floats
-                self._expr.as_matrix().astype('float')
-            )
-        ))
-        
+        expr = self._expr.values
+        if expr.dtype not in (np.float32, np.float64):
+            # PCCUP expects floats
+            expr = expr.astype('float')
+        if store_pair_stats:
+            stats = self._pair_stats(mode='w+', num_genes=expr.shape[0])
+            pccs = self._accumulate_pair_stats(expr, stats)
+            stats.flush()
+            del stats
+            self._global('pair_stats_accessions', expr.shape[1])
+        else:
+            # stats from a previous build no longer match
+            self._drop_pair_stats()
+            # float32 and float64 matrices are passed through as is
+            pccs = (1 - PCCUP.pair_correlation(np.ascontiguousarray(expr)))
+        del expr
+        self._log_memory('pair correlation')
+        return self._store_coexpression(
+            pccs, significance_thresh, store_distance=store_distance
+        )
+
+    def _store_coexpression(self, pccs, significance_thresh, store_distance=False):
+        '''
+            Fisher transforms and standardizes the pairwise PCCs
+            and stores them as the coex table.
+        '''
         self.log("Applying Fisher Transform")
         pccs[pccs >= 1.0] = 0.9999999
         pccs[pccs <= -1.0] = -0.9999999
@@ -1798,9 +2590,10 @@ class COB(Expr):
         gc.collect()
         
         # 4. Calculate Gene Distance
-        self.log("Calculating Gene Distance")
-        raw_coex.addcol(self.refgen.pairwise_distance(
-            gene_list=self.refgen.from_ids(self._expr.index)), pos=1, name='distance')
+        self._gene_coordinate_cache = None
+        if store_distance:
+            self.log("Calculating Gene Distance")
+            self._store_distance(raw_coex)
         gc.collect()
         
         # 5. Cleanup
@@ -1814,6 +2607,132 @@ class COB(Expr):
         self.log("Done")
         return self
 
+    def _store_distance(self, raw_coex):
+        '''
+            Calculates pairwise gene distances and stores them
+            as a column in the coex table.
+        '''
+        # Distances are written to disk block by block, then moved
+        # into the coex table
+        tmpdir = self._tmpdir()
+        distances = bcz.carray(
+            np.empty(0,dtype='float32'),
+            expectedlen=len(raw_coex),
+            rootdir=os.path.join(tmpdir,'distance'),
+            mode='w'
+        )
+        self.refgen.pairwise_distance(
+            gene_list=self._expr_index, out=distances
+        )
+        distances.flush()
+        raw_coex.addcol(distances, pos=1, name='distance', move=True)
+        del distances
+        shutil.rmtree(tmpdir,ignore_errors=True)
+
+    def _pair_stats(self, mode='r+', num_genes=None):
+        '''
+            Memory maps the stored per pair sufficient statistics: a
+            float64 array with a row for each of PAIR_STATS and a column
+            for each gene pair, in coex table order.
+
+            Parameters
+            ----------
+            mode : str (default: 'r+')
+                The memory map mode. 'w+' creates a new, zeroed, array
+                for num_genes genes.
+            num_genes : int (default: None)
+                The number of genes, only used when mode is 'w+'
+
+            Returns
+            -------
+            The memory mapped array or None if the network does not
+            store pair statistics.
+        '''
+        filename = self._expr_file('pair_stats')
+        if mode == 'w+':
+            return np.lib.format.open_memmap(
+                filename, mode='w+', dtype=np.float64,
+                shape=(len(PAIR_STATS), comb(num_genes,2,exact=True))
+            )
+        if not os.path.exists(filename):
+            return None
+        return np.load(filename, mmap_mode=mode)
+
+    def _drop_pair_stats(self):
+        '''
+            Removes the stored pair statistics.
+        '''
+        filename = self._expr_file('pair_stats')
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    @staticmethod
+    def _accumulate_pair_stats(values, stats, block_size=None):
+        '''
+            Adds the sufficient statistics for the PCCs between the rows
+            of values to stats, in place, and returns the PCCs calculated
+            from the updated statistics.
+
+            For each pair of genes (u,v) the statistics are the number of
+            accessions where neither is nan and the sums of u, v, u^2, v^2
+            and uv over those accessions, which is everything that
+            PCCUP.pair_correlation accumulates. Since they are sums, adding
+            the statistics of new accessions gives the statistics of all
+            accessions. Genes are processed in blocks using matrix products
+            and each block is written to stats before moving on, so stats
+            can be a memory mapped array.
+
+            Parameters
+            ----------
+            values : 2D numpy array
+                genes (rows) by accessions (columns)
+            stats : 2D numpy array
+                float64 array with a row for each of PAIR_STATS and
+                a column for each gene pair in coex table order
+            block_size : int (default: None)
+                The number of genes per block. By default blocks
+                span about 2 million pairs.
+
+            Returns
+            -------
+            A float32 array containing the PCC for each gene pair. Like
+            PCCUP.pair_correlation, pairs with less than 10 shared
+            accessions or without variance are nan.
+        '''
+        num_genes = values.shape[0]
+        present = np.isfinite(values)
+        filled = np.where(present, values, 0).astype(np.float64)
+        squared = filled**2
+        present = present.astype(np.float64)
+        if block_size is None:
+            block_size = max(1, 2000000 // max(num_genes,1))
+        pccs = np.empty(stats.shape[1], dtype=np.float32)
+        genes = np.arange(num_genes)
+        start = 0
+        for first in range(0, num_genes, block_size):
+            rows = slice(first, first+block_size)
+            # only pairs (i,j) with i < j are stored, row by row
+            upper = genes[None,first:] > genes[rows,None]
+            stop = start + upper.sum()
+            pairs = slice(start, stop)
+            stats[0,pairs] += (present[rows] @ present[first:].T)[upper]
+            stats[1,pairs] += (filled[rows] @ present[first:].T)[upper]
+            stats[2,pairs] += (present[rows] @ filled[first:].T)[upper]
+            stats[3,pairs] += (squared[rows] @ present[first:].T)[upper]
+            stats[4,pairs] += (present[rows] @ squared[first:].T)[upper]
+            stats[5,pairs] += (filled[rows] @ filled[first:].T)[upper]
+            count,sum_u,sum_v,sum_u2,sum_v2,sum_uv = stats[:,pairs]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                num = sum_uv - sum_u*sum_v/count
+                den = np.sqrt(
+                    (sum_u2 - sum_u**2/count) * (sum_v2 - sum_v**2/count)
+                )
+                pcc = num / den
+            pcc[(count < 10) | (den == 0)] = np.nan
+            pccs[pairs] = pcc
+            start = stop
+        return pccs
+
     def _calculate_degree(self,update_db=True):
         '''
             Calculates degrees of genes within network. 
@@ -1821,12 +2740,12 @@ class COB(Expr):
         self.log('Building Degree')
         # Get significant expressions and dump coex from memory for time being
         # Generate a df that starts all genes at 0
-        names = self._expr.index.values
+        names = self._expr_index.values
         self.degree = pd.DataFrame(0,index=names,columns=['Degree'])
         # Get the index and find the counts
         self.log('Calculating Gene degree')
         sigs = np.arange(len(self.coex))[odo(self.coex.significant,np.ndarray)]
-        sigs = PCCUP.coex_expr_index(sigs, len(self._expr.index.values))
+        sigs = PCCUP.coex_expr_index(sigs, len(self._expr_index.values))
         sigs = list(Counter(chain(*sigs)).items())
         if len(sigs) > 0:
             # Translate the expr indexes to the gene names
@@ -1880,7 +2799,7 @@ class COB(Expr):
         gc.collect()
         
         # Put them in a dataframe and stow them
-        self.leaves = pd.DataFrame(leaves,index=self._expr.index,columns=['index'])
+        self.leaves = pd.DataFrame(leaves,index=self._expr_index,columns=['index'])
         self._gene_link = gene_link
         self._bcolz('leaves', df=self.leaves)
         
@@ -1894,7 +2813,7 @@ class COB(Expr):
         '''
         clusters = self.mcl()
         self.log('Building cluster dataframe')
-        names = self._expr.index.values
+        names = self._expr_index.values
         self.clusters = pd.DataFrame(np.nan,index=names,columns=['cluster'])
         if len(clusters) > 0:
             self.clusters = pd.DataFrame(
@@ -1954,14 +2873,12 @@ class COB(Expr):
         self._bcolz('degree', df=pd.DataFrame())
         self._bcolz('mcl_cluster', df=pd.DataFrame())
         self._bcolz('leaves', df=pd.DataFrame())
-        self._expr_index = defaultdict(
-            lambda: None,
-            {gene:index for index, gene in enumerate(self._expr.index)}
-        )
         return self
 
     @classmethod
-    def from_Expr(cls, expr, zscore_cutoff=3, **kwargs):
+    def from_Expr(cls, expr, zscore_cutoff=3, store_distance=False,
+                  store_pair_stats=False, resume=False, skip_stages=(),
+                  defer_stages=(), **kwargs):
         '''
             Create a COB instance from an camoco.Expr (Expression) instance.
             A COB inherits all the methods of a Expr instance and implements
@@ -1976,18 +2893,55 @@ class COB(Expr):
                 co-expression network.
             zscore_cutoff : int (defualt: 3)
                 The zscore cutoff for the network.
+            store_distance : bool (default: False)
+                If True, store the pairwise gene distances as a
+                column in the coex table. Otherwise they are
+                calculated from gene coordinates when needed.
+            store_pair_stats : bool (default: False)
+                If True, keep the per pair sums the PCCs are calculated
+                from so accessions can be added without rebuilding the
+                network (see COB.add_accessions). These take 48 bytes
+                per gene pair on disk.
+            resume : bool (default: False)
+                If True, stages the build manifest records as completed
+                with the same inputs are not run again. Use this to pick
+                up a build that failed part of the way through.
+            skip_stages : iterable of str (default: ())
+                Build stages (see BUILD_STAGES) which are not run, 
+                e.g. 'leaves'.
+            defer_stages : iterable of str (default: ())
+                Build stages which are not run now, but can be later
+                with COB.complete_build, e.g. 'clusters'.
 
             Returns
             -------
             camoco.COB instance
 
+            Notes
+            -----
+            The status, parameters, input hash and timestamps of each
+            stage are recorded in a build manifest as the build goes.
+
         '''
         # The Expr object already exists, just get a handle on it
         self = expr
-        self._calculate_coexpression()
-        self._calculate_degree()
-        self._calculate_leaves()
-        self._calculate_clusters()
+        for stage in set(skip_stages) | set(defer_stages):
+            if stage not in BUILD_STAGES[1:]:
+                raise ValueError(
+                    f'Cannot skip or defer {stage}, must be one '
+                    f'of {BUILD_STAGES[1:]}'
+                )
+        if not resume or self._build_manifest() is None:
+            self._global('build_manifest', json.dumps({}))
+        params = self._build_params(
+            significance_thresh=zscore_cutoff,
+            store_distance=store_distance,
+            store_pair_stats=store_pair_stats
+        )
+        self._run_build_stages(
+            params, BUILD_STAGES, resume=resume,
+            skip=skip_stages, defer=defer_stages
+        )
         return self
 
     @classmethod
@@ -2024,9 +2978,11 @@ class COB(Expr):
                 (see Expr.from_DataFrame)
 
         '''
-        dfs = [c.expr(raw=True) for c in cobs]
-        for cob,df in zip(cobs,dfs):
-            df.columns = [f'{acc}_{cob.name}' for acc in df.columns]
+        # The raw tables are shared with the cache, rename copies
+        dfs = [
+            c.expr(raw=True).rename(columns=lambda acc: f'{acc}_{c.name}')
+            for c in cobs
+        ]
         all_expr = pd.concat(dfs,axis=1,sort=False)
         # Call the internal from_dataframe method 
         return cls.from_DataFrame(
@@ -2075,12 +3031,12 @@ class COB(Expr):
             df, name, description, refgen, rawtype, 
             zscore_cutoff=zscore_cutoff, **kwargs
         )
-        return cls.from_Expr(expr)
+        return cls.from_Expr(expr, zscore_cutoff=zscore_cutoff, **kwargs)
 
     @classmethod
     def from_table(cls, filename, name, description,
                    refgen, rawtype=None, sep='\t', index_col=None, 
-                   zscore_cutoff=3, **kwargs):
+                   zscore_cutoff=3, chunksize=5000, **kwargs):
         '''
             Build a COB Object from an FPKM or Micrarray CSV. This is a
             convenience method which handles reading in of tables.
@@ -2115,6 +3071,9 @@ class COB(Expr):
                 for gene names.
             zscore_cutoff : int (defualt: 3)
                 The zscore cutoff for the network.
+            chunksize : int (default: 5000)
+                The table is streamed into memory this many rows at a
+                time, see Tools.read_expr_table.
             **kwargs : key value pairs
                 additional parameters passed to subsequent methods.
 
@@ -2122,11 +3081,12 @@ class COB(Expr):
             -------
                 a COB object
         '''
-        df = pd.read_table(
+        df = read_expr_table(
             filename,
             sep=sep,
-            compression='infer',
-            index_col=index_col
+            index_col=index_col,
+            chunksize=chunksize,
+            dtype='float32' if kwargs.get('float32',False) else 'float64'
         )
         return cls.from_DataFrame(
             df, name, description, refgen,
@@ -143,6 +143,17 @@ class Camoco(object):
             )
         )
 
+    def _tmpdir(self):
+        # returns the path to a new tmp directory
+        return tempfile.mkdtemp(
+            dir=os.path.expanduser(
+                os.path.join(
+                    cf.options.basedir,
+                    "tmp"
+                )
+            )
+        )
+
     def _global(self, key, val=None):
         # Set the global for the dataset
         try:
@@ -1,7 +1,9 @@
 #!/usr/bin/python
 
 import numpy as np
+import pandas as pd
 from camoco.Locus import Locus
+from camoco.Tools import random_state
 
 class Chrom(object):
     def __init__(self,id,length):
@@ -20,6 +22,33 @@ class Chrom(object):
         pos = np.random.randint(0,self.length)
         return Locus(chrom=self.id,start=pos,end=pos,id='rSNP-chr{}:{}'.format(self.id,pos))
 
+    def rLoci(self,n,length=0,seed=None):
+        '''
+            returns n random loci of the specified length within
+            the chromosome as a table. With length 0, each locus
+            is a single position (see rSNP).
+
+            Parameters
+            ----------
+            n : int
+                The number of loci to generate
+            length : int (default: 0)
+                The length of each locus
+            seed : int or numpy.random.RandomState (default: None)
+                Seed used for reproducible sampling.
+
+            Returns
+            -------
+            A pandas DataFrame with chrom, start, end and id columns
+        '''
+        rng = random_state(seed)
+        if length >= self.length:
+            raise ValueError(
+                'Locus of length {} does not fit in {}'.format(length,self)
+            )
+        starts = rng.randint(0,self.length-length,size=n)
+        return _loci_table(np.repeat(self.id,n),starts,length)
+
     def __len__(self):
         return self.length
 
@@ -29,4 +58,20 @@ class Chrom(object):
     def __repr__(self):
         return str(self)
 
-
+def _loci_table(chroms,starts,length):
+    '''
+        Builds the table returned by the random loci generators.
+        Ids follow the same convention as rLocus and rSNP.
+    '''
+    chroms = np.asarray(chroms).astype(str)
+    starts = np.asarray(starts,dtype=np.int64)
+    if length == 0:
+        ids = ['rSNP-chr{}:{}'.format(c,p) for c,p in zip(chroms,starts)]
+    else:
+        ids = np.repeat('rLocus-{}'.format(length),len(starts))
+    return pd.DataFrame({
+        'chrom' : chroms,
+        'start' : starts,
+        'end' : starts + length,
+        'id' : ids
+    },columns=['chrom','start','end','id'])
@@ -1,7 +1,8 @@
 #! /usr/bin/python3
 from .Camoco import Camoco
+from .Config import cf
 from .RefGen import RefGen
-from .Tools import memoize
+from .Tools import memoize,peak_memory,read_expr_table
 from .Locus import Locus
 from .Exceptions import CamocoGeneNameError,CamocoAccessionNameError,CamocoGeneAbsentError
 
@@ -9,38 +10,46 @@ from scipy.spatial.distance import pdist, squareform, euclidean
 from scipy.stats import hypergeom, pearsonr
 from scipy.stats.mstats import rankdata as mrankdata
 from scipy.cluster.hierarchy import linkage, dendrogram
-from collections import defaultdict,Counter
+from collections import defaultdict,Counter,OrderedDict
 
 import matplotlib
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import io
+import os
+import json
 import re
 import string
 
 pd.set_option('display.width', 100)
 
+# Raw expression tables are kept in memory once they have been read,
+# up to this many bytes in total. Least recently used tables are
+# dropped first, see Expr.clear_raw_cache.
+RAW_CACHE_BYTES = 2**30
+_raw_cache = OrderedDict()
+
 class Expr(Camoco):
     '''
         A gene expression dataset. Build, normalize, filter and 
         easily access different parts of the gene expression matrix.
     '''
     def __init__(self, name):
+        # The array backing self._expr when it is transformed
+        # in place, see Expr._working_values
+        self._expr_values = None
+        # The expression DataFrame, only built when needed (see Expr._expr)
+        self._expr_df = None
+        # The memory mapped expression matrix (see Expr._expr_arrays)
+        self._expr_mmap = None
         # Create a camoco object
         super().__init__(name=name, type='Expr')
-        # Part I: Load the Expression dataset
-        self.log('Loading Expr table')
-        self._expr = self._bcolz('expr')
+        # Part I: Open the Expression dataset, values are read lazily
+        self.log('Opening Expr table')
         self._gene_qc_status = self._bcolz('gene_qc_status')
-        if (self._expr is None) or (self._gene_qc_status is None):
+        if self._gene_qc_status is None:
             self._expr = pd.DataFrame()
-        
-        self.log('Building Expr Index')
-        self._expr_index = defaultdict(
-            lambda: None,
-            {gene:index for index, gene in enumerate(self._expr.index)}
-        )
         # Part II: Load the Reference Genome
         try:
             self.log('Loading RefGen')
@@ -51,12 +60,12 @@ class Expr(Camoco):
             self.log.warn('Refgen for {} not available, must be reset!', self.name)
 
     def __contains__(self, obj):
-        if obj in self._expr.index:
+        if obj in self._expr_index:
             return True
-        if obj in self._expr.columns:
+        if obj in self.accessions():
             return True
         try:
-            if obj.id in self._expr.index:
+            if obj.id in self._expr_index:
                 return True
         except AttributeError as e:
             pass
@@ -69,32 +78,42 @@ class Expr(Camoco):
         pass
 
     def num_genes(self,raw=False):
-        return len(self.expr(raw=raw))
+        if raw is False:
+            return len(self._expr_index)
+        if self._global('raw_num_genes') is None:
+            self._store_raw_metadata(self.expr(raw=True))
+        return int(self._global('raw_num_genes'))
 
     def num_accessions(self,raw=False):
-        return len(self.expr(raw=raw).columns)
+        if raw is False:
+            return len(self.accessions())
+        if self._global('raw_num_accessions') is None:
+            self._store_raw_metadata(self.expr(raw=True))
+        return int(self._global('raw_num_accessions'))
 
     def shape(self):
-        return self._expr.shape
+        return (len(self._expr_index),len(self.accessions()))
 
     def zscore(self):
         pass
 
     def accessions(self):
+        if self._expr_df is None and self._expr_arrays() is not None:
+            return self._expr_arrays()[2]
         return self._expr.columns
 
     def genes(self, raw=False):
         # Returns a list of distinct genes
         if raw is False:
-            return self.refgen.from_ids(self._expr.index)
+            return self.refgen.from_ids(self._expr_index)
         else:
-            return self.refgen.from_ids(self._bcolz('raw_expr').index)
+            return self.refgen.from_ids(self._raw_metadata()[0])
 
     def expr_profile(self, gene):
         '''
             return the expression profile for a gene
         '''
-        return self._expr.loc[gene.id]
+        return self.expr(genes=[gene]).iloc[0]
 
     def is_normalized(self, max_val=None, raw=False):
         if max_val is not None:
@@ -144,8 +163,12 @@ class Expr(Camoco):
 
         '''
         if raw is True:
-            self.log('Extracting raw expression values')
-            df = self._bcolz('raw_expr')
+            df = self._raw_expr()
+        elif genes is not None and self._expr_df is None \
+            and self._expr_arrays() is not None:
+            # only read the rows for genes from the memory mapped matrix
+            df = self._expr_rows([x.id for x in genes])
+            genes = None
         else:
             df = self._expr
         if genes is not None:
@@ -153,17 +176,37 @@ class Expr(Camoco):
         if accessions is not None:
             df = df[accessions]
         if gene_normalize:
-            df = df.apply(
-                # Axis: 1 applies to ROWS!
-                lambda row: (row-row.mean())/row.std(), axis=1
-            )
+            df = self._normalize_rows(df)
         return df
 
+    @staticmethod
+    def _normalize_rows(df):
+        '''
+            Standard normalizes each row of df, ignoring nans. This
+            is the vectorized version of:
+                df.apply(lambda row: (row-row.mean())/row.std(), axis=1)
+        '''
+        return pd.DataFrame(
+            Expr._zscore_rows(df.values), index=df.index, columns=df.columns
+        )
+
+    @staticmethod
+    def _zscore_rows(values):
+        '''
+            Returns a standard normalized (float64) copy of a 2D
+            array, normalizing each row and ignoring nans.
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nanmean(values, axis=1, keepdims=True)
+            std = np.nanstd(values, axis=1, ddof=1, keepdims=True)
+            return (values - mean) / std
+
     def plot_accession_histograms(self, bins=50, figsize=(16, 8)):
         '''
             Plot histogram of accession expression values.
         '''
-        raw = self._bcolz('raw_expr')
+        raw = self.expr(raw=True)
         qcd = self._expr
 
         for name, values in qcd.iteritems():
@@ -196,7 +239,58 @@ class Expr(Camoco):
         Internal Methods ------------------------------------------------------
     '''
 
-    def _update_values(self, df, transform_name, raw=False):
+    def _membership_mask(self, membership, ids):
+        '''
+            Tests a set of gene ids for membership. If membership is
+            a RefGen, the test is done in bulk against its gene
+            positions instead of one query per gene.
+
+            Parameters
+            ----------
+            membership : RefGen or container
+                The object to test the ids against
+            ids : iterable of str
+                gene ids
+
+            Returns
+            -------
+            A numpy array of bools, one for each id
+        '''
+        if isinstance(membership,RefGen):
+            positions = membership._gene_positions()
+            return np.array(
+                pd.Index([str(x).upper() for x in ids]).isin(positions.index),
+                dtype=bool
+            )
+        return np.array([x in membership for x in ids],dtype=bool)
+
+    def _gene_chroms(self, ids, missing=None):
+        '''
+            Looks up the chromosome for a set of gene ids (or aliases)
+            in self.refgen in bulk.
+
+            Parameters
+            ----------
+            ids : iterable of str
+                gene ids
+            missing : object (default: None)
+                The value to use for ids not in the RefGen
+
+            Returns
+            -------
+            A list of chromosomes, one for each id
+        '''
+        ids = [str(x) for x in ids]
+        resolved = self.refgen._resolve_ids(ids)
+        chroms = self.refgen._gene_positions().chrom.reindex(
+            [resolved.get(x) for x in ids]
+        )
+        return [
+            chrom if x in resolved else missing
+            for x,chrom in zip(ids,chroms.values)
+        ]
+
+    def _update_values(self, df, transform_name, raw=False, reset=True):
         '''
             updates the 'expression' table values with values from df.
             Requires a transformation name for the log.
@@ -213,6 +307,10 @@ class Expr(Camoco):
             raw : bool (default: False)
                 A flag to update the raw values. This also resets
                 the current values to what is in df.
+            reset : bool (default: True)
+                If False, the current values are kept when the raw
+                values are updated. Used when the current values are
+                updated separately (see COB.add_accessions).
 
             Returns
             -------
@@ -223,51 +321,266 @@ class Expr(Camoco):
             CamocoGeneNamesError
             CamocoAccessNamesError
         '''
-        # update the transformation log
-        if len(set(df.columns)) != len(df.columns):
+        # Keep full names in raw, but compress the
+        # names in the normed network
+        columns = self._clean_accession_names(df.columns, shorten=not raw)
+        # Names are checked once cleaned, cleaning can make them collide
+        if len(set(columns)) != len(columns):
             raise CamocoAccessionNameError('Accession names must be unique')
         if len(set(df.index)) != len(df.index):
             raise CamocoGeneNameError('Gene names must be unique.')
+        # update the transformation log
         self._transformation_log(transform_name)
         if raw == True:
             table = 'raw_expr'
             # If we are updating the raw table, remove the
             # normal table since it assumes it came from
             # the raw table.
-            self._reset(raw=False)
+            if reset:
+                self._reset(raw=False)
         else:
             table = 'expr'
-            # Keep full names in raw, but compress the
-            # names in the normed network
-            def shorten(x):
-                if len(x) > 100:
-                    return x[0:89] + '...' + x[-10:-1]
-                else:
-                    return x
-            df.columns = [shorten(x) for x in df.columns]
+        df.columns = columns
         # Sort the table by genes
-        df = df.sort_index()
-        # ensure that column names are alphanumeric
-        colP = re.compile('[^A-Za-z0-9_]')
-        begP = re.compile('^\d')
-        df.columns = [colP.sub('_', x).strip('_') for x in df.columns.values]
-        df.columns = [x if not begP.match(x[0]) else 'Exp_'+x for x in df.columns.values]
+        if not df.index.is_monotonic_increasing:
+            df = df.sort_index()
         # Also, make sure gene names are uppercase
-        idxP = re.compile('[^A-Za-z0-9_, ;:().]')
-        df.index = [idxP.sub('', str(x)).upper() for x in df.index.values]
+        df.index = self._clean_gene_names(df.index)
+        values = None
+        if self._expr_dtype == np.float32:
+            df,values = self._float32_frame(df, self._expr_values)
         try:
             self._bcolz(table, df=df)
-            self._expr = df
+            if table == 'expr':
+                self._save_expr_arrays(df)
+            else:
+                self._drop_raw_cache()
+                self._store_raw_metadata(df)
+            if table == 'expr' or reset:
+                self._expr = df
+                self._expr_values = values
         except Exception as e:
             self.log('Unable to update expression table values: {}', e)
             raise e
-        # Set the index
-        self._expr_index = defaultdict(
-            lambda: None,
-            {gene:index for index, gene in enumerate(self._expr.index)}
-        )
         return self
 
+    @staticmethod
+    def _clean_accession_names(accessions, shorten=False):
+        '''
+            Returns accession names the way they are stored: non
+            alphanumeric characters are replaced with underscores
+            and names starting with a digit get an 'Exp_' prefix.
+            If shorten is True, long names are compressed the way
+            they are in the normalized table.
+        '''
+        def short(x):
+            # Compressed names are 101 characters long, leave them
+            # be so already stored names are not compressed again
+            if len(x) > 101:
+                return x[0:89] + '...' + x[-10:-1]
+            else:
+                return x
+        colP = re.compile('[^A-Za-z0-9_]')
+        begP = re.compile('^\d')
+        names = [str(x) for x in accessions]
+        if shorten:
+            names = [short(x) for x in names]
+        names = [colP.sub('_', x).strip('_') for x in names]
+        return [x if not begP.match(x) else 'Exp_'+x for x in names]
+
+    @staticmethod
+    def _clean_gene_names(genes):
+        '''
+            Returns gene names the way they are stored: upper
+            case and stripped of unusual characters.
+        '''
+        idxP = re.compile('[^A-Za-z0-9_, ;:().]')
+        return [idxP.sub('', str(x)).upper() for x in genes]
+
+    @property
+    def _expr(self):
+        '''
+            The expression matrix as a DataFrame. The DataFrame is
+            only built on first access, on top of the memory mapped
+            matrix when it is available (see Expr._expr_arrays).
+        '''
+        if self._expr_df is None:
+            arrays = self._expr_arrays()
+            if arrays is not None:
+                values,genes,accessions = arrays
+                self._expr_df = pd.DataFrame(
+                    values, index=genes, columns=accessions, copy=False
+                )
+            else:
+                # Datasets built before the matrix was stored
+                # uncompressed, store it now for next time
+                df = self._bcolz('expr')
+                if df is None:
+                    df = pd.DataFrame()
+                elif len(df) > 0:
+                    self._save_expr_arrays(df)
+                self._expr_df = df
+        return self._expr_df
+
+    @_expr.setter
+    def _expr(self, df):
+        self._expr_df = df
+        self._expr_mmap = None
+
+    @property
+    def _expr_index(self):
+        '''
+            A pandas Index of the genes in the expression matrix,
+            in row order. Use get_indexer to map genes onto rows.
+        '''
+        if self._expr_df is None and self._expr_arrays() is not None:
+            return self._expr_arrays()[1]
+        return self._expr.index
+
+    def _expr_file(self, name):
+        '''
+            The path of one of the uncompressed expression arrays.
+        '''
+        return os.path.expanduser(
+            os.path.join(
+                cf.options.basedir,
+                'databases',
+                '{}.{}.{}.npy'.format(self.type, self.name, name)
+            )
+        )
+
+    def _save_expr_arrays(self, df):
+        '''
+            Stores the expression matrix as uncompressed arrays so
+            it can be memory mapped instead of decompressed when
+            the dataset is loaded.
+        '''
+        values = df.values
+        if values.dtype not in (np.float32, np.float64):
+            values = values.astype('float')
+        arrays = {
+            'expr' : np.ascontiguousarray(values),
+            'expr_genes' : np.array([str(x) for x in df.index], dtype=str),
+            'expr_accessions' : np.array([str(x) for x in df.columns], dtype=str)
+        }
+        for name,array in arrays.items():
+            # Write to a temporary file first so open memory
+            # maps of the old matrix are not clobbered
+            filename = self._expr_file(name)
+            with open(filename + '.tmp', 'wb') as OUT:
+                np.save(OUT, array)
+            os.replace(filename + '.tmp', filename)
+        self._expr_mmap = None
+
+    def _expr_arrays(self):
+        '''
+            Memory maps the stored expression matrix.
+
+            Returns
+            -------
+            A tuple containing the (read only) memory mapped values
+            and pandas Indexes of the genes and accessions, or None
+            if the matrix was not stored uncompressed.
+        '''
+        if self._expr_mmap is None:
+            try:
+                self._expr_mmap = (
+                    np.load(self._expr_file('expr'), mmap_mode='r'),
+                    pd.Index(np.load(self._expr_file('expr_genes'))),
+                    pd.Index(np.load(self._expr_file('expr_accessions')))
+                )
+            except IOError:
+                self._expr_mmap = False
+        return self._expr_mmap or None
+
+    def _expr_rows(self, ids):
+        '''
+            Reads the expression values for a set of genes from
+            the memory mapped matrix, without building the full
+            DataFrame.
+
+            Raises
+            ------
+            KeyError
+                If any of the genes are not in the matrix
+        '''
+        values,genes,accessions = self._expr_arrays()
+        rows = genes.get_indexer(ids)
+        if np.any(rows < 0):
+            raise KeyError('{} not in {}'.format(
+                [id for id,row in zip(ids,rows) if row < 0], self.name
+            ))
+        return pd.DataFrame(
+            np.asarray(values[rows]), index=genes[rows], columns=accessions
+        )
+
+    def _raw_expr(self):
+        '''
+            Returns the raw expression table. The table is only
+            decompressed the first time, after that it is served
+            from a cache bounded by RAW_CACHE_BYTES. Cached tables
+            are shared, so their values are read only: callers
+            that change the values need to copy them first.
+        '''
+        key = (self.type, self.name)
+        if key in _raw_cache:
+            _raw_cache.move_to_end(key)
+            return _raw_cache[key]
+        self.log('Extracting raw expression values')
+        df = self._bcolz('raw_expr')
+        if df is None:
+            return df
+        nbytes = df.values.nbytes
+        if nbytes <= RAW_CACHE_BYTES:
+            values = df.values
+            values.flags.writeable = False
+            df = pd.DataFrame(
+                values, index=df.index, columns=df.columns, copy=False
+            )
+            _raw_cache[key] = df
+            # drop the least recently used tables
+            while sum(x.values.nbytes for x in _raw_cache.values()) > RAW_CACHE_BYTES:
+                _raw_cache.popitem(last=False)
+        return df
+
+    def _drop_raw_cache(self):
+        '''
+            Removes this datasets raw table from the cache.
+        '''
+        _raw_cache.pop((self.type, self.name), None)
+
+    @staticmethod
+    def clear_raw_cache():
+        '''
+            Drops all cached raw expression tables, e.g. to free
+            memory. They will be read from disk the next time they
+            are needed.
+        '''
+        _raw_cache.clear()
+
+    def _store_raw_metadata(self, df):
+        '''
+            Stores the shape and the gene and accession names of the
+            raw expression table in globals, so they can be looked up
+            without reading the table.
+        '''
+        self._global('raw_num_genes', len(df.index))
+        self._global('raw_num_accessions', len(df.columns))
+        self._global('raw_genes', json.dumps([str(x) for x in df.index]))
+        self._global('raw_accessions', json.dumps([str(x) for x in df.columns]))
+
+    def _raw_metadata(self):
+        '''
+            Returns the gene and accession names of the raw
+            expression table (see Expr._store_raw_metadata).
+        '''
+        if self._global('raw_genes') is None:
+            self._store_raw_metadata(self.expr(raw=True))
+        return (
+            json.loads(self._global('raw_genes')),
+            json.loads(self._global('raw_accessions'))
+        )
+
     def _get_gene_index(self,gene):
         '''
             Retrieve the row index for a gene.
@@ -290,8 +603,8 @@ class Expr(Camoco):
             id = gene.id
         else:
             id = gene
-        index = self._expr_index[id]
-        if index == None:
+        index = self._expr_index.get_indexer([id])[0]
+        if index < 0:
             raise CamocoGeneAbsentError('{} not in {}'.format(id,self.name))
         return index
 
@@ -307,6 +620,53 @@ class Expr(Camoco):
             )
             self.log('Trans. Log: {}', self._global('transformation_log'))
 
+    @property
+    def _expr_dtype(self):
+        '''
+            The dtype of the working expression matrix. Datasets built
+            with float32=True (see Expr.from_DataFrame) keep it as a
+            single float32 array which is transformed in place.
+        '''
+        return np.dtype(self._global('expr_dtype') or 'float64')
+
+    @staticmethod
+    def _float32_frame(df, values=None):
+        '''
+            Returns a version of df backed by a single writeable, C
+            contiguous float32 array along with the array itself.
+            df is only copied if it is not already laid out that way.
+            values can be the array df was built from, which is reused
+            in case pandas only hands out read-only views of it.
+        '''
+        if values is None or values.shape != df.shape \
+            or not np.may_share_memory(values, df.values):
+            values = df.values
+        if values.dtype != np.float32 \
+            or not values.flags.c_contiguous \
+            or not values.flags.writeable:
+            values = np.array(values, dtype=np.float32, order='C')
+            df = pd.DataFrame(
+                values, index=df.index, columns=df.columns, copy=False
+            )
+        return df,values
+
+    def _working_values(self):
+        '''
+            Returns the float32 array backing self._expr. Changes
+            made to the array are reflected in self._expr, which
+            lets the build stages transform the matrix in place.
+        '''
+        if self._expr_values is None \
+            or not np.may_share_memory(self._expr_values, self._expr.values):
+            self._expr,self._expr_values = self._float32_frame(self._expr)
+        return self._expr_values
+
+    def _log_memory(self, stage):
+        '''
+            Logs the peak memory usage of the process after a stage.
+        '''
+        self.log('Peak memory after {}: {:.1f} MB', stage, peak_memory())
+
     def _reset(self, raw=False):
         '''
             resets the expression values to their raw
@@ -316,9 +676,14 @@ class Expr(Camoco):
             # kill the raw table too
             self.log('Resetting raw expression data')
             self._bcolz('raw_expr', df=pd.DataFrame())
+            self._drop_raw_cache()
+            self._store_raw_metadata(pd.DataFrame())
         self.log('Resetting expression data')
-        self._expr = self.expr(raw=True)
+        # QC and normalization change the working values in place
+        self._expr = self.expr(raw=True).copy()
+        self._expr_values = None
         self._bcolz('expr', df=self._expr)
+        self._save_expr_arrays(self._expr)
         self._transformation_log('reset')
 
 
@@ -364,8 +729,14 @@ class Expr(Camoco):
                     ('Could not guess correct normalization for {}'
                     ' pass in function through method argument.'
                     ).format(self.rawtype))
-            # apply the normalization to each column (accession)
-            df = df.apply(lambda col: method(col), axis=0)
+            if self._expr_dtype == np.float32 and isinstance(method, np.ufunc):
+                # transform the working matrix in place
+                values = self._working_values()
+                method(values, out=values)
+                df = self._expr
+            else:
+                # apply the normalization to each column (accession)
+                df = df.apply(lambda col: method(col), axis=0)
             # update values
             self._update_values(df, method.__name__)
 
@@ -417,6 +788,7 @@ class Expr(Camoco):
         self._global('qc_max_gene_missing_data', max_gene_missing_data)
         self._global('qc_min_single_sample_expr', min_single_sample_expr)
         self._global('qc_max_accession_missing_data', max_accession_missing_data)
+        self._global('qc_presence_absence', int(presence_absence))
         # Retrieve raw data as a data frame
         self.log('Raw Starting set: {} genes {} accessions'.format(
             len(df.index), len(df.columns))
@@ -430,7 +802,7 @@ class Expr(Camoco):
         if not membership:
             membership = self.refgen
         self._global('qc_membership', str(membership))
-        qc_gene['pass_membership'] = [x in membership for x in df.index]
+        qc_gene['pass_membership'] = self._membership_mask(membership,df.index)
         self.log(
             "Found out {} genes not in {}", 
             sum(qc_gene['pass_membership'] == False), 
@@ -440,23 +812,34 @@ class Expr(Camoco):
         # -----------------------------------------
         # Set minimum FPKM threshold
         self.log("Filtering expression values lower than {}", min_expr)
-        df_flt = df.copy()
+        # All of the masks are computed in a single pass over the
+        # values, the only copy made is the filtered matrix itself.
+        # The values keep their dtype so threshold comparisons
+        # are exactly the same as on the data frame.
+        if self._expr_dtype == np.float32:
+            # filter the working matrix in place
+            values = self._working_values()
+        else:
+            values = np.array(
+                df.values, dtype=np.result_type(df.values.dtype,np.float32)
+            )
         # Presence absence variable et
         if presence_absence == True:
            self.log("Allowing for presence absence variation")
            #find out which values equal 0
-           zero_index = df_flt == 0
+           zero_index = values == 0
         # Filter the min expression genes
-        df_flt[df < min_expr] = np.nan
+        with np.errstate(invalid='ignore'):
+            values[values < min_expr] = np.nan
         if presence_absence == True:
             #change out original 0's index to a small value
-            df_flt[zero_index] = 0.001
-        df = df_flt
+            values[zero_index] = 0.001
+        missing = np.isnan(values)
         # -----------------------------------------
         # Gene Missing Data Test
-        qc_gene['pass_missing_data'] = df.apply(
-            lambda x : ((sum(np.isnan(x))) < len(x)*max_gene_missing_data),
-            axis=1
+        num_accessions = values.shape[1]
+        qc_gene['pass_missing_data'] = (
+            missing.sum(axis=1) < num_accessions*max_gene_missing_data
         )
         self.log(
             "Found {} genes with > {} missing data",
@@ -467,49 +850,57 @@ class Expr(Camoco):
         # Gene Min Expression Test
         # filter out genes which do not meet a minimum expr
         # threshold in at least one sample
-        qc_gene['pass_min_expression'] = df.apply(
-            lambda x: any(x >= min_single_sample_expr),
-            axis=1 # 1 is column
-        )
+        with np.errstate(invalid='ignore'):
+            qc_gene['pass_min_expression'] = (
+                values >= min_single_sample_expr
+            ).any(axis=1)
         self.log(
             ("Found {} genes which "
             "do not have one sample above {}"), 
             sum(qc_gene['pass_min_expression'] == False),
             min_single_sample_expr
         )
-        qc_gene['PASS_ALL'] = qc_gene.apply(
-            lambda row: np.all(row), axis=1
-        )
-        df = df.loc[qc_gene['PASS_ALL'], :]
+        qc_gene['PASS_ALL'] = qc_gene.values.all(axis=1)
+        gene_mask = qc_gene['PASS_ALL'].values
         # -----------------------------------------
         # Filter out ACCESSIONS with too much missing data
-        qc_accession['pass_missing_data'] = df.apply(
-            lambda col : (
-                ((sum(np.isnan(col)) / len(col)) <= max_accession_missing_data)
-            ),
-            axis=0 # 0 is columns
-        )
+        num_genes = gene_mask.sum()
+        with np.errstate(invalid='ignore',divide='ignore'):
+            qc_accession['pass_missing_data'] = (
+                (missing[gene_mask].sum(axis=0) / num_genes) 
+                <= max_accession_missing_data
+            )
         self.log(
             "Found {} accessions with > {} missing data", 
             sum(qc_accession['pass_missing_data'] == False),
             max_accession_missing_data
         )
         # Update the total QC passing column
-        qc_accession['PASS_ALL'] = qc_accession.apply(
-            lambda row: np.all(row), axis=1
+        qc_accession['PASS_ALL'] = qc_accession.values.all(axis=1)
+        accession_mask = qc_accession['PASS_ALL'].values
+        del missing
+        values = np.ascontiguousarray(values[np.ix_(gene_mask,accession_mask)])
+        df = pd.DataFrame(
+            values,
+            index=df.index[gene_mask],
+            columns=df.columns[accession_mask],
+            copy=False
         )
-        df = df.loc[:, qc_accession['PASS_ALL']]
+        if self._expr_dtype == np.float32:
+            # hand the filtered array over as the new working matrix
+            self._expr_values = values
+        del values
         # Update the database
         self._bcolz('qc_accession', df=qc_accession)
         self._bcolz('qc_gene', df=qc_gene)
         # Report your findings
-        self.log('Genes passing QC:\n{}', str(qc_gene.apply(sum, axis=0)))
-        self.log('Accessions passing QC:\n{}', str(qc_accession.apply(sum, axis=0)))
+        self.log('Genes passing QC:\n{}', str(qc_gene.sum(axis=0)))
+        self.log('Accessions passing QC:\n{}', str(qc_accession.sum(axis=0)))
         # Also report a breakdown by chromosome
-        qc_gene = qc_gene[qc_gene['pass_membership']]
-        qc_gene['chrom'] = [self.refgen[x].chrom for x in qc_gene.index]
+        qc_gene = qc_gene[qc_gene['pass_membership']].copy()
+        qc_gene['chrom'] = self._gene_chroms(qc_gene.index)
         self.log('Genes passing QC by chromosome:\n{}',
-            str(qc_gene.groupby('chrom').aggregate(sum, axis=0))
+            str(qc_gene.groupby('chrom').sum())
         )
         # update the df to reflect only genes/accession passing QC
         self.log('Kept: {} genes {} accessions'.format(len(df.index), len(df.columns)))
@@ -521,25 +912,113 @@ class Expr(Camoco):
 
     @staticmethod
     def inplace_nansort(col):
-        # mask invalid data
-        masked_col = np.ma.masked_invalid(col)
-        masked_sorted = np.sort(col[~masked_col.mask].data)
-        # get ranked values
-        col_sorted = np.copy(col)
-        non_nan = 0
-        for i, x in enumerate(~masked_col.mask):
-            if x == True:
-                col_sorted[i] = masked_sorted[non_nan]
-                non_nan += 1
-            else:
-                col_sorted[i] = np.nan
+        '''
+            Sorts the non-nan values of col, leaving the nans
+            where they were.
+        '''
+        col_sorted = np.array(col, dtype=float)
+        not_nan = ~np.isnan(col_sorted)
+        col_sorted[not_nan] = np.sort(col_sorted[not_nan])
         return col_sorted
 
-    def _quantile(self):
+    @staticmethod
+    def _quantile_normalize(values, chunk_size=None):
+        '''
+            Quantile normalizes the columns of a matrix. Nans are
+            ignored: each column is ranked (ties broken by order of
+            appearance) and its sorted non-nan values are laid out
+            over the non-nan rows. The row-wise means of that layout
+            are then looked up by each values percentile rank.
+
+            Parameters
+            ----------
+            values : 2D numpy array
+                genes (rows) by accessions (columns)
+            chunk_size : int (default: None)
+                If not None, the columns are processed this many at a
+                time which bounds the size of the temporary arrays.
+                Row means are accumulated across chunks so they can
+                differ from the unchunked result in the last bits.
+
+            Returns
+            -------
+            A tuple containing the normalized values (a new float64
+            array with nans in the same places as values) and an array
+            with the size of the largest set of rank ties in each column.
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        num_rows,num_cols = values.shape
+        if chunk_size is None:
+            chunk_size = max(num_cols,1)
+        # percentile ranks are staged in the output array and
+        # replaced with the row means in a second pass
+        quantiled = np.empty_like(values)
+        rank_ties = np.zeros(num_cols, dtype=np.int64)
+        row_sums = np.zeros(num_rows)
+        row_counts = np.zeros(num_rows, dtype=np.int64)
+        positions = np.arange(1, num_rows+1)
+        for start in range(0, num_cols, chunk_size):
+            cols = slice(start, start+chunk_size)
+            chunk = values[:,cols]
+            not_nan = ~np.isnan(chunk)
+            num_valid = not_nan.sum(axis=0)
+            # a stable sort gives the same ranks as method='first',
+            # nans are sorted to the end
+            order = np.argsort(chunk, axis=0, kind='stable')
+            ranks = np.empty(chunk.shape)
+            np.put_along_axis(
+                ranks, order, 
+                np.broadcast_to(positions[:,None], chunk.shape).astype(float), 
+                axis=0
+            )
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ranks /= num_valid
+            ranks[~not_nan] = np.nan
+            quantiled[:,cols] = ranks
+            del ranks
+            chunk_sorted = np.take_along_axis(chunk, order, axis=0)
+            del order
+            # largest run of equal values in each sorted column
+            if num_rows > 0:
+                breaks = np.where(
+                    chunk_sorted[1:] == chunk_sorted[:-1], 0, positions[:-1,None]
+                )
+                run_start = np.maximum.accumulate(breaks, axis=0)
+                run_lengths = positions[:-1,None] - run_start + 1
+                rank_ties[cols] = np.maximum(run_lengths.max(axis=0, initial=1), 1)
+                del breaks, run_start, run_lengths
+            # lay the sorted values back over the non-nan rows
+            valid_index = np.maximum(np.cumsum(not_nan, axis=0) - 1, 0)
+            expr_sort = np.ascontiguousarray(
+                np.take_along_axis(chunk_sorted, valid_index, axis=0)
+            )
+            del chunk_sorted, valid_index
+            expr_sort[~not_nan] = 0
+            row_sums += expr_sort.sum(axis=1)
+            row_counts += not_nan.sum(axis=1)
+            del expr_sort
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rank_average = row_sums / row_counts
+        assert not np.any(np.isnan(rank_average))
+        # map percentile ranks onto the ranked averages
+        for start in range(0, num_cols, chunk_size):
+            chunk = quantiled[:,start:start+chunk_size]
+            not_nan = ~np.isnan(chunk)
+            index = (chunk[not_nan]*num_rows).astype(int) - 1
+            chunk[not_nan] = rank_average[index]
+        return quantiled, rank_ties
+
+    def _quantile(self, chunk_size=None):
         '''
             Perform quantile normalization across each accession.
             Each accessions gene expression values are replaced with
             ranked gene averages.
+
+            Parameters
+            ----------
+            chunk_size : int (default: None)
+                Process this many accessions at a time to limit memory
+                usage. See Expr._quantile_normalize.
         '''
         self.log('------------ Quantile ')
         if 'quantile' in self._transformation_log():
@@ -547,41 +1026,19 @@ class Expr(Camoco):
         # Retrieve current expression DataFrame
         expr = self.expr()
         self.log('Ranking data')
-        for accession_name,values in expr.iteritems():
-            rank_ties = max(Counter(values).values())
-            if rank_ties > len(values) * 0.20:
+        values, rank_ties = self._quantile_normalize(
+            expr.values, chunk_size=chunk_size
+        )
+        num_genes = len(expr.index)
+        for accession_name,ties in zip(expr.columns,rank_ties):
+            if ties > num_genes * 0.20:
                 raise ValueError(
-                    f'{self.name}:{accession_name} has {rank_ties} '
-                    f'({rank_times/len(values)}%) rank ties'
+                    f'{self.name}:{accession_name} has {ties} '
+                    f'({ties/num_genes}%) rank ties'
                 )
-        # assign ranks by accession (column)
-        expr_ranks = expr.rank(axis=0, method='first', na_option='keep')
-        assert np.all(np.isnan(expr) == np.isnan(expr_ranks))
-        # normalize rank to be percentage
-        expr_ranks = expr_ranks.apply(
-            lambda col: col/np.nanmax(col.values),
-            axis=0
-        )
-        # we need to know the number of non-nans so we can correct for their ranks later
-        self.log('Sorting ranked data')
-        # Sort values by accession/column, lowest to highest
-        expr_sort = expr.apply(lambda col: self.inplace_nansort(col), axis=0)
-        # make sure the nans weren't included in the sort or the rank
-        assert np.all(np.isnan(expr) == np.isnan(expr_ranks))
-        assert np.all(np.isnan(expr) == np.isnan(expr_sort))
-        # calculate ranked averages
-        self.log('Calculating averages')
-        rank_average = expr_sort.apply(np.nanmean, axis=1)
-        # we need to apply the percentages to the lenght of the
-        rankmax = len(rank_average)
-        self.log('Range of normalized values:{}..{} (n = {})'.format(
-            min(rank_average), max(rank_average), len(rank_average))
-        )
-        self.log('Asserting that no Genes are nan...')
-        assert sum(np.isnan(rank_average)) == 0
-        self.log('Applying non-floating normalization')
-        quan_expr = expr_ranks.applymap(
-            lambda x : rank_average[int(x*rankmax)-1] if not np.isnan(x) else np.nan
+        quan_expr = pd.DataFrame(values, index=expr.index, columns=expr.columns)
+        self.log('Range of normalized values:{}..{}'.format(
+            np.nanmin(values), np.nanmax(values))
         )
         self.log('Updating values')
         assert np.all(np.isnan(expr) == np.isnan(quan_expr))
@@ -671,14 +1128,18 @@ class Expr(Camoco):
         self = super().create(name, description,type=type)
         # Create appropriate bcolz tables
         self._bcolz('expr', df=pd.DataFrame())
+        self._save_expr_arrays(pd.DataFrame())
         self._bcolz('raw_expr', df=pd.DataFrame())
+        self._drop_raw_cache()
+        self._store_raw_metadata(pd.DataFrame())
         # Delete existing datasets
         self._set_refgen(refgen, filter=False)
         return self
 
     @classmethod
     def from_table(cls, filename, name, description, refgen, rawtype=None,
-            sep='\t', normalize=True, quality_control=True, **kwargs):
+            sep='\t', normalize=True, quality_control=True, chunksize=5000,
+            **kwargs):
         '''
             Create a Expr instance from a file containing raw expression data.
             For instance FPKM or results from a microarray experiment. This is
@@ -714,6 +1175,9 @@ class Expr(Camoco):
                 A flag which specifies whether or not to perform QC. Parameters
                 for QC are passed in using the **kwargs arguments. For default
                 parameters and options see Expr._quality_control.
+            chunksize : int (Default: 5000)
+                The table is streamed into memory this many rows at a
+                time, see Tools.read_expr_table.
             **kwargs : key value pairs
                 additional parameters passed to subsequent methods. (see
                 Expr.from_DataFrame)
@@ -723,16 +1187,20 @@ class Expr(Camoco):
             An Expr instance
 
         '''
-        tbl = pd.read_table(filename, sep=sep)
+        tbl = read_expr_table(
+            filename, sep=sep, chunksize=chunksize,
+            dtype='float32' if kwargs.get('float32',False) else 'float64'
+        )
         return cls.from_DataFrame(
                 tbl, name, description, refgen, 
-                rawtype=rawtype, **kwargs
+                rawtype=rawtype, normalize=normalize,
+                quality_control=quality_control, **kwargs
             )
 
     @classmethod
     def from_DataFrame(cls, df, name, description, refgen, rawtype=None,
             normalize=True, norm_method=None, quantile=False, 
-            quality_control=True, **kwargs
+            quality_control=True, float32=False, **kwargs
         ):
         ''' 
             Creates an Expr instance from a pandas DataFrame. Expects that the
@@ -772,10 +1240,18 @@ class Expr(Camoco):
             quantile : bool (Default : False)
                 Specifies whether or not to perform quantile normalization on
                 import.
+                The number of accessions normalized at a time can be
+                limited by passing quantile_chunk_size in **kwargs.
             quality_control : bool (Default: True)
                 A flag which specifies whether or not to perform QC. Parameters
                 for QC are passed in using the **kwargs arguments. For default
                 parameters and options see Expr._quality_control.
+            float32 : bool (Default: False)
+                Keep the expression matrix as a single C-contiguous float32
+                array which QC and normalization transform in place and which
+                is passed to the coexpression kernel without conversion.
+                This halves the memory needed for large datasets at the cost
+                of single precision values.
             **kwargs : key value pairs
                 additional parameters passed to subsequent methods.
                 See arguments for Expr._normalize(), Expr._quality_control()
@@ -791,23 +1267,35 @@ class Expr(Camoco):
         if rawtype is None:
             raise TypeError("raw_type must be one of ['RNASEQ', 'MICROARRAY']")
         self._global('rawtype', rawtype)
+        if float32:
+            self._global('expr_dtype', 'float32')
+            # the only copy of the input, everything
+            # after this is done in place
+            df = pd.DataFrame(
+                np.array(df.values, dtype=np.float32, order='C'),
+                index=df.index, columns=df.columns, copy=False
+            )
         # put raw values into the database
         self.log('Importing Raw Expression Values')
         self._update_values(df, 'Raw'+rawtype, raw=True)
+        self._log_memory('import')
         if quality_control:
             self.log('Performing Quality Control on genes')
             self._quality_control(**kwargs)
             assert self.anynancol() == False
+            self._log_memory('quality control')
         else:
             self.log('Skipping Quality Control!')
         if normalize:
             self.log('Performing Raw Expression Normalization')
             self._normalize(**kwargs)
             assert self.anynancol() == False
+            self._log_memory('normalization')
         if quantile:
             self.log('Performing Quantile Gene Normalization')
-            self._quantile()
+            self._quantile(chunk_size=kwargs.get('quantile_chunk_size',None))
             assert self.anynancol() == False
+            self._log_memory('quantile normalization')
         self.log('Filtering refgen: {}', refgen.name)
         self._set_refgen(refgen, filter=True)
         return self
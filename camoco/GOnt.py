@@ -5,7 +5,7 @@ from .Term import Term
 from .Camoco import Camoco
 from .RefGen import RefGen
 from .Locus import Locus
-from .Tools import log,rawFile
+from .Tools import log,rawFile,chunks
 
 from collections import defaultdict,Counter
 from itertools import chain
@@ -15,6 +15,7 @@ from matplotlib import pylab as plt
 import pandas as pd
 import apsw as lite
 import numpy as np
+from scipy import sparse
 import networkx as nx
 import re
 import json
@@ -99,7 +100,15 @@ class GOnt(Ontology):
         Ontology extension for GO
     '''
     def __init__(self, name, type='GOnt'):
+        # is_a closure kept in memory, see _closure
+        self._closure_cache = None
         super().__init__(name, type=type)
+        # Datasets built before the closure table existed
+        if self._has_table('rels') and not self._has_table('rels_closure'):
+            self._build_closure()
+        # or before annotations were flagged as direct or inherited
+        if self._has_table('term_loci') and not self._has_column('term_loci','inherited'):
+            self._create_tables()
 
     def __getitem__(self, id):
         if isinstance(id,str):
@@ -152,11 +161,54 @@ class GOnt(Ontology):
             is_a=is_a, loci=term_loci, **term_attrs
         )
 
+    def _bulk_terms(self, ids):
+        '''
+            Builds the GOTerms for a list of term ids using
+            batched queries, see Ontology._bulk_terms.
+        '''
+        cur = self.db.cursor()
+        info = {}
+        term_loci = defaultdict(list)
+        term_attrs = defaultdict(dict)
+        is_a = defaultdict(set)
+        alts = defaultdict(set)
+        for chunk in chunks(ids):
+            args = ','.join('?'*len(chunk))
+            for id,desc,name in cur.execute(
+                'SELECT id,desc,name FROM terms WHERE id IN ({})'.format(args),chunk):
+                info[id] = (desc,name)
+            for term,id in cur.execute(
+                'SELECT term,id FROM term_loci WHERE term IN ({})'.format(args),chunk):
+                term_loci[term].append(id)
+            for term,key,val in cur.execute(
+                'SELECT term,key,val FROM term_attrs WHERE term IN ({})'.format(args),chunk):
+                term_attrs[term][key] = val
+            for parent,child in cur.execute(
+                'SELECT parent,child FROM rels WHERE child IN ({})'.format(args),chunk):
+                is_a[child].add(parent)
+            for alt,main in cur.execute(
+                'SELECT alt,main FROM alts WHERE main IN ({})'.format(args),chunk):
+                alts[main].add(alt)
+        genes = {
+            gene_id:gene for gene_id,gene in zip(
+                *self._bulk_loci(set(chain.from_iterable(term_loci.values())))
+            )
+        }
+        return [
+            GOTerm(
+                id, name=info[id][1], desc=info[id][0], alt_id=alts[id],
+                is_a=is_a[id], loci=[genes[x] for x in term_loci[id] if x in genes],
+                **term_attrs[id]
+            ) for id in ids if id in info
+        ]
+
     def add_term(self, term, cursor=None, overwrite=False):
         ''' 
             Add a single term to the ontology 
         '''
         self.get_term.cache_clear()
+        self._incidence_cache = None
+        self._clear_closure()
         if overwrite:
             self.del_term(term.id)
         if not cursor:
@@ -175,6 +227,7 @@ class GOnt(Ontology):
                 'INSERT OR REPLACE INTO term_loci (term, id) VALUES (?, ?)', 
                 [(term.id, locus.id) for locus in term.loci]
             )
+            self._update_term_size(term.id,cur)
         # Add the term attrs
         if term.attrs:
             for key,val in term.attrs.items():
@@ -206,41 +259,438 @@ class GOnt(Ontology):
             id = term.id
         else:
             id = term
+        self._incidence_cache = None
+        self.get_term.cache_clear()
+        self._clear_closure()
         main_id = cur.execute('SELECT main FROM alts WHERE alt = ?', (id, )).fetchone()
         if main_id:
-            id = main_id
-        else:
-            id = term.id
+            (id,) = main_id
         cur.execute('''
             DELETE FROM terms WHERE id = ?;
             DELETE FROM term_loci WHERE term = ?;
+            DELETE FROM term_sizes WHERE term = ?;
+            DELETE FROM term_attrs WHERE term = ?;
             DELETE FROM rels WHERE child = ?;
             DELETE FROM rels WHERE parent = ?;
             DELETE FROM alts WHERE main = ?;
-            ''', (id, id, id, id, id))
+            ''', (id, id, id, id, id, id, id))
         if not cursor:
             cur.execute('END TRANSACTION')
 
     def parents(self, term):
         '''
             Return an iterable containing the parents of a term.
-            Parents are determined via the is_a property of the term.
+            Parents are determined via the is_a property of the term,
+            all ancestors are returned (each one once), see ancestors.
+
+            Parameters
+            ----------
+            term : GOTerm or str
+
+            Returns
+            -------
+            A list containing the parent GOTerms
+        '''
+        return self._bulk_terms(self.ancestors(term))
+
+    def ancestors(self, term):
+        '''
+            Returns the ids of all the ancestors of a term (following
+            is_a relationships), read from the precomputed closure.
+
+            Parameters
+            ----------
+            term : GOTerm or str
+                The term or its id (alt ids are resolved)
+
+            Returns
+            -------
+            A list of term ids
+        '''
+        matrix,_,term_ids = self._closure()
+        row = self._closure_index(term)
+        return term_ids[
+            matrix.indices[matrix.indptr[row]:matrix.indptr[row+1]]
+        ].tolist()
+
+    def descendants(self, term):
+        '''
+            Returns the ids of all the descendants of a term (all the
+            terms that have the term as an ancestor).
+
+            Parameters
+            ----------
+            term : GOTerm or str
+                The term or its id (alt ids are resolved)
+
+            Returns
+            -------
+            A list of term ids
+        '''
+        _,by_ancestor,term_ids = self._closure()
+        col = self._closure_index(term)
+        return term_ids[
+            by_ancestor.indices[by_ancestor.indptr[col]:by_ancestor.indptr[col+1]]
+        ].tolist()
+
+    def depth(self, term):
+        '''
+            Returns the depth of a term: the length of the longest
+            is_a path from the term up to a root term (roots have
+            a depth of 0).
+        '''
+        matrix,_,_ = self._closure()
+        row = self._closure_index(term)
+        distances = matrix.data[matrix.indptr[row]:matrix.indptr[row+1]]
+        if len(distances) == 0:
+            return 0
+        return int(distances.max())
+
+    def common_ancestors(self, terms):
+        '''
+            Returns the ids of the terms that are an ancestor of
+            every term passed in. A term counts as its own ancestor
+            here, so if one of the terms is an ancestor of all the
+            others it is returned as well.
+
+            Parameters
+            ----------
+            terms : iterable of GOTerms or str
+
+            Returns
+            -------
+            A list of term ids
+        '''
+        matrix,_,term_ids = self._closure()
+        rows = [self._closure_index(term) for term in terms]
+        if len(rows) == 0:
+            return []
+        ancestors = (matrix[rows] != 0).astype(np.int32)
+        ancestors = ancestors + sparse.csr_matrix(
+            (np.ones(len(rows),dtype=np.int32),(np.arange(len(rows)),rows)),
+            shape=ancestors.shape
+        )
+        counts = np.asarray((ancestors != 0).sum(axis=0)).ravel()
+        return term_ids[counts == len(rows)].tolist()
+
+    def information_content(self):
+        '''
+            Returns the information content of each term, calculated
+            from the term sizes: IC = -log(size/num_loci), where size is
+            the number of loci annotated to the term (including the ones
+            inherited from child terms) and num_loci is the number of
+            distinct loci in the ontology. Terms without any loci have
+            an undefined (NaN) information content.
+
+            Returns
+            -------
+            A pandas Series of IC values indexed by term id (in the
+            same order as the closure)
+        '''
+        _,_,term_ids = self._closure()
+        sizes = pd.Series(dict(
+            self.db.cursor().execute('SELECT term,size FROM term_sizes')
+        ),dtype=float).reindex(term_ids)
+        with np.errstate(divide='ignore'):
+            ic = np.log(max(self.num_distinct_loci(),1)/sizes)
+        ic[~(sizes > 0)] = np.nan
+        return ic
+
+    def term_similarity(self, terms_a, terms_b=None, method='resnik'):
+        '''
+            Calculates the semantic similarity between every pair of
+            terms in two sets of terms.
+
+            Parameters
+            ----------
+            terms_a : iterable of GOTerms or str
+                The first set of terms
+            terms_b : iterable of GOTerms or str (default: None)
+                The second set of terms, if None then terms_a is
+                compared with itself
+            method : str (default: resnik)
+                One of:
+                resnik: the IC of the most informative common
+                    ancestor (a term is its own ancestor here)
+                lin: 2*resnik / (IC(a) + IC(b))
+                jiang: 1 / (1 + IC(a) + IC(b) - 2*resnik), i.e. the
+                    Jiang-Conrath distance turned into a similarity
+
+            Returns
+            -------
+            A DataFrame of similarities, terms_a by terms_b
+        '''
+        if method not in ('resnik','lin','jiang'):
+            raise ValueError('method must be one of resnik, lin or jiang')
+        terms_a = [x if isinstance(x,str) else x.id for x in terms_a]
+        terms_b = terms_a if terms_b is None else \
+            [x if isinstance(x,str) else x.id for x in terms_b]
+        rows_a = np.array([self._closure_index(x) for x in terms_a],dtype=int)
+        rows_b = np.array([self._closure_index(x) for x in terms_b],dtype=int)
+        similarity = self._term_similarity(rows_a,rows_b,method)
+        return pd.DataFrame(similarity,index=terms_a,columns=terms_b)
+
+    def _term_similarity(self, rows_a, rows_b, method='resnik'):
+        '''
+            Calculates the similarity matrix between terms given as
+            positions in the closure, see term_similarity.
+        '''
+        matrix,_,term_ids = self._closure()
+        ic = self.information_content().values
+        # Each term is its own ancestor here
+        ancestors = (matrix != 0).astype(np.int8) + \
+            sparse.identity(len(term_ids),dtype=np.int8,format='csr')
+        ancestors_a = ancestors[rows_a].tocsc()
+        ancestors_b = ancestors[rows_b].tocsc()
+        resnik = np.zeros((len(rows_a),len(rows_b)),dtype=np.float64)
+        # Ancestors shared by at least one term in each set, visited
+        # from the least to the most informative so the most
+        # informative common ancestor is the last one written
+        shared = np.flatnonzero(
+            (np.diff(ancestors_a.indptr) > 0) & (np.diff(ancestors_b.indptr) > 0)
+            & np.isfinite(ic)
+        )
+        for k in shared[np.argsort(ic[shared],kind='mergesort')]:
+            resnik[np.ix_(
+                ancestors_a.indices[ancestors_a.indptr[k]:ancestors_a.indptr[k+1]],
+                ancestors_b.indices[ancestors_b.indptr[k]:ancestors_b.indptr[k+1]]
+            )] = ic[k]
+        if method == 'resnik':
+            return resnik
+        ic_a = np.nan_to_num(ic[rows_a])[:,None]
+        ic_b = np.nan_to_num(ic[rows_b])[None,:]
+        with np.errstate(divide='ignore',invalid='ignore'):
+            if method == 'lin':
+                similarity = 2*resnik/(ic_a + ic_b)
+                similarity[(ic_a + ic_b) == 0] = 0
+            else:
+                similarity = 1/(1 + ic_a + ic_b - 2*resnik)
+        return similarity
+
+    def gene_similarity(self, genes_a, genes_b=None, method='resnik',
+                        combine='bma', inherited=False):
+        '''
+            Calculates the semantic similarity between every pair of
+            genes in two sets of genes, based on the terms the genes
+            are annotated to.
 
             Parameters
             ----------
-            term : GOTerm
+            genes_a : iterable of Loci or str
+                The first set of genes
+            genes_b : iterable of Loci or str (default: None)
+                The second set of genes, if None then genes_a is
+                compared with itself
+            method : str (default: resnik)
+                The term similarity, see term_similarity
+            combine : str (default: bma)
+                How term similarities are combined into a gene
+                similarity, either 'max' (the best matching pair of
+                terms) or 'bma' (best match average: the average of
+                the best match of each term of one gene among the
+                terms of the other, averaged over both directions)
+            inherited : bool (default: False)
+                Also use the terms a gene was propagated to. By default
+                only the terms the gene is directly annotated to are
+                used.
 
             Returns
             -------
-            An iterable containing the parents
+            A DataFrame of similarities, genes_a by genes_b. Genes
+            without any annotations have NaN similarities.
+        '''
+        if combine not in ('max','bma'):
+            raise ValueError('combine must be either max or bma')
+        genes_a = [x if isinstance(x,str) else x.id for x in genes_a]
+        same = genes_b is None
+        genes_b = genes_a if same else \
+            [x if isinstance(x,str) else x.id for x in genes_b]
+        # gene by term incidence matrices
+        _,_,term_ids = self._closure()
+        annotations = self._gene_annotations(set(genes_a) | set(genes_b),inherited)
+        def incidence(genes):
+            genes = pd.Index(genes)
+            rows = genes.get_indexer(annotations.id)
+            found = rows >= 0
+            cols = term_ids.get_indexer(annotations.term[found])
+            incidence = sparse.csr_matrix(
+                (np.ones(found.sum()),(rows[found],cols)),
+                shape=(len(genes),len(term_ids))
+            )
+            incidence.sum_duplicates()
+            incidence.data[:] = 1
+            return incidence
+        incidence_a = incidence(genes_a)
+        incidence_b = incidence_a if same else incidence(genes_b)
+        # Only the terms the genes are annotated to are compared
+        terms_a = np.flatnonzero(np.diff(incidence_a.tocsc().indptr))
+        terms_b = np.flatnonzero(np.diff(incidence_b.tocsc().indptr))
+        incidence_a = incidence_a[:,terms_a].tocsc()
+        incidence_b = incidence_b[:,terms_b].tocsc()
+        similarity = self._term_similarity(terms_a,terms_b,method)
+        # The best match among the terms of each gene in b, for each term in a
+        best_b = self._group_max(similarity.T,incidence_b).T
+        if combine == 'bma':
+            size_a = np.asarray(incidence_a.sum(axis=1)).ravel()
+            with np.errstate(divide='ignore',invalid='ignore'):
+                forward = (incidence_a @ best_b) / size_a[:,None]
+            if same:
+                backward = forward.T
+            else:
+                best_a = self._group_max(similarity,incidence_a).T
+                size_b = np.asarray(incidence_b.sum(axis=1)).ravel()
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    backward = ((incidence_b @ best_a) / size_b[:,None]).T
+            gene_similarity = (forward + backward)/2
+        else:
+            gene_similarity = self._group_max(best_b,incidence_a)
+        return pd.DataFrame(gene_similarity,index=genes_a,columns=genes_b)
 
-            NOTE: note guaranteed to be in order NOR guaranteed 
-            to not contain duplicates
+    @staticmethod
+    def _group_max(values, incidence):
+        '''
+            For each row of a sparse group by item incidence matrix,
+            returns the max over that group's items of a dense items
+            by n matrix (NaN for empty groups).
+        '''
+        incidence = incidence.tocsr()
+        result = np.full((incidence.shape[0],values.shape[1]),np.nan)
+        # reduceat can not handle empty groups
+        nonempty = np.flatnonzero(np.diff(incidence.indptr))
+        if len(nonempty) > 0:
+            result[nonempty] = np.maximum.reduceat(
+                values[incidence.indices],incidence.indptr[nonempty],axis=0
+            )
+        return result
+
+    def _gene_annotations(self, gene_ids, inherited=False):
+        '''
+            Returns a DataFrame of (term,id) annotations for genes
+        '''
+        cur = self.db.cursor()
+        rows = []
+        for chunk in chunks(gene_ids):
+            query = 'SELECT term,id FROM term_loci WHERE id IN ({})'.format(
+                ','.join('?'*len(chunk))
+            )
+            if not inherited:
+                query += ' AND inherited = 0'
+            rows.extend(cur.execute(query,chunk))
+        return pd.DataFrame(rows,columns=['term','id'])
+
+    def _closure_index(self, term):
+        '''
+            Returns the position of a term in the closure
         '''
-        for parent_term in term.is_a:
-            yield self[parent_term]
-            for grand_parent in self.parents(self[parent_term]):
-                yield grand_parent
+        _,_,term_ids = self._closure()
+        if not isinstance(term,str):
+            term = term.id
+        if term not in term_ids:
+            main_id = self.db.cursor().execute(
+                'SELECT main FROM alts WHERE alt = ?', (term,)
+            ).fetchone()
+            if main_id is None:
+                raise KeyError('{} is not in the database.'.format(term))
+            (term,) = main_id
+        return term_ids.get_loc(term)
+
+    def _closure(self):
+        '''
+            Returns the is_a transitive closure as sparse matrices.
+            The closure is read from the rels_closure table (it is
+            rebuilt first if the relationships have changed) and
+            cached.
+
+            Returns
+            -------
+            A tuple (matrix,by_ancestor,term_ids). matrix is a CSR
+            matrix with a row for each term and a column for each of
+            its ancestors holding the length of the longest path
+            between them. by_ancestor is the same matrix in CSC form
+            (columns are fast) and term_ids are the term ids in
+            row/column order.
+        '''
+        if self._closure_cache is None:
+            cur = self.db.cursor()
+            num_closure = cur.execute('SELECT COUNT(*) FROM rels_closure').fetchone()[0]
+            num_rels = cur.execute('SELECT COUNT(*) FROM rels').fetchone()[0]
+            if num_closure == 0 and num_rels > 0:
+                self._build_closure()
+            term_ids = pd.Index([x for x, in cur.execute('SELECT id FROM terms ORDER BY id')])
+            closure = cur.execute(
+                'SELECT child,ancestor,distance FROM rels_closure'
+            ).fetchall()
+            if len(closure) > 0:
+                child,ancestor,distance = zip(*closure)
+            else:
+                child,ancestor,distance = [],[],[]
+            matrix = sparse.csr_matrix(
+                (np.array(distance,dtype=np.int16),
+                 (term_ids.get_indexer(child),term_ids.get_indexer(ancestor))),
+                shape=(len(term_ids),len(term_ids))
+            )
+            matrix.sort_indices()
+            self._closure_cache = (matrix,matrix.tocsc(),term_ids)
+        return self._closure_cache
+
+    def _build_closure(self):
+        '''
+            Calculates the transitive closure of the is_a relationships
+            and stores it in the rels_closure table. The closure is
+            found by repeatedly multiplying the sparse child by parent
+            matrix: paths of length k+1 are paths of length k followed
+            by one more step, so the loop runs as many times as the
+            longest path in the DAG. The distance stored for each pair
+            is the length of the longest path between them.
+        '''
+        self.log('Building the is_a closure')
+        self._create_closure_table()
+        cur = self.db.cursor()
+        term_ids = pd.Index([x for x, in cur.execute('SELECT id FROM terms ORDER BY id')])
+        rels = cur.execute('SELECT child,parent FROM rels').fetchall()
+        if len(rels) > 0:
+            child,parent = zip(*rels)
+        else:
+            child,parent = [],[]
+        child = term_ids.get_indexer(child)
+        parent = term_ids.get_indexer(parent)
+        # Relationships to terms that are not in the database are ignored
+        keep = (child >= 0) & (parent >= 0)
+        num_terms = len(term_ids)
+        step = sparse.csr_matrix(
+            (np.ones(keep.sum(),dtype=np.int32),(child[keep],parent[keep])),
+            shape=(num_terms,num_terms)
+        )
+        step.sum_duplicates()
+        step.data[:] = 1
+        distance = step.copy()
+        paths = step
+        length = 1
+        while True:
+            paths = (paths @ step).tocsr()
+            paths.eliminate_zeros()
+            if paths.nnz == 0:
+                break
+            length += 1
+            if length > num_terms:
+                raise ValueError('The is_a relationships contain a cycle')
+            paths.data[:] = 1
+            distance = distance.maximum(paths*length)
+        distance = distance.tocoo()
+        try:
+            cur.execute('BEGIN TRANSACTION')
+            cur.execute('DELETE FROM rels_closure')
+            cur.executemany(
+                'INSERT INTO rels_closure (child,ancestor,distance) VALUES (?,?,?)',
+                zip(term_ids[distance.row].tolist(),
+                    term_ids[distance.col].tolist(),
+                    distance.data.tolist())
+            )
+            cur.execute('END TRANSACTION')
+        except Exception as e:
+            cur.execute('ROLLBACK')
+            raise e
+        self._closure_cache = None
 
     def children(self,term):
         '''
@@ -253,6 +703,16 @@ class GOnt(Ontology):
         )]
         return [self[x] for x in children_ids]
 
+    def num_children(self, term):
+        '''
+            Returns the number of children terms a term has
+        '''
+        term = self[term]
+        return self.db.cursor().execute(
+            'SELECT COUNT(child)  FROM rels WHERE parent = ?',
+            (term.id,)
+        ).fetchone()[0]
+
     def graph(self, terms=None):
         '''
             Create a NetworkX graph from terms
@@ -500,21 +960,20 @@ class GOnt(Ontology):
                 The path the the obo file. You can download
                 it here: http://geneontology.org/page/download-ontology
             
-            Returns
-            -------
-            A list of Empty (i.e. no genes) GO Terms 
+            Yields
+            ------
+            Empty (i.e. no genes) GO Terms, one at a time
         '''
         # Importing the obo information
         self.log('Importing OBO: {}', obo_file)
         cur_term = None
-        terms = []
         isa_re = re.compile('is_a: (.*) !.*')
         with rawFile(obo_file) as INOBO:
             for line in INOBO:
                 line = line.strip()
                 if line.startswith('id: '):
                     if cur_term is not None:
-                        terms.append(cur_term)
+                        yield cur_term
                     GOid = line.replace('id: ', '')
                     cur_term = GOTerm(GOid)
                 elif line.startswith('name: '):
@@ -531,29 +990,53 @@ class GOnt(Ontology):
                     cur_term.desc += line.replace('comment: ', '')
                 elif line.startswith('is_a: '):
                     cur_term.is_a.add(isa_re.match(line).group(1))
-        terms.append(cur_term)
-        return terms
+        if cur_term is not None:
+            yield cur_term
+
+    def _term_batches(self, terms, batch_size=10000):
+        '''
+            Turns GOTerms into batches of rows for the terms, term_attrs,
+            rels and alts tables, see Ontology._bulk_load
+        '''
+        for batch in chunks(terms,batch_size):
+            yield {
+                'terms' : (
+                    ['id','desc','name'],
+                    [(term.id,term.desc,term.name) for term in batch]
+                ),
+                'term_attrs' : (
+                    ['term','key','val'],
+                    [(term.id,key,val) for term in batch \
+                        for key,val in term.attrs.items()]
+                ),
+                'rels' : (
+                    ['parent','child'],
+                    [(parent,term.id) for term in batch for parent in term.is_a]
+                ),
+                'alts' : (
+                    ['alt','main'],
+                    [(alt,term.id) for term in batch for alt in term.alt_id]
+                )
+            }
 
     def _parse_gene_term_map(self,gene_map_file,headers=True,
             go_col=1,id_col=0):
+        '''
+            Streams the gene to GO term mapping file
+
+            Yields
+            ------
+            (gene id, term id) tuples
+        '''
         # Importing gene map information, and cross referencing with obo information
         self.log('Importing Gene Map: {}', gene_map_file)
-        genes = dict()
-        gene = ''
-        cur_term = ''
         with rawFile(gene_map_file) as INMAP:
             if headers:
                 garb = INMAP.readline()
-            for line in INMAP.readlines():
+            for line in INMAP:
                 row = line.strip('\n').split('\t')
                 gene = row[id_col].split('_')[0].strip()
-                cur_term = row[go_col]
-                # Make a map between genes and associated GO terms
-                if gene not in genes:
-                    genes[gene] = set([cur_term])
-                else:
-                    genes[gene].add(cur_term)
-        return genes
+                yield (gene,row[go_col])
 
     @classmethod
     def from_terms(cls, terms, name, description, refgen):
@@ -583,20 +1066,10 @@ class GOnt(Ontology):
         self.log('Your gene ontology is built.')
         return self
 
-        
-    def num_children(self, term):
-        '''
-            Returns the number of children terms a term has
-        '''
-        term = self[term]
-        return self.db.cursor().execute(
-            'SELECT COUNT(child)  FROM rels WHERE parent = ?',
-            (term.id,)
-        ).fetchone()[0]
-
     @classmethod
     def from_obo(cls, obo_file, gene_map_file ,name, description, 
-            refgen, go_col=1, id_col=0, headers=True, overwrite=True):
+            refgen, go_col=1, id_col=0, headers=True, overwrite=True,
+            propagate=True):
         ''' 
             Convenience function for importing GOnt from obo files 
 
@@ -622,44 +1095,37 @@ class GOnt(Ontology):
                 in the gene_map_file
             overwrite : bool (default: True)
                 Kill old instances.
+            propagate : bool (default: True)
+                Propagate gene annotations up to every ancestor of
+                the annotated terms (the true path rule). Inherited
+                annotations are flagged in the database.
         '''
         self = cls.create(name, description, refgen, overwrite=overwrite)
-        # Parse the OBO file and get a list of empty terms
-        terms = {term.id : term for term in self._parse_obo(obo_file)}
-        # Add terms to the database so that the parent method works
-        self.add_terms(terms.values(), overwrite=False)
-        # Build the indices
-        self.log('Building the indices.')
-        self._build_indices()
+        # Stream the OBO file straight into the database, the
+        # indices (and the is_a closure) are built at the end
+        self._bulk_load(self._term_batches(self._parse_obo(obo_file)))
+        _,_,terms = self._closure()
         # Parse the Gene/Term mapping 
-        genes = self._parse_gene_term_map(gene_map_file,
-            headers=headers,go_col=go_col,id_col=id_col
-        )
-        # Assign genes to terms AND to parent terms
         self.log("Adding GO-gene assignments")
         # Keep a list of missing references to report later
         missing_terms = set()
-        for gene_id,term_ids in genes.items():
-            # Get a gene object from the refgen
-            try:
-                gene = self.refgen[gene_id]
-                for term_id in term_ids:
-                    # Add gene to each term its annotated to
-                    if term_id not in terms:
-                        missing_terms.add(term_id)
-                        continue
-                    terms[term_id].loci.add(gene)
-                    # Propogate gene to each parental term
-                    for parent in self.parents(terms[term_id]):
-                        terms[parent.id].loci.add(gene)
-            except ValueError as e:
-                pass
+        annotations = []
+        for batch in chunks(self._parse_gene_term_map(gene_map_file,
+                headers=headers,go_col=go_col,id_col=id_col),100000):
+            resolved = self.refgen._resolve_ids(set(gene_id for gene_id,_ in batch))
+            for gene_id,term_id in batch:
+                if gene_id not in resolved:
+                    continue
+                if term_id not in terms:
+                    missing_terms.add(term_id)
+                    continue
+                annotations.append((term_id,resolved[gene_id]))
         self.log(
             'The following terms were referenced in the obo file '
             'but were not found in the gene-term mapping: \n' +
             '\n'.join(sorted(missing_terms)) + '\n'
         ) 
-        self.add_terms(terms.values(), overwrite=False)
+        self._add_annotations(annotations,propagate=propagate)
         return self
 
     def _create_tables(self):
@@ -670,6 +1136,11 @@ class GOnt(Ontology):
             cur.execute('ALTER TABLE terms ADD COLUMN name TEXT;')
         except lite.SQLError:
             pass
+        # Flags loci that were propagated up from a child term
+        try:
+            cur.execute('ALTER TABLE term_loci ADD COLUMN inherited INT DEFAULT 0;')
+        except lite.SQLError:
+            pass
         cur.execute('''
             CREATE TABLE IF NOT EXISTS rels (
                 parent TEXT, 
@@ -683,14 +1154,107 @@ class GOnt(Ontology):
                 main TEXT
             );
         ''')
+        self._create_closure_table()
+
+    def _create_closure_table(self):
+        self.db.cursor().execute('''
+            CREATE TABLE IF NOT EXISTS rels_closure (
+                child TEXT,
+                ancestor TEXT,
+                distance INT,
+                PRIMARY KEY(child, ancestor)
+            );
+            CREATE INDEX IF NOT EXISTS closureIND ON rels_closure (ancestor);
+        ''')
 
     def _clear_tables(self):
         super()._clear_tables()
         cur = self.db.cursor()
-        cur.execute('DELETE FROM rels; DELETE FROM alts;')
+        cur.execute('DELETE FROM rels; DELETE FROM alts; DELETE FROM rels_closure;')
+
+    def _add_annotations(self, annotations, propagate=True):
+        '''
+            Stores gene annotations in the term_loci table. With
+            propagate, each gene is also stored for every ancestor
+            of the terms it is annotated to. This is done in one
+            pass for all genes: the direct annotations form a sparse
+            term by gene matrix which is multiplied by the closure.
+
+            Parameters
+            ----------
+            annotations : iterable of (term id, gene id) tuples
+                The direct annotations
+            propagate : bool (default: True)
+                Also store the inherited annotations
+        '''
+        matrix,_,term_ids = self._closure()
+        annotations = pd.DataFrame(list(annotations),columns=['term','id'])
+        rows = term_ids.get_indexer(annotations.term)
+        # Annotations to terms that are not in the database are dropped
+        annotations = annotations[rows >= 0]
+        rows = rows[rows >= 0]
+        cols,gene_ids = pd.factorize(annotations.id)
+        direct = sparse.csr_matrix(
+            (np.ones(len(rows),dtype=np.int32),(rows,cols)),
+            shape=(len(term_ids),len(gene_ids))
+        )
+        direct.sum_duplicates()
+        direct.data[:] = 1
+        if propagate:
+            # ancestors[t,a] is 1 if a is an ancestor of t (or t itself)
+            ancestors = (matrix != 0).astype(np.int32) \
+                + sparse.identity(len(term_ids),dtype=np.int32,format='csr')
+            annotated = (ancestors.T @ direct).tocoo()
+        else:
+            annotated = direct.tocoo()
+        inherited = np.asarray(
+            direct[annotated.row,annotated.col] == 0
+        ).ravel().astype(int)
+        self.log(
+            'Adding {} annotations ({} inherited)',
+            len(inherited),inherited.sum()
+        )
+        self._bulk_load([{
+            'term_loci' : (
+                ['term','id','inherited'],
+                zip(term_ids[annotated.row].tolist(),
+                    gene_ids[annotated.col].tolist(),
+                    inherited.tolist())
+            )
+        }])
+
+    def annotated_ids(self, term, inherited=True):
+        '''
+            Returns the ids of the loci annotated to a term.
+
+            Parameters
+            ----------
+            term : GOTerm or str
+                The term or its id
+            inherited : bool (default: True)
+                If False, only return the loci annotated directly
+                to the term (not propagated up from a child term).
+        '''
+        if not isinstance(term,str):
+            term = term.id
+        query = 'SELECT id FROM term_loci WHERE term = ?'
+        if not inherited:
+            query += ' AND inherited = 0'
+        return [x for x, in self.db.cursor().execute(query,(term,))]
+
+    def _clear_closure(self):
+        '''
+            Marks the closure as out of date, it gets rebuilt
+            the next time it is needed.
+        '''
+        self._closure_cache = None
+        self.db.cursor().execute('DELETE FROM rels_closure')
 
 
     def _build_indices(self):
+        # Ontology.__init__ builds the indices of datasets made before the
+        # term_sizes table existed, which predate the closure table too
+        self._create_closure_table()
         super()._build_indices()
         cursor = self.db.cursor()
         cursor.execute('''
@@ -699,6 +1263,9 @@ class GOnt(Ontology):
             CREATE INDEX IF NOT EXISTS term_loci_ID 
                 ON term_loci (term);
         ''')
+        # The closure is emptied whenever terms change
+        if self.db.cursor().execute('SELECT COUNT(*) FROM rels_closure').fetchone()[0] == 0:
+            self._build_closure()
 
     def _drop_indices(self):
         super()._drop_indices()
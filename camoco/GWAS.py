@@ -3,6 +3,64 @@
 from .Ontology import Ontology
 from .Term import Term
 from .Locus import Locus
+from .Tools import chunks
+
+from collections import defaultdict
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+# UCSC style binning (Kent et al. 2002). Each level splits the genome
+# into bins 8 times smaller than the level above, the smallest bins
+# are 128kb (2**17). Loci are assigned to the smallest bin that fully
+# contains them so a region query only has to look in the bins that
+# overlap it at each level. Loci ending past the top level (512Mb)
+# go into bin 0, which every query looks at (see _overlapping_bins).
+_BIN_OFFSETS = [512+64+8+1, 64+8+1, 8+1, 1, 0]
+_BIN_FIRST_SHIFT = 17
+_BIN_NEXT_SHIFT = 3
+_BIN_MAX = 2**29
+
+def _locus_bin(start, end):
+    '''
+        Returns the UCSC bin for loci (works with scalars
+        or numpy arrays of start and end positions).
+    '''
+    scalar = np.isscalar(start) and np.isscalar(end)
+    start = np.atleast_1d(np.asarray(start,dtype=np.int64))
+    end = np.atleast_1d(np.asarray(end,dtype=np.int64))
+    start_bin = start >> _BIN_FIRST_SHIFT
+    end_bin = end >> _BIN_FIRST_SHIFT
+    bins = np.zeros(len(start),dtype=np.int64)
+    found = end >= _BIN_MAX
+    for offset in _BIN_OFFSETS:
+        fits = (start_bin == end_bin) & ~found
+        bins[fits] = offset + start_bin[fits]
+        found |= fits
+        start_bin = start_bin >> _BIN_NEXT_SHIFT
+        end_bin = end_bin >> _BIN_NEXT_SHIFT
+    if scalar:
+        return int(bins[0])
+    return bins
+
+def _overlapping_bins(start, end):
+    '''
+        Returns all the bins that can hold loci overlapping
+        the region between start and end.
+    '''
+    # Regions past the binned range can only overlap loci
+    # in bin 0, which holds everything ending past it
+    start = min(max(int(start),0),_BIN_MAX-1)
+    end = min(max(int(end),start),_BIN_MAX-1)
+    start_bin = start >> _BIN_FIRST_SHIFT
+    end_bin = end >> _BIN_FIRST_SHIFT
+    bins = [0]
+    for offset in _BIN_OFFSETS:
+        bins.extend(range(offset+start_bin,offset+end_bin+1))
+        start_bin = start_bin >> _BIN_NEXT_SHIFT
+        end_bin = end_bin >> _BIN_NEXT_SHIFT
+    return sorted(set(bins))
 
 
 class GWAS(Ontology):
@@ -12,6 +70,9 @@ class GWAS(Ontology):
     '''
     def __init__(self,name):
         super().__init__(name,type='GWAS')
+        # Datasets built before loci were binned
+        if self._has_table('term_loci') and not self._has_bins():
+            self._build_indices()
 
     def __getitem__(self, id):
         ''' retrieve a term by id '''
@@ -21,9 +82,9 @@ class GWAS(Ontology):
             ).fetchone()
             term_loci = [
                 Locus(chrom,start,end,id=id,) \
-                for term, id, chrom, start, end, window  in \
+                for id, chrom, start, end in \
                 self.db.cursor().execute(''' 
-                    SELECT * from term_loci WHERE 
+                    SELECT id, chrom, start, end from term_loci WHERE 
                     term = ?
                 ''',(id,))
             ]
@@ -38,6 +99,37 @@ class GWAS(Ontology):
         except TypeError as e: #Not in database
             raise e
 
+    def _bulk_terms(self, ids):
+        '''
+            Builds the Terms for a list of term ids using batched
+            queries, see Ontology._bulk_terms. GWAS loci are read
+            straight from the term_loci table.
+        '''
+        cur = self.db.cursor()
+        descs = {}
+        term_loci = defaultdict(list)
+        loci = {}
+        for chunk in chunks(ids):
+            args = ','.join('?'*len(chunk))
+            descs.update(cur.execute(
+                'SELECT id,desc FROM terms WHERE id IN ({})'.format(args),chunk
+            ))
+            for term,id,chrom,start,end in cur.execute('''
+                SELECT term,id,chrom,start,end FROM term_loci 
+                WHERE term IN ({})'''.format(args),chunk):
+                locus = Locus(chrom,start,end,id=id)
+                loci[(term,id)] = locus
+                term_loci[term].append(locus)
+            for term,id,key,val in cur.execute('''
+                SELECT term,id,key,val FROM loci_attr 
+                WHERE term IN ({})'''.format(args),chunk):
+                if (term,id) in loci:
+                    loci[(term,id)].attr[key] = val
+        return [
+            Term(id, desc=descs[id], loci=term_loci[id]) \
+            for id in ids if id in descs
+        ]
+
     def add_term(self, term, cursor=None, overwrite=True):
         ''' 
             This will add a single term to the ontology.
@@ -52,6 +144,7 @@ class GWAS(Ontology):
                 # Otherwise, assume that another transaction was initiated
                 # perhaps by self.add_terms (notice the plurality)
                 cur = cursor
+            self._incidence_cache = None
             if overwrite:
                 self.del_term(term.id,cursor=cur)
             # Add the term name and description
@@ -60,18 +153,20 @@ class GWAS(Ontology):
                 VALUES (?, ?)''', (term.id, term.desc)
             )
             # Add the term loci
-            for locus in term.loci:
-                cur.execute('''
-                    INSERT OR REPLACE INTO term_loci 
-                    (term, id, chrom, start, end, window)
-                    VALUES (?, ?, ?, ? ,? ,?);
-                    ''', (term.id, locus.id, locus.chrom,
-                        locus.start, locus.end, locus.window)
-                )
-                cur.executemany('''
-                    INSERT OR REPLACE INTO loci_attr
-                    (term,id,key,val) VALUES (?,?,?,?);
-                ''',[(term.id,locus.id,key,val) for key,val in locus.attr.items()])
+            cur.executemany('''
+                INSERT OR REPLACE INTO term_loci 
+                (term, id, chrom, start, end, window, bin)
+                VALUES (?, ?, ?, ? ,? ,?, ?);
+                ''', [(term.id, locus.id, locus.chrom,
+                    locus.start, locus.end, locus.window,
+                    _locus_bin(locus.start,locus.end)) for locus in term.loci]
+            )
+            cur.executemany('''
+                INSERT OR REPLACE INTO loci_attr
+                (term,id,key,val) VALUES (?,?,?,?);
+            ''',[(term.id,locus.id,key,val) \
+                for locus in term.loci for key,val in locus.attr.items()])
+            self._update_term_size(term.id,cur)
             if not cursor: 
                 # Still assume that 
                 cur.execute('END TRANSACTION')
@@ -100,6 +195,124 @@ class GWAS(Ontology):
             Internal Methods -- Factory Methods
     '''
 
+    def loci_in_region(self, chrom, start, end, return_table=False):
+        '''
+            Returns the loci (from any term) that overlap a region.
+            Uses the binned (chrom,bin,start) index so only the loci
+            near the region are looked at.
+
+            Parameters
+            ----------
+            chrom : str
+                The chromosome of the region
+            start : int
+                The start of the region
+            end : int
+                The end of the region
+            return_table : bool (default: False)
+                If True, return a DataFrame with the term, id, chrom,
+                start and end of each locus instead of Locus objects.
+
+            Returns
+            -------
+            A list of Loci (with their attrs) or a DataFrame
+        '''
+        bins = _overlapping_bins(start,end)
+        rows = self.db.cursor().execute('''
+            SELECT term, id, chrom, start, end FROM term_loci
+            WHERE chrom = ? AND bin IN ({})
+                AND start <= ? AND end >= ?
+            ORDER BY start
+            '''.format(','.join('?'*len(bins))),
+            [str(chrom)] + bins + [end,start]
+        ).fetchall()
+        if return_table == True:
+            return pd.DataFrame(rows,columns=['term','id','chrom','start','end'])
+        loci = {
+            (term,id):Locus(chrom,start,end,id=id) \
+            for term,id,chrom,start,end in rows
+        }
+        # Fetch the attrs for all of the loci at once
+        cur = self.db.cursor()
+        for chunk in chunks(loci,size=499):
+            for term,id,key,val in cur.execute('''
+                SELECT term,id,key,val FROM loci_attr
+                WHERE (term,id) IN (VALUES {})
+                '''.format(','.join(['(?,?)']*len(chunk))),
+                list(chain.from_iterable(chunk))):
+                loci[(term,id)].attr[key] = val
+        return list(loci.values())
+
+    def terms_near(self, loci, window_size=50000, return_table=False):
+        '''
+            Returns the terms that have loci within a window around
+            any of the loci (e.g. candidate genes), across all terms.
+
+            Parameters
+            ----------
+            loci : Locus or iterable of Loci
+                The loci to look around
+            window_size : int (default: 50000)
+                The number of bases up and downstream of each locus
+                to look in
+            return_table : bool (default: False)
+                If True, return a DataFrame with a row for each
+                nearby locus (and the locus it was near) instead of
+                the term ids.
+
+            Returns
+            -------
+            A sorted list of term ids or a DataFrame
+        '''
+        if isinstance(loci,Locus):
+            loci = [loci]
+        tables = []
+        for locus in loci:
+            tbl = self.loci_in_region(
+                locus.chrom,
+                locus.start - window_size,
+                locus.end + window_size,
+                return_table=True
+            )
+            tbl.insert(0,'locus',locus.id)
+            tables.append(tbl)
+        if len(tables) == 0:
+            tbl = pd.DataFrame(columns=['locus','term','id','chrom','start','end'])
+        else:
+            tbl = pd.concat(tables,ignore_index=True)
+        if return_table == True:
+            return tbl
+        return sorted(set(tbl.term))
+
+    def _has_bins(self):
+        return self._has_column('term_loci','bin')
+
+    def _build_indices(self):
+        cur = self.db.cursor()
+        # Older datasets do not have a bin column
+        if not self._has_bins():
+            self.log('Adding bins to the GWAS loci')
+            cur.execute('ALTER TABLE term_loci ADD COLUMN bin INT')
+        missing = cur.execute(
+            'SELECT rowid, start, end FROM term_loci WHERE bin IS NULL'
+        ).fetchall()
+        if len(missing) > 0:
+            rowid,start,end = zip(*missing)
+            cur.execute('BEGIN TRANSACTION')
+            cur.executemany(
+                'UPDATE term_loci SET bin = ? WHERE rowid = ?',
+                zip(_locus_bin(start,end).tolist(),rowid)
+            )
+            cur.execute('END TRANSACTION')
+        super()._build_indices()
+        cur.execute('''
+            CREATE INDEX IF NOT EXISTS lociBinIND ON term_loci (chrom,bin,start)
+        ''')
+
+    def _drop_indices(self):
+        super()._drop_indices()
+        self.db.cursor().execute('DROP INDEX IF EXISTS lociBinIND')
+
     def _create_tables(self):
         super()._create_tables()
         # Add the loci table so it works with SNPs
@@ -115,6 +328,8 @@ class GWAS(Ontology):
                 start INT,
                 end INT,
                 window INT,
+                -- UCSC bin for region queries, see _locus_bin
+                bin INT,
                 -- Relationship here is b/w term and locus-id
                 PRIMARY KEY(term,id)
             );
@@ -215,25 +430,91 @@ class GWAS(Ontology):
                 Assign an id to the locus
         '''
         self = cls.create(name, description, refgen)
-        # group each trait by its name
-        for term_id, df in df.groupby(term_col):
-            term = Term(term_id)
-            # we have a SNP
-            if pos_col is not None:
-                for i, row in df.iterrows():
-                    # make sure there are no collisions with the Locus instance
-                    # function names. This is hackey and I dont like it
-                    kwargs = {
-                        key:val for key, val in dict(row).items() \
-                        if key not in Locus.__init__.__code__.co_varnames \
-                        and key not in [chr_col,pos_col,start_col,end_col,id_col]
-                    }
-                    snp = Locus(
-                        row[chr_col], int(row[pos_col]), int(row[pos_col]), 
-                        gene_build=self.refgen.build, **kwargs
-                    )
-                    term.loci.add(snp)
-            self.log("Importing {}", term)
-            self.add_term(term)
+        self._bulk_load([self._locus_rows(
+            df, term_col=term_col, chr_col=chr_col, pos_col=pos_col,
+            start_col=start_col, end_col=end_col, id_col=id_col
+        )])
         self.set_strongest(attr=strongest_attr,higher=strongest_higher)
         return self
+
+    @classmethod
+    def from_table(cls, filename, name, description, refgen, sep='\t',
+            chunksize=100000, term_col='Term', chr_col='CHR', pos_col=None,
+            start_col=None, end_col=None, id_col=None,
+            strongest_attr='pval', strongest_higher=True):
+        '''
+            Import a GWAS dataset from a delimited file. The file is
+            streamed in chunks so tables with millions of SNPs never
+            have to be held in memory, see from_DataFrame for the
+            column parameters.
+
+            Parameters
+            ----------
+            filename : str
+                Path to the table (can be compressed)
+            sep : str (default: '\t')
+                The field separator
+            chunksize : int (default: 100000)
+                The number of rows read at a time
+        '''
+        self = cls.create(name, description, refgen)
+        self._bulk_load(
+            self._locus_rows(
+                df, term_col=term_col, chr_col=chr_col, pos_col=pos_col,
+                start_col=start_col, end_col=end_col, id_col=id_col
+            ) for df in pd.read_table(filename, sep=sep, chunksize=chunksize)
+        )
+        self.set_strongest(attr=strongest_attr,higher=strongest_higher)
+        return self
+
+    def _locus_rows(self, df, term_col='Term', chr_col='CHR', pos_col=None,
+            start_col=None, end_col=None, id_col=None):
+        '''
+            Converts a DataFrame of loci (one row per locus) into rows
+            for the terms, term_loci and loci_attr tables, see
+            Ontology._bulk_load. Columns that are not used for the locus
+            position are stored as locus attributes.
+        '''
+        df = df[df[term_col].notnull()]
+        if pos_col is not None:
+            start = end = df[pos_col].astype(int)
+        elif start_col is not None and end_col is not None:
+            start = df[start_col].astype(int)
+            end = df[end_col].astype(int)
+        else:
+            raise ValueError('Either pos_col or start_col and end_col must be specified')
+        chrom = df[chr_col].astype(str)
+        if id_col is not None:
+            ids = df[id_col].astype(str)
+        else:
+            # Same as the id of a Locus without one
+            ids = '<None>' + chrom + ':' + start.astype(str) + '-' + end.astype(str)
+        terms = df[term_col].tolist()
+        ids = ids.tolist()
+        # make sure there are no collisions with the Locus instance
+        # function names. This is hackey and I dont like it
+        attr_cols = [
+            key for key in df.columns \
+            if key not in Locus.__init__.__code__.co_varnames \
+            and key not in [chr_col,pos_col,start_col,end_col,id_col]
+        ]
+        loci_attr = [
+            (term,id,'gene_build',self.refgen.build) \
+            for term,id in zip(terms,ids)
+        ]
+        for key in attr_cols:
+            loci_attr.extend(
+                (term,id,key,val) for term,id,val in zip(terms,ids,df[key].tolist())
+            )
+        return {
+            'terms' : (
+                ['id','desc'],
+                [(id,'') for id in df[term_col].unique().tolist()]
+            ),
+            'term_loci' : (
+                ['term','id','chrom','start','end','window','bin'],
+                zip(terms,ids,chrom.tolist(),start.tolist(),end.tolist(),
+                    [0]*len(ids),_locus_bin(start.values,end.values).tolist())
+            ),
+            'loci_attr' : (['term','id','key','val'],loci_attr)
+        }
@@ -1,6 +1,9 @@
 #!/usr/bin/python
 import numpy as np
 
+from camoco.Chrom import _loci_table
+from camoco.Tools import random_state
+
 class Genome(object):  # pragma: no cover 
     def __init__(self,id,chroms=list()):
         self.id = id
@@ -18,6 +21,38 @@ class Genome(object):  # pragma: no cover
     def rSNP(self):
         ''' returns a random 'SNP' from the genome '''
         return self.rChrom().rSNP()
+    def rLoci(self,n,length=0,seed=None):
+        '''
+            returns n random loci of specified length as a table.
+            Chromosomes are weighted by the number of positions a
+            locus can start at, so loci are uniform over the genome.
+            With length 0, each locus is a single position (a SNP).
+
+            Parameters
+            ----------
+            n : int
+                The number of loci to generate
+            length : int (default: 0)
+                The length of each locus
+            seed : int or numpy.random.RandomState (default: None)
+                Seed used for reproducible sampling.
+
+            Returns
+            -------
+            A pandas DataFrame with chrom, start, end and id columns
+        '''
+        rng = random_state(seed)
+        spans = np.array([int(x.length)-length for x in self.chroms],dtype=np.int64)
+        spans[spans < 0] = 0
+        if spans.sum() == 0:
+            raise ValueError('No chromosome can fit a locus of length {}'.format(length))
+        rindex = rng.choice(len(self.chroms),size=n,p=spans/spans.sum())
+        starts = np.floor(rng.random_sample(n)*spans[rindex]).astype(np.int64)
+        chroms = np.array([str(x.id) for x in self.chroms])[rindex]
+        return _loci_table(chroms,starts,length)
+    def rSNPs(self,n,seed=None):
+        ''' returns a table of n random 'SNPs' from the genome '''
+        return self.rLoci(n,length=0,seed=seed)
     def __repr__(self):
         return "\n".join(map(str,self.chroms))
  
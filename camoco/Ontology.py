@@ -4,15 +4,19 @@ from .Camoco import Camoco
 from .RefGen import RefGen
 from .Locus import Locus
 from .Term import Term
+from .Tools import chunks,random_state
 
 from pandas import DataFrame
 from scipy.stats import hypergeom
+from scipy import sparse
 from itertools import chain
 from functools import lru_cache
-from collections import OrderedDict
+from collections import OrderedDict,defaultdict
 
 import sys
 import copy
+import time
+import random
 import numpy
 import camoco as co
 import pandas as pd
@@ -36,6 +40,14 @@ class Ontology(Camoco):
         super().__init__(name, type=type)
         if self.refgen:
             self.refgen = RefGen(self.refgen)
+        # Term by locus incidence matrix, see _incidence_matrix
+        self._incidence_cache = None
+        # Datasets built before the term_sizes table existed
+        # get it (and the reverse locus index) the first time
+        # they are opened
+        if self._has_table('term_loci') and not self._has_table('term_sizes'):
+            self._create_term_sizes()
+            self._build_indices()
 
     def __len__(self):
         '''
@@ -64,12 +76,9 @@ class Ontology(Camoco):
 
         '''
         return self.db.cursor().execute(
-            '''SELECT COUNT(*) FROM (
-                SELECT DISTINCT(term) FROM term_loci 
-                GROUP BY term 
-                HAVING COUNT(term) >= ? 
-                    AND  COUNT(term) <= ?
-            );''',
+            '''SELECT COUNT(*) FROM term_sizes 
+                WHERE size >= ? AND size <= ?
+            ''',
             (min_term_size, max_term_size)
         ).fetchone()[0]
 
@@ -92,7 +101,8 @@ class Ontology(Camoco):
         except TypeError as e: # Not in database
             raise e
 
-    def terms_containing(self,locus_list,max_term_size=10e10,min_term_size=0):
+    def terms_containing(self,locus_list,max_term_size=10e10,min_term_size=0,
+                         ids_only=False):
         '''
             Retrurns the set of terms which contains the 
             specified loci.
@@ -110,28 +120,36 @@ class Ontology(Camoco):
                 The minimum term size for which to test enrichment. Useful
                 for filtering out very small terms that would be uninformative
                 (e.g. single gene terms)
+            ids_only : bool (default: False)
+                If True, only return the ids of the terms and
+                do not build the Term objects.
 
             Returns
             -------
             list of terms which contain provided loci
         '''
         # Filter to unique set
-        locus_list = set(locus_list)
-        # query the database
-        terms = self.db.cursor().execute('''SELECT DISTINCT term 
-        FROM term_loci WHERE id IN ('{}')
-        '''.format(
-            "','".join([x.id for x in locus_list])
-        )).fetchall()
-        # Fetch the terms with the proper size
-        terms = list(
-            filter(
-                lambda t: (len(t) >= min_term_size) and (len(t) <= max_term_size),
-                [self[name] for name, in terms]
-            )
-        )
-        return terms
-
+        locus_ids = set(x.id for x in locus_list)
+        # query the database, the term sizes are filtered
+        # in the query using the term_sizes table
+        cur = self.db.cursor()
+        terms = []
+        # leave room for the two size bounds in the host parameters
+        for chunk in chunks(locus_ids, size=997):
+            terms.extend(id for id, in cur.execute('''
+                SELECT DISTINCT term_loci.term FROM term_loci 
+                JOIN term_sizes ON term_loci.term = term_sizes.term
+                WHERE term_loci.id IN ({})
+                    AND term_sizes.size >= ?
+                    AND term_sizes.size <= ?
+                '''.format(','.join('?'*len(chunk))),
+                chunk + [min_term_size,max_term_size]
+            ))
+        # A term can show up in more than one chunk
+        terms = list(OrderedDict.fromkeys(terms))
+        if ids_only:
+            return terms
+        return self._bulk_terms(terms)
 
     def num_distinct_loci(self):
         return self.db.cursor().execute(
@@ -143,18 +161,84 @@ class Ontology(Camoco):
             'SELECT DISTINCT(id) FROM term_loci'
         )]
 
-    def iter_terms(self,min_term_size=0,max_term_size=10e10):
+    def iter_terms(self,min_term_size=0,max_term_size=10e10,batch_size=1000):
         '''
             Return a generator that iterates over each term in the ontology.
+
+            Terms are built in batches: the terms, their loci and
+            attributes for a whole batch are pulled with a handful
+            of queries instead of several queries per term.
+
+            Parameters
+            ----------
+            min_term_size : int (default: 0)
+                The minimum number of loci in a term
+            max_term_size : int (default: 10e10)
+                The maximum number of loci in a term
+            batch_size : int (default: 1000)
+                The number of terms built at a time
+        '''
+        ids = [id for id, in self.db.cursor().execute('''
+            SELECT term FROM term_sizes
+            WHERE size >= ? AND size <= ?
+            ORDER BY term
+        ''',(min_term_size,max_term_size))]
+        for batch in chunks(ids,batch_size):
+            yield from self._bulk_terms(batch)
+
+    def _bulk_terms(self, ids):
+        '''
+            Builds the Terms for a list of term ids using
+            batched queries.
+
+            Parameters
+            ----------
+            ids : list of str
+                The term ids
+
+            Returns
+            -------
+            A list of Terms in the same order as ids (ids that
+            are not in the database are skipped)
+        '''
+        cur = self.db.cursor()
+        descs = {}
+        term_loci = defaultdict(list)
+        term_attrs = defaultdict(dict)
+        for chunk in chunks(ids):
+            args = ','.join('?'*len(chunk))
+            descs.update(cur.execute(
+                'SELECT id,desc FROM terms WHERE id IN ({})'.format(args),chunk
+            ))
+            for term,id in cur.execute(
+                'SELECT term,id FROM term_loci WHERE term IN ({})'.format(args),chunk):
+                term_loci[term].append(id)
+            for term,key,val in cur.execute(
+                'SELECT term,key,val FROM term_attrs WHERE term IN ({})'.format(args),chunk):
+                term_attrs[term][key] = val
+        # Look up the genes for the whole batch at once
+        genes = {
+            gene_id:gene for gene_id,gene in zip(
+                *self._bulk_loci(set(chain.from_iterable(term_loci.values())))
+            )
+        }
+        return [
+            Term(
+                id, desc=descs[id],
+                loci=[genes[x] for x in term_loci[id] if x in genes],
+                **term_attrs[id]
+            ) for id in ids if id in descs
+        ]
+
+    def _bulk_loci(self, locus_ids):
+        '''
+            Returns the requested ids and their genes from the
+            RefGen (ids not in the RefGen are dropped).
         '''
-        terms = self.db.cursor().execute('''
-            SELECT term from term_loci
-            GROUP BY term
-            HAVING COUNT(term) >= ?
-                AND COUNT(term) <= ?
-        ''',(min_term_size,max_term_size))
-        for id, in terms:
-            yield self[id]
+        locus_ids = list(locus_ids)
+        resolved = self.refgen._resolve_ids(locus_ids)
+        locus_ids = [x for x in locus_ids if x in resolved]
+        return locus_ids,self.refgen.from_ids(locus_ids)
 
     def terms(self,min_term_size=0,max_term_size=10e10):
         return list(self.iter_terms(min_term_size=min_term_size,max_term_size=max_term_size))
@@ -163,7 +247,7 @@ class Ontology(Camoco):
         return "Ontology:{} - desc: {} - contains {} terms for {}".format(
             self.name, self.description, len(self), self.refgen)
 
-    def rand(self, n=1, min_term_size=1, max_term_size=100000):
+    def rand(self, n=1, min_term_size=1, max_term_size=100000, seed=None):
         '''
             Return a random Term from the Ontology
 
@@ -176,22 +260,33 @@ class Ontology(Camoco):
                 i.e. the number of genes annotated to the term
             max_term_size : int (default: 100000)
                 The largest acceptable term size
+            seed : int or numpy.random.RandomState (default: None)
+                Seed used for reproducible sampling.
         '''
         cur = self.db.cursor()
-        ids = cur.execute(''' 
-            SELECT term FROM term_loci 
-            GROUP BY term 
-            HAVING COUNT(term) >= ?
-                AND COUNT(term) <= ?
-            ORDER BY RANDOM() 
-            LIMIT ?;
-        ''',(min_term_size,max_term_size,n)).fetchall()
-        if len(ids) == 0:
+        # Count the qualifying terms with the size index and pick
+        # random offsets into that range, only the sampled ids
+        # are read from the table
+        num_terms = cur.execute('''
+            SELECT COUNT(*) FROM term_sizes 
+            WHERE size >= ? AND size <= ?
+        ''',(min_term_size,max_term_size)).fetchone()[0]
+        if num_terms == 0:
             raise ValueError(
                 'No Terms exists with this criteria '
                 '{} < len(term) < {}:'.format(min_term_size,max_term_size)
             )
-        terms = [self[id[0]] for id in ids]
+        offsets = random_state(seed).choice(
+            num_terms, min(n,num_terms), replace=False
+        )
+        ids = [cur.execute('''
+            SELECT term FROM term_sizes 
+            WHERE size >= ? AND size <= ?
+            ORDER BY size, rowid LIMIT 1 OFFSET ?
+        ''',(min_term_size,max_term_size,int(offset))).fetchone()[0]
+            for offset in offsets
+        ]
+        terms = [self[id] for id in ids]
         if len(terms) == 1:
             return terms[0]
         else:
@@ -215,6 +310,7 @@ class Ontology(Camoco):
 
         if overwrite:
             self.del_term(term.id)
+        self._incidence_cache = None
         if not cursor:
             cur = self.db.cursor()
             cur.execute('BEGIN TRANSACTION')
@@ -228,19 +324,18 @@ class Ontology(Camoco):
 
         # Add the term loci
         if term.loci:
-            for locus in term.loci:
-                cur.execute('''
-                    INSERT OR ABORT INTO term_loci (term, id)
-                    VALUES (?, ?)
-                    ''', (term.id, locus.id))
+            cur.executemany('''
+                INSERT OR ABORT INTO term_loci (term, id)
+                VALUES (?, ?)
+                ''', [(term.id, locus.id) for locus in term.loci])
+            self._update_term_size(term.id,cur)
 
         # Add the term attrs
         if term.attrs:
-            for key,val in term.attrs.items():
-                cur.execute('''
-                    INSERT OR ABORT INTO term_attrs (term,key,val)
-                    VALUES (?,?)
-                ''',(term.id,key,val))
+            cur.executemany('''
+                INSERT OR ABORT INTO term_attrs (term,key,val)
+                VALUES (?,?,?)
+            ''',[(term.id,key,val) for key,val in term.attrs.items()])
 
         if not cursor:
             cur.execute('END TRANSACTION')
@@ -266,11 +361,14 @@ class Ontology(Camoco):
                 id = term.id
             else:
                 id = term
+            self._incidence_cache = None
     
             cur.execute('''
                 DELETE FROM term_loci WHERE term = ?;
+                DELETE FROM term_sizes WHERE term = ?;
+                DELETE FROM term_attrs WHERE term = ?;
                 DELETE FROM terms WHERE id = ?;
-                ''', (id, id))
+                ''', (id, id, id, id))
             if not cursor:
                 cur.execute('END TRANSACTION')
         except Exception as e:
@@ -308,6 +406,54 @@ class Ontology(Camoco):
             self.del_term(term, cursor=cur)
         cur.execute('END TRANSACTION')
 
+    def _bulk_load(self, batches):
+        '''
+            Writes rows straight into the database tables. All batches
+            are written in a single transaction using executemany, with
+            the indices dropped during the load and rebuilt (along with
+            the term sizes) at the end.
+
+            Parameters
+            ----------
+            batches : iterable of dicts
+                Each batch maps a table name to a tuple of
+                (columns, rows) where rows is an iterable of
+                tuples in column order. Batches can be generated
+                lazily, e.g. from chunks of a file.
+
+            Returns
+            -------
+            The number of rows written
+        '''
+        self._incidence_cache = None
+        self._drop_indices()
+        cur = self.db.cursor()
+        num_rows = 0
+        start_time = time.time()
+        try:
+            cur.execute('BEGIN TRANSACTION')
+            for batch in batches:
+                for table,(columns,rows) in batch.items():
+                    rows = list(rows)
+                    cur.executemany(
+                        'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                            table,','.join(columns),','.join('?'*len(columns))
+                        ),rows
+                    )
+                    num_rows += len(rows)
+                self.log(
+                    'Loaded {} rows ({:.0f} rows/sec)',num_rows,
+                    num_rows/max(time.time()-start_time,1e-9)
+                )
+            cur.execute('END TRANSACTION')
+        except Exception as e:
+            cur.execute('ROLLBACK')
+            raise e
+        finally:
+            self.log('Building the indices.')
+            self._build_indices()
+        return num_rows
+
     def set_strongest(self,attr=None,higher=None):
         '''
             Convinience function that allows you to set default values for
@@ -389,16 +535,23 @@ class Ontology(Camoco):
 
         '''
         self = cls.create(name,description,refgen)
-        # create terms from 
-        terms = [
-            Term(id,loci=refgen[set(df[gene_col])]) \
-            for id,df in dataframe.groupby(term_col)
-        ]
-        self.log('Adding {} terms to the database.',len(terms))
-        self.add_terms(terms, overwrite=True)
-        # Build the indices
-        self.log('Building the indices.')
-        self._build_indices()
+        # Map the gene ids onto the RefGen, dropping the
+        # ones that are not in there
+        dataframe = dataframe[[term_col,gene_col]].drop_duplicates()
+        resolved = refgen._resolve_ids(dataframe[gene_col].tolist())
+        loci = dataframe[gene_col].map(resolved)
+        found = loci.notnull()
+        self.log('Adding {} terms to the database.',dataframe[term_col].nunique())
+        self._bulk_load([{
+            'terms' : (
+                ['id','desc'],
+                [(id,'') for id in dataframe[term_col].unique().tolist()]
+            ),
+            'term_loci' : (
+                ['term','id'],
+                zip(dataframe[term_col][found].tolist(),loci[found].tolist())
+            )
+        }])
         self.log('Your gene ontology is built.')
         return self
 
@@ -451,19 +604,108 @@ class Ontology(Camoco):
                 val TEXT
             );
         ''')
+        self._create_term_sizes()
+
+    def _create_term_sizes(self):
+        self.db.cursor().execute('''
+            CREATE TABLE IF NOT EXISTS term_sizes (
+                term TEXT PRIMARY KEY,
+                size INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS termSizeIND ON term_sizes (size);
+        ''')
+
+    def _update_term_size(self, id, cursor):
+        '''
+            Refreshes the term_sizes entry for a single term,
+            terms without any loci do not get an entry.
+        '''
+        cursor.execute('''
+            DELETE FROM term_sizes WHERE term = ?;
+            INSERT INTO term_sizes (term, size)
+                SELECT term, COUNT(term) FROM term_loci 
+                WHERE term = ? GROUP BY term;
+        ''',(id,id))
+
+    def _has_column(self, table, column):
+        return column in [
+            x[1] for x in self.db.cursor().execute(
+                'PRAGMA table_info({})'.format(table)
+            )
+        ]
+
+    def _has_table(self, table):
+        return self.db.cursor().execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?",
+            (table,)
+        ).fetchone()[0] > 0
+
+    def _build_term_sizes(self):
+        '''
+            Rebuilds the term_sizes table (the number of loci
+            in each term) from the term_loci table.
+        '''
+        cur = self.db.cursor()
+        cur.execute('''
+            DELETE FROM term_sizes;
+            INSERT INTO term_sizes (term, size)
+                SELECT term, COUNT(term) FROM term_loci GROUP BY term;
+        ''')
 
     def _clear_tables(self):
         cur = self.db.cursor()
-        cur.execute('DELETE FROM terms; DELETE FROM term_loci;')
+        cur.execute('DELETE FROM terms; DELETE FROM term_loci; DELETE FROM term_sizes;')
 
     def _build_indices(self):
         cursor = self.db.cursor()
         cursor.execute('CREATE INDEX IF NOT EXISTS termIND ON terms (id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS lociIND ON term_loci (term,id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS lociRevIND ON term_loci (id,term)')
+        self._build_term_sizes()
 
     def _drop_indices(self):
         cursor = self.db.cursor()
-        cursor.execute('DROP INDEX IF EXISTS termIND; DROP INDEX IF EXISTS lociIND;')
+        cursor.execute('''
+            DROP INDEX IF EXISTS termIND; 
+            DROP INDEX IF EXISTS lociIND;
+            DROP INDEX IF EXISTS lociRevIND;
+        ''')
+
+    def _incidence_matrix(self):
+        '''
+            Returns a sparse term by locus incidence matrix for
+            the Ontology. The matrix is built with a single scan of
+            the term_loci table and cached until terms are added
+            or deleted.
+
+            Returns
+            -------
+            A tuple (matrix,term_ids,locus_ids) where matrix is a
+            scipy CSR matrix with a 1 where a locus is in a term,
+            term_ids are the ids of the rows and locus_ids are the
+            ids of the columns (both pandas Indexes).
+        '''
+        if self._incidence_cache is None:
+            term_loci = pd.DataFrame(
+                self.db.cursor().execute(
+                    'SELECT term,id FROM term_loci'
+                ).fetchall(),
+                columns=['term','id']
+            )
+            term_codes,term_ids = pd.factorize(term_loci.term)
+            locus_codes,locus_ids = pd.factorize(term_loci.id)
+            matrix = sparse.csr_matrix(
+                (numpy.ones(len(term_loci),dtype=numpy.int32),
+                 (term_codes,locus_codes)),
+                shape=(len(term_ids),len(locus_ids))
+            )
+            # Duplicate rows in term_loci only count once
+            matrix.sum_duplicates()
+            matrix.data[:] = 1
+            self._incidence_cache = (
+                matrix,pd.Index(term_ids),pd.Index(locus_ids)
+            )
+        return self._incidence_cache
 
     def enrichment(self, locus_list, pval_cutoff=0.05, max_term_size=300,
                    min_term_size=2, num_universe=None, return_table=False,
@@ -510,130 +752,150 @@ class Ontology(Camoco):
                 the locus list. Increasing this value can minimize spurious
                 or uninformative terms
         '''
+        matrix,term_ids,locus_ids = self._incidence_matrix()
         if isinstance(locus_list,co.Ontology):
             ontology = locus_list
             self.log('Calculating enrichment for an  Ontology: {}',ontology.name)
-
-            enrich = []
             if label is None:
                 label = ontology.name
             if num_universe is None:
                 num_universe = len(set(self.distinct_loci_ids()).union(ontology.distinct_loci_ids()))
-            for term in ontology.terms(min_term_size=min_term_size,max_term_size=max_term_size):
-                term = copy.copy(term)
-                e = self.enrichment(
-                    term.loci,
-                    pval_cutoff=pval_cutoff,
-                    max_term_size=max_term_size,
-                    min_term_size=min_term_size,
-                    num_universe=num_universe,
-                    return_table=return_table,
-                    label=label+'_'+term.id,
-                    include_genes=include_genes,
-                    bonferroni_correction=bonferroni_correction,
-                    min_overlap=min_overlap,
-                ) 
-                enrich.append(e)
-            if return_table:
-                return pd.concat(enrich)
-            else:
-                return enrich
-        # return a new copy of each 
-
-        terms = [copy.copy(term) for term in self.terms_containing(
-            locus_list,
-            min_term_size=min_term_size,
-            max_term_size=max_term_size
-        )]
+            # Each term in the other ontology is a locus list
+            source,source_ids,source_loci = ontology._incidence_matrix()
+            source_sizes = numpy.asarray(source.sum(axis=1)).ravel()
+            keep = (source_sizes >= min_term_size) & (source_sizes <= max_term_size)
+            source = source[keep]
+            source_ids = source_ids[keep]
+            num_sampled = source_sizes[keep]
+            # Map the source loci onto the columns of this ontology
+            cols = locus_ids.get_indexer(source_loci)
+            found = cols >= 0
+            mapping = sparse.csr_matrix(
+                (numpy.ones(found.sum(),dtype=numpy.int32),
+                 (numpy.flatnonzero(found),cols[found])),
+                shape=(len(source_loci),len(locus_ids))
+            )
+            query = (source @ mapping).tocsr()
+            labels = [label+'_'+id for id in source_ids]
+        else:
+            locus_list = list(locus_list)
+            cols = locus_ids.get_indexer(list(set(x.id for x in locus_list)))
+            cols = cols[cols >= 0]
+            query = sparse.csr_matrix(
+                (numpy.ones(len(cols),dtype=numpy.int32),
+                 (numpy.zeros(len(cols),dtype=numpy.int64),cols)),
+                shape=(1,len(locus_ids))
+            )
+            num_sampled = numpy.array([len(locus_list)])
+            labels = [label]
         # Calculate the size of the Universe
         if num_universe is None:
             num_universe = self.num_distinct_loci() 
-        self.log(
-            '{}: Loci occur in {} terms, containing {} genes'.format(
-                label,len(terms), num_universe
-            )
+        # Tally up the overlap between each locus list and each term
+        term_sizes = numpy.asarray(matrix.sum(axis=1)).ravel()
+        overlap = (query @ matrix.T).tocoo()
+        tested = (term_sizes[overlap.col] >= min_term_size) \
+               & (term_sizes[overlap.col] <= max_term_size)
+        rows = overlap.row[tested]
+        terms = overlap.col[tested]
+        num_common = overlap.data[tested]
+        num_tested = numpy.bincount(rows,minlength=query.shape[0])
+        # the reason this is num_common - 1 is because we are looking for 1 - cdf
+        # and we need to greater than OR EQUAL TO num_common
+        # Look. Do this in ipython:
+        '''
+            In [99]: probs = [hypergeom.pmf(x,100,5,10) for x in range(0,6)]
+            In [100]: probs
+            Out[100]: 
+            [0.58375236692612187,
+             0.33939091100357333,
+             0.070218809173150043,
+             0.006383528106649855,
+             0.00025103762217164457,
+             3.3471682956218215e-06]
+            In [103]: 1-sum(probs[0:3]) 
+            # Get the probs of drawing 3 or more
+            Out[103]: 0.006637912897154763
+            # Remember slicing is exclusive for the end value
+            In [105]: hypergeom.sf(3,100,5,10)
+            # That aint right
+            Out[105]: 0.00025438479046726637
+            In [106]: hypergeom.sf(3-1,100,5,10)
+            # See? You wnat num_common - 1
+            Out[106]: 0.0066379128971171221
+            # can we go back to drinking coffee now?
+        '''
+        pvals = hypergeom.sf(
+            num_common-1,num_universe,term_sizes[terms],num_sampled[rows]
         )
-        significant_terms = []
-        for term in terms:
-            term_genes = set(term.loci)
-            #if len(term_genes) > max_term_size:
-            #    continue
-            num_common = len(term_genes.intersection(locus_list))
-            num_in_term = len(term_genes)
-            num_sampled = len(locus_list)
-            # the reason this is num_common - 1 is because we are looking for 1 - cdf
-            # and we need to greater than OR EQUAL TO num_common
-            # Look. Do this in ipython:
-            '''
-                In [99]: probs = [hypergeom.pmf(x,100,5,10) for x in range(0,6)]
-                In [100]: probs
-                Out[100]: 
-                [0.58375236692612187,
-                 0.33939091100357333,
-                 0.070218809173150043,
-                 0.006383528106649855,
-                 0.00025103762217164457,
-                 3.3471682956218215e-06]
-                In [103]: 1-sum(probs[0:3]) 
-                # Get the probs of drawing 3 or more
-                Out[103]: 0.006637912897154763
-                # Remember slicing is exclusive for the end value
-                In [105]: hypergeom.sf(3,100,5,10)
-                # That aint right
-                Out[105]: 0.00025438479046726637
-                In [106]: hypergeom.sf(3-1,100,5,10)
-                # See? You wnat num_common - 1
-                Out[106]: 0.0066379128971171221
-                # can we go back to drinking coffee now?
-            '''
-            pval = hypergeom.sf(num_common-1,num_universe,num_in_term,num_sampled)
-            if pval <= pval_cutoff and num_common >= min_overlap:
-                term.attrs['hyper'] = OrderedDict([
-                    ('source'           , self.name),
-                    ('pval'             , pval),
-                    ('terms_tested'     , len(terms)),
-                    ('num_common'       , num_common),
-                    ('num_universe'     , num_universe),
-                    ('source_term_size' , num_in_term),
-                    ('target_term_size' , len(locus_list)),
-                    ('num_terms'        , len(self)),
-                    #('num_sampled'      , num_sampled)
-                ])
-                if label != None:
-                    term.attrs['hyper']['label'] = label
-                if bonferroni_correction == True:
-                    # Right now this isn't true bonferroni, its only correcting for
-                    # the number of terms that had term genes in it
-                    if pval > pval_cutoff / len(terms):
-                        term.attrs['hyper']['bonferroni'] = False
-                    else:
-                        term.attrs['hyper']['bonferroni'] = True
-                term.attrs['pval'] = pval
-                if include_genes == True:
-                    term.attrs['hyper']['genes'] = ",".join(
-                        [x.id for x in term_genes.intersection(locus_list)]
-                    )
-                significant_terms.append(term)
-        self.log('\t\tFound {} was significant for {} terms',label,len(significant_terms))
+        significant = (pvals <= pval_cutoff) & (num_common >= min_overlap)
+        num_terms = len(self)
+        results = [[] for _ in range(query.shape[0])]
+        for row,col,common,pval in zip(rows[significant],terms[significant],
+                                       num_common[significant],pvals[significant]):
+            # return a new copy of each 
+            term = copy.copy(self[term_ids[col]])
+            term.attrs = dict(term.attrs)
+            term.attrs['hyper'] = OrderedDict([
+                ('source'           , self.name),
+                ('pval'             , float(pval)),
+                ('terms_tested'     , int(num_tested[row])),
+                ('num_common'       , int(common)),
+                ('num_universe'     , num_universe),
+                ('source_term_size' , int(term_sizes[col])),
+                ('target_term_size' , int(num_sampled[row])),
+                ('num_terms'        , num_terms),
+            ])
+            if labels[row] != None:
+                term.attrs['hyper']['label'] = labels[row]
+            if bonferroni_correction == True:
+                # Right now this isn't true bonferroni, its only correcting for
+                # the number of terms that had term genes in it
+                if pval > pval_cutoff / num_tested[row]:
+                    term.attrs['hyper']['bonferroni'] = False
+                else:
+                    term.attrs['hyper']['bonferroni'] = True
+            term.attrs['pval'] = float(pval)
+            if include_genes == True:
+                common_loci = numpy.intersect1d(
+                    matrix[col].indices,query[row].indices
+                )
+                term.attrs['hyper']['genes'] = ",".join(locus_ids[common_loci])
+            results[row].append(term)
+        if not isinstance(locus_list,co.Ontology):
+            self.log(
+                '{}: Loci occur in {} terms, containing {} genes'.format(
+                    label,num_tested[0], num_universe
+                )
+            )
+            self.log('\t\tFound {} was significant for {} terms',label,len(results[0]))
         if return_table == True:
-            tbl = []
-            for x in significant_terms:
-                val = OrderedDict([
-                    ('name', x.name),
-                    ('id'  , x.id)
-                ])
-                val.update(x.attrs['hyper'])
-                val.update(x.attrs)
-                del val['hyper']
-                tbl.append(val)
-            tbl = DataFrame.from_records(tbl)
-            #if label != None:
-            #    tbl['label'] = label
-            if len(tbl) > 0:
-                tbl = tbl.sort_values(by='pval')
-            return tbl
+            results = [self._enrichment_table(x) for x in results]
         else:
-            return sorted(significant_terms,key=lambda x: x.attrs['pval'])
-
-
+            results = [sorted(x,key=lambda x: x.attrs['pval']) for x in results]
+        if isinstance(locus_list,co.Ontology):
+            if return_table:
+                return pd.concat(results)
+            return results
+        return results[0]
 
+    @staticmethod
+    def _enrichment_table(significant_terms):
+        '''
+            Converts a list of significant terms from enrichment
+            into a DataFrame sorted by pval.
+        '''
+        tbl = []
+        for x in significant_terms:
+            val = OrderedDict([
+                ('name', x.name),
+                ('id'  , x.id)
+            ])
+            val.update(x.attrs['hyper'])
+            val.update(x.attrs)
+            del val['hyper']
+            tbl.append(val)
+        tbl = DataFrame.from_records(tbl)
+        if len(tbl) > 0:
+            tbl = tbl.sort_values(by='pval')
+        return tbl
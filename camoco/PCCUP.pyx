@@ -15,8 +15,14 @@ cdef extern from "numpy/npy_math.h" nogil:
 #    bint isnan(double x)
 #    double sqrt(double x)
 
-# input is a typed numpy memoryview (::1 means c contiguous array)
-def pair_correlation(double[:, ::1] x):
+ctypedef fused expr_t:
+    float
+    double
+
+# input is a typed numpy memoryview (::1 means c contiguous array),
+# both float and double expression matrices are accepted so float32
+# data does not need to be converted first
+def pair_correlation(const expr_t[:, ::1] x):
     # Define a new memoryview on an empty gene X gene matrix
     cdef float[::1] pccs = np.empty(comb(x.shape[0],2,exact=True)).astype('float32')
     cdef float u, v
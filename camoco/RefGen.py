@@ -8,7 +8,7 @@ from .Camoco import Camoco
 from .Locus import Gene,Locus
 from .Chrom import Chrom
 from .Genome import Genome
-from .Tools import memoize,rawFile
+from .Tools import memoize,rawFile,random_state,chunks
 from .Exceptions import CamocoZeroWindowError
 
 import itertools
@@ -29,6 +29,8 @@ class RefGen(Camoco):
         super().__init__(name,type="RefGen")
         self._create_tables()
         self._build_indices()
+        # In memory gene positions, see _gene_positions()
+        self._gene_position_cache = None
 
     @property
     def genome(self):
@@ -102,7 +104,7 @@ class RefGen(Camoco):
         '''
         return [x for x in gene_list if x in self]
 
-    def random_genes(self,n,**kwargs):
+    def random_genes(self,n,seed=None,return_table=False,**kwargs):
         '''
             Return random genes from the RefGen, without replacement.
 
@@ -110,6 +112,11 @@ class RefGen(Camoco):
             ----------
             n : int
 
+            seed : int or numpy.random.RandomState (default: None)
+                Seed used for reproducible sampling.
+            return_table : bool (default: False)
+                If True, return a Pandas table (DataFrame) of gene
+                positions instead of building Gene objects.
             **kwargs : key,value pairs
                 Extra parameters passed onto the locus init method
 
@@ -118,13 +125,44 @@ class RefGen(Camoco):
             An iterable containing n (unique) random genes
 
         '''
-        rand_nums = np.random.choice(self.num_genes()+1,n,replace=False)
-        gene_info = self.db.cursor().executemany(
-                "SELECT chromosome,start,end,id from genes WHERE rowid = ?",
-                [[int(rownum)] for rownum in rand_nums]
-        )
+        rng = random_state(seed)
+        positions = self._gene_positions()
+        rand_nums = rng.choice(len(positions),n,replace=False)
+        genes = positions.iloc[rand_nums][['chrom','start','end']]
+        if return_table == True:
+            return genes
         return set([Gene(chr,start,end=end,id=id,**kwargs) for \
-            (chr,start,end,id) in gene_info])
+            (id,chr,start,end) in genes.itertuples()])
+
+    def _gene_positions(self):
+        '''
+            Returns the positions of all genes in the RefGen
+            in genome order (sorted by chromosome then start).
+            The table is read with a single scan of the genes
+            table and cached on the instance. The cache is reset
+            when genes are added.
+
+            Returns
+            -------
+            A pandas DataFrame indexed by gene id with chrom,
+            start, end and chrom_code columns. chrom_code is an
+            integer code for the chromosome, genes on the same
+            chromosome are contiguous in the table.
+        '''
+        if self._gene_position_cache is None:
+            positions = pd.DataFrame(
+                self.db.cursor().execute('''
+                    SELECT id,chromosome,start,end FROM genes
+                ''').fetchall(),
+                columns=['id','chrom','start','end']
+            )
+            positions = positions.sort_values(by=['chrom','start'])
+            positions = positions.set_index('id')
+            positions['start'] = positions.start.astype(np.int64)
+            positions['end'] = positions.end.astype(np.int64)
+            positions['chrom_code'] = pd.factorize(positions.chrom)[0]
+            self._gene_position_cache = positions
+        return self._gene_position_cache
 
     def iter_chromosomes(self):
         ''' returns chrom object iterator '''
@@ -201,16 +239,79 @@ class RefGen(Camoco):
                 'or slicing syntax instead.'
             )
             return self.from_id(gene_ids,**kwargs)
-        genes = []
-        for id in gene_ids:
-            try:
-                genes.append(self.from_id(id,**kwargs))
-            except ValueError as e: 
-                if check_shape == False:
-                    continue
-                else:
-                    raise e
-        return genes
+        gene_ids = list(gene_ids)
+        # Resolve everything in bulk instead of one query per gene
+        resolved = self._resolve_ids(gene_ids)
+        attrs = self._gene_attrs(set(resolved.values()))
+        if check_shape == True:
+            for id in gene_ids:
+                if id not in resolved:
+                    raise ValueError('{} not in {}'.format(id,self.name))
+        found = [resolved[id] for id in gene_ids if id in resolved]
+        positions = self._gene_positions()
+        rows = positions.index.get_indexer(found)
+        return [
+            Gene(chrom,int(start),int(end),gene_id,
+                build=self.build,organism=self.organism,**kwargs
+            ).update(attrs.get(gene_id,{})) \
+            for gene_id,chrom,start,end in zip(
+                found,
+                positions.chrom.values[rows],
+                positions.start.values[rows],
+                positions.end.values[rows]
+            )
+        ]
+
+    def _resolve_ids(self, gene_ids):
+        '''
+            Maps gene ids (or gene aliases) onto the ids stored in
+            the genes table using the cached gene positions and
+            a batched alias lookup.
+
+            Parameters
+            ----------
+            gene_ids : iterable of str
+                The ids or aliases to resolve
+
+            Returns
+            -------
+            A dict mapping each resolvable id to its gene id.
+            Ids that cannot be resolved are left out.
+        '''
+        positions = self._gene_positions()
+        resolved = {}
+        missing = []
+        for id in set(gene_ids):
+            if id.upper() in positions.index:
+                resolved[id] = id.upper()
+            else:
+                missing.append(id)
+        cur = self.db.cursor()
+        for chunk in chunks(missing):
+            for alias,id in cur.execute('''
+                SELECT alias,id FROM aliases WHERE alias IN ({})
+                '''.format(','.join('?'*len(chunk))),chunk):
+                if id.upper() in positions.index:
+                    resolved[alias] = id.upper()
+        return resolved
+
+    def _gene_attrs(self, gene_ids):
+        '''
+            Fetches the stored attributes for a set of genes
+            using batched queries.
+
+            Returns
+            -------
+            A dict of dicts: gene id -> {key:val}
+        '''
+        attrs = {}
+        cur = self.db.cursor()
+        for chunk in chunks(gene_ids):
+            for id,key,val in cur.execute('''
+                SELECT id,key,val FROM gene_attrs WHERE id IN ({})
+                '''.format(','.join('?'*len(chunk))),chunk):
+                attrs.setdefault(id,{})[key] = val
+        return attrs
 
     # NOTE: Dont LRU cache this, it gets cached in from_id
     def __getitem__(self,item):
@@ -565,8 +666,141 @@ class RefGen(Camoco):
                     genes = list(set(itertools.chain(*genes)))
             return genes
 
+    def candidate_gene_counts(self, loci, flank_limit=2, window_size=None):
+        '''
+            Returns the number of candidate genes for each locus
+            without building any Gene objects. The counts are
+            the same as len(candidate_genes(locus)) but are computed
+            with a binary search over the in memory gene positions.
+
+            Parameters
+            ----------
+            loci : iterable of camoco.Locus
+                The loci to count candidates for.
+            flank_limit : int (default : 2)
+                The total number of flanking genes **on each side**
+                considered a candidate surrounding a locus
+            window_size : int (default: None)
+                Optional window size, see candidate_genes.
+
+            Returns
+            -------
+            A numpy array of candidate counts, in the same
+            order as loci.
+        '''
+        loci = list(loci)
+        counts = np.zeros(len(loci),dtype=np.int64)
+        if window_size is None:
+            for locus in loci:
+                if locus.window == 0:
+                    raise CamocoZeroWindowError(
+                        'Asking for upstream genes for {} and no window size.',
+                        locus.id
+                    )
+        positions = self._gene_positions()
+        flank_limit = int(flank_limit)
+        loci_chroms = np.array([str(x.chrom) for x in loci])
+        for chrom,genes in positions.groupby('chrom',sort=False):
+            (i,) = np.nonzero(loci_chroms == chrom)
+            if len(i) == 0:
+                continue
+            starts = genes.start.values
+            locus_start = np.array([loci[x].start for x in i])
+            locus_end = np.array([loci[x].end for x in i])
+            if window_size is not None:
+                upstream = locus_start - window_size
+                downstream = locus_end + window_size
+            else:
+                upstream = np.array([loci[x].upstream for x in i])
+                downstream = np.array([loci[x].downstream for x in i])
+            # Genes that START within the locus
+            within_start = np.searchsorted(starts,locus_start,side='left')
+            within_end = np.searchsorted(starts,locus_end,side='right')
+            # Flanking genes that start within the window
+            num_up = within_start - np.searchsorted(starts,upstream,side='left')
+            num_down = np.searchsorted(starts,downstream,side='right') - within_end
+            counts[i] = (
+                (within_end - within_start)
+                + np.minimum(num_up,flank_limit)
+                + np.minimum(num_down,flank_limit)
+            )
+        return counts
+
+    def random_gene_blocks(self, sizes, num_bootstraps=None, seed=None,
+        max_iter=1000):
+        '''
+            Samples random blocks of contiguous genes. Each block lies
+            on a single chromosome and, within a bootstrap, blocks never
+            overlap. Blocks are drawn for all sizes at once, blocks
+            running off the end of a chromosome or overlapping another
+            block are rejected and redrawn together.
+
+            Parameters
+            ----------
+            sizes : iterable of int
+                The number of genes in each block. Blocks of size 0
+                are not sampled.
+            num_bootstraps : int (default: None)
+                If specified, sample this many independent sets
+                of blocks at once.
+            seed : int or numpy.random.RandomState (default: None)
+                Seed used for reproducible sampling.
+            max_iter : int (default: 1000)
+                Give up if blocks cannot be placed after this many
+                rounds of rejection.
+
+            Returns
+            -------
+            An array of block start positions (rows in genome order,
+            see _gene_positions), -1 for empty blocks. The array has
+            shape (len(sizes),) or (num_bootstraps,len(sizes)).
+        '''
+        rng = random_state(seed)
+        sizes = np.asarray(sizes,dtype=np.int64)
+        num_reps = 1 if num_bootstraps is None else int(num_bootstraps)
+        codes = self._gene_positions().chrom_code.values
+        # The number of genes left on the chromosome from each position
+        room = np.searchsorted(codes,codes,side='right') - np.arange(len(codes))
+        if len(sizes) > 0 and sizes.max() > 0 and \
+            (len(room) == 0 or sizes.max() > room.max()):
+            raise ValueError(
+                'Cannot sample a block of {} genes from {}'.format(
+                    sizes.max(),self.name
+                )
+            )
+        sizes = np.broadcast_to(sizes,(num_reps,len(sizes)))
+        starts = np.full(sizes.shape,-1,dtype=np.int64)
+        for _ in range(max_iter):
+            todo = (starts < 0) & (sizes > 0)
+            if not todo.any():
+                break
+            draws = rng.randint(0,len(codes),size=todo.sum())
+            # Blocks cannot run off the end of a chromosome
+            starts[todo] = np.where(room[draws] >= sizes[todo],draws,-1)
+            # Reject blocks which overlap a block starting before it
+            placed = starts >= 0
+            order = np.argsort(np.where(placed,starts,len(codes)),axis=1)
+            sorted_starts = np.take_along_axis(starts,order,axis=1)
+            sorted_ends = sorted_starts + np.take_along_axis(sizes,order,axis=1)
+            sorted_placed = np.take_along_axis(placed,order,axis=1)
+            overlap = np.zeros(sizes.shape,dtype=bool)
+            overlap[:,1:] = sorted_placed[:,1:] & (
+                sorted_starts[:,1:] < np.maximum.accumulate(sorted_ends,axis=1)[:,:-1]
+            )
+            rejected = np.zeros(sizes.shape,dtype=bool)
+            np.put_along_axis(rejected,order,overlap,axis=1)
+            starts[rejected] = -1
+        else:
+            raise ValueError(
+                'Could not place non-overlapping blocks in {} iterations'.format(max_iter)
+            )
+        if num_bootstraps is None:
+            return starts[0]
+        return starts
+
     def bootstrap_candidate_genes(self, loci, flank_limit=2,
-        chain=True, window_size=None, include_parent_locus=False):
+        chain=True, window_size=None, include_parent_locus=False,
+        num_bootstraps=None, seed=None):
         '''
             Returns candidate genes which are random, but conserves
             total number of overall genes.
@@ -584,109 +818,108 @@ class RefGen(Camoco):
                 Optional parameter which will update candidate genes
                 'attr' attribute with the id of the parent locus
                 which contains it.
+            num_bootstraps : int (default: None)
+                If specified, generate this many bootstraps at once
+                and return a list containing the result for each.
+            seed : int or numpy.random.RandomState (default: None)
+                Seed used for reproducible bootstraps.
 
             Returns
             -------
             a list of candidate genes (or list of lists if chain is False)
 
         '''
-        if isinstance(loci,Locus):
-            # We now have a single locus
-            locus = loci
-            # grab the actual candidate genes
-            num_candidates = len(
-                self.candidate_genes(
-                    locus, flank_limit=flank_limit,
-                    chain=True, window_size=window_size
-                )
-            )
-            if num_candidates == 0:
-                return []
-            # Snps a random genes from the genome
-            random_gene = self.random_gene()
-            # Snag the same number of candidates
-            random_candidates = self.upstream_genes(
-                random_gene,
-                gene_limit=num_candidates,
-                window_size=10e100
-            )
-            if len(random_candidates) != num_candidates: #C
-                # somehow we hit the end of a chromosome
-                # or something, just recurse
-                random_candidates = self.bootstrap_candidate_genes(
-                    locus,flank_limit=flank_limit,chain=True
-                )
-            if include_parent_locus == True: #C
-                for gene in random_candidates:
-                    gene.update({'parent_locus':random_gene.id})
-            return random_candidates
+        single_locus = isinstance(loci,Locus)
+        if single_locus:
+            locus_list = [loci]
         else:
-            # Sort the loci so we can collapse down
+            # Sort the loci so the order matches candidate_genes
             locus_list = sorted(loci)
-            seen = set()
-            bootstraps = list()
-            target = self.candidate_genes(
-                locus_list,flank_limit=flank_limit,
-                chain=False,window_size=window_size
-            )
-            target_accumulator = 0
-            candidate_accumulator = 0
-            #self.log('target: {}, loci: {}',len(target),len(locus_list))
-            for i,(locus,targ) in enumerate(zip(locus_list,target)):
-                # compare downstream of last locus to current locus
-                candidates = self.bootstrap_candidate_genes(
-                    locus, flank_limit=flank_limit,
-                    chain=True, window_size=window_size,
-                    include_parent_locus=include_parent_locus
-                )
-                # If genes randomly overlap, resample
-                while len(seen.intersection(candidates)) > 0: #C
-                    candidates = self.bootstrap_candidate_genes(
-                        locus, flank_limit=flank_limit,
-                        window_size=window_size, chain=True,
-                        include_parent_locus=include_parent_locus
-                    )
-                # Add all new bootstrapped genes to the seen list
-                seen |= set(candidates)
-                bootstraps.append(candidates)
-            if chain: #C
-                bootstraps = list(seen)
-            #self.log("Found {} bootstraps",len(bootstraps))
-            return bootstraps
-
-
-    def pairwise_distance(self, gene_list=None): #pragma: no cover
+        num_candidates = self.candidate_gene_counts(
+            locus_list,flank_limit=flank_limit,window_size=window_size
+        )
+        starts = self.random_gene_blocks(
+            num_candidates,num_bootstraps=num_bootstraps,seed=seed
+        )
+        positions = self._gene_positions()
+        bootstraps = list()
+        for rep_starts in np.atleast_2d(starts):
+            random_candidates = list()
+            for start,size in zip(rep_starts,num_candidates):
+                block = [
+                    self.Gene(chrom,gstart,gend,id,
+                              build=self.build,organism=self.organism)
+                    for id,chrom,gstart,gend in positions.iloc[start:start+size][
+                        ['chrom','start','end']
+                    ].itertuples()
+                ] if size > 0 else []
+                if include_parent_locus == True: #C
+                    for gene in block:
+                        gene.update({'parent_locus':block[0].id})
+                random_candidates.append(block)
+            if single_locus:
+                random_candidates = random_candidates[0]
+            elif chain: #C
+                random_candidates = list(itertools.chain(*random_candidates))
+            bootstraps.append(random_candidates)
+        if num_bootstraps is None:
+            return bootstraps[0]
+        return bootstraps
+
+
+    def pairwise_distance(self, gene_list=None, dtype='float32', out=None,
+        block_size=2**24): #pragma: no cover
         '''
             returns a vector containing the pairwise distances between genes
             in gene_list in vector form. See np.squareform for matrix
-            conversion.
+            conversion. Distances between genes on different chromosomes
+            are inf (or RefGenDist.TRANS_DISTANCE_INT32 if dtype is int32).
+
+            Parameters
+            ----------
+            gene_list : iterable of co.Locus or gene ids (default: None)
+                The genes to calculate distances between, the distance
+                vector is in the same order as the genes. If None, all
+                genes in the RefGen (sorted by id) are used.
+            dtype : str (default: float32)
+                Either float32 or int32, the int32 encoding halves the
+                size of the output.
+            out : object with an append method (default: None)
+                If specified, the distances are calculated in blocks
+                and appended to out (e.g. an on disk bcolz carray)
+                instead of returning the full vector.
+            block_size : int (default: 2**24)
+                The number of distances calculated per block.
+
+            Returns
+            -------
+            A numpy array of distances, or out if it was specified.
         '''
+        positions = self._gene_positions()
         if gene_list is None: #C
-            gene_list = list(self.iter_genes())
-        query = '''
-                SELECT genes.id, chrom.rowid, start, end FROM genes
-                LEFT JOIN chromosomes chrom ON genes.chromosome = chrom.id
-                WHERE genes.id in ("{}")
-                ORDER BY genes.id
-        '''.format('","'.join([g.id for g in gene_list]))
-        # extract chromosome row ids and gene start positions for each gene
-        positions = pd.DataFrame(
-            # Grab the chromosomes rowid because its numeric
-            self.db.cursor().execute(query).fetchall(),
-            columns=['gene','chrom','start','end']
-        ).sort_values(by='gene')
-        # chromosome needs to be floats
-        positions.chrom = positions.chrom.astype('float')
-        # Do a couple of checks
-        assert len(positions) == len(gene_list), \
+            gene_ids = sorted(positions.index)
+        else:
+            gene_ids = [g.id.upper() if isinstance(g,Locus) else str(g).upper() \
+                        for g in gene_list]
+        positions = positions.reindex(gene_ids)
+        assert not positions.chrom.isnull().any(), \
             'Some genes in dataset not if RefGen'
-        assert all(positions.gene == [g.id for g in gene_list]), \
-            'Genes are not in the correct order!'
-        distances = RefGenDist.gene_distances(
-            positions.chrom.values,
+        blocks = RefGenDist.distance_blocks(
+            positions.chrom_code.values,
             positions.start.values,
-            positions.end.values
+            positions.end.values,
+            dtype=dtype,
+            block_size=block_size
         )
+        if out is not None:
+            for block in blocks:
+                out.append(block)
+            return out
+        distances = np.empty(len(gene_ids)*(len(gene_ids)-1)//2,dtype=dtype)
+        offset = 0
+        for block in blocks:
+            distances[offset:offset+len(block)] = block
+            offset += len(block)
         return distances
 
     def summary(self): #C
@@ -837,6 +1070,8 @@ class RefGen(Camoco):
         ''')
 
     def add_gene(self,gene,refgen=None):
+        # Genes are changing, reset the in memory positions
+        self._gene_position_cache = None
         if isinstance(gene,Locus): #C
             self.db.cursor().execute('''
             INSERT OR REPLACE INTO genes VALUES (?,?,?,?)
@@ -1,26 +1,159 @@
 import numpy as np
-from scipy.misc import comb
+cimport numpy as np
+
+cimport cython
+
+from libc.math cimport INFINITY
+from libc.stdint cimport INT32_MAX
+
+# Distances between genes on different chromosomes (or on an
+# unknown chromosome) are reported as +inf in float32 output and
+# as this sentinel in int32 output. The sentinel is larger than any
+# real distance so min_distance style filters treat both the same.
+TRANS_DISTANCE_INT32 = INT32_MAX
+
+ctypedef fused distance_t:
+    float
+    np.int32_t
 
 def gene_distances(double[:] chr, long[:] start, long[:] end):
-    # Create an array to put the results in
-    cdef float[:] distances = np.empty(comb(chr.shape[0],2,exact=True)).astype('float32')
-    # to remember which permutation we are one
-    cdef long i, j, index
-
-    print("Calculating for {} genes".format(len(chr)))
-
-    # Loop through genes and calcualate distances
-    index = 0
-    for i in range(chr.shape[0]):
-        for j in range(i+1,chr.shape[0]):
-            # We Cant compare genes on different chromosomes
-            if chr[i] != chr[j]:
-                distances[index] = np.inf 
-            elif start[i] < start[j]: # i is upstream of j
-                distances[index] = np.float32(start[j] - end[i])
-            else: # i is upstream of j
-                distances[index] = np.float32(start[i] - end[j])
-            index += 1
-    assert index == len(distances)
-    return distances.base
+    '''
+        Returns the pairwise distances between genes in long
+        (condensed) form. Kept for backwards compatibility,
+        see distance_blocks.
+    '''
+    return np.concatenate(list(distance_blocks(
+        np.asarray(chr).astype(np.int32),
+        np.asarray(start),
+        np.asarray(end)
+    )) or [np.empty(0,dtype='float32')])
+
+def pair_distances(chrom, start, end, i, j):
+    '''
+        Calculates the distances between specific pairs of genes,
+        using the same conventions as distance_blocks (float32 output,
+        trans distances are inf).
+
+        Parameters
+        ----------
+        chrom, start, end : arrays of ints
+            Gene coordinates, see distance_blocks
+        i, j : arrays of ints
+            The indices of the two genes in each pair
+
+        Returns
+        -------
+        A float32 numpy array of distances, one for each pair
+    '''
+    chrom = np.asarray(chrom)
+    start = np.asarray(start,dtype=np.int64)
+    end = np.asarray(end,dtype=np.int64)
+    distances = np.where(
+        start[i] < start[j], # i is upstream of j
+        start[j] - end[i],
+        start[i] - end[j]
+    ).astype('float32')
+    distances[(chrom[i] != chrom[j]) | (chrom[i] < 0)] = np.inf
+    return distances
+
+def distance_blocks(chrom, start, end, dtype='float32', block_size=2**24):
+    '''
+        Calculates the pairwise distances between genes in long
+        (condensed) form, i.e. the same order as the coex table,
+        yielding the result in consecutive blocks so the full vector
+        never has to be held in memory.
+
+        Parameters
+        ----------
+        chrom : array of ints
+            An integer code for the chromosome of each gene. Genes
+            with a negative code are treated as being on their own
+            chromosome.
+        start : array of ints
+            The gene start positions
+        end : array of ints
+            The gene end positions
+        dtype : str (default: float32)
+            Either float32 (trans distances are inf) or int32 (trans
+            distances are TRANS_DISTANCE_INT32).
+        block_size : int (default: 2**24)
+            The approximate number of distances in each block.
+
+        Yields
+        ------
+        numpy arrays containing consecutive blocks of the distance vector
+    '''
+    cdef np.int32_t[::1] chrom_v = np.ascontiguousarray(chrom,dtype=np.int32)
+    cdef np.int64_t[::1] start_v = np.ascontiguousarray(start,dtype=np.int64)
+    cdef np.int64_t[::1] end_v = np.ascontiguousarray(end,dtype=np.int64)
+    cdef Py_ssize_t n = chrom_v.shape[0]
+    cdef Py_ssize_t row_start, row_stop, num_pairs
+    if dtype not in ('float32','int32'):
+        raise ValueError('dtype must be float32 or int32')
+    # Sort genes by chromosome (stable, so genes within a chromosome
+    # stay in their original order). Each row then only visits the
+    # genes on its own chromosome, everything else is a trans pair.
+    chrom_arr = np.asarray(chrom_v)
+    order = np.argsort(chrom_arr,kind='mergesort').astype(np.int64)
+    rank = np.empty(n,dtype=np.int64)
+    rank[order] = np.arange(n)
+    chrom_stop = np.searchsorted(chrom_arr[order],chrom_arr,side='right')
+    chrom_stop = chrom_stop.astype(np.int64)
+    row_start = 0
+    while row_start < n - 1:
+        # grab rows until the block is full
+        row_stop = row_start
+        num_pairs = 0
+        while row_stop < n - 1 and (num_pairs == 0 or
+                num_pairs + (n - row_stop - 1) <= block_size):
+            num_pairs += n - row_stop - 1
+            row_stop += 1
+        out = np.empty(num_pairs,dtype=dtype)
+        # dispatches on the dtype of out
+        _distance_block(
+            chrom_v,start_v,end_v,order,rank,chrom_stop,
+            row_start,row_stop,out
+        )
+        yield out
+        row_start = row_stop
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _distance_block(np.int32_t[::1] chrom, np.int64_t[::1] start,
+        np.int64_t[::1] end, np.int64_t[::1] order, np.int64_t[::1] rank,
+        np.int64_t[::1] chrom_stop, Py_ssize_t row_start, Py_ssize_t row_stop,
+        distance_t[::1] out):
+    '''
+        Fills out with the distances for rows [row_start,row_stop)
+        of the condensed distance matrix.
+    '''
+    cdef Py_ssize_t n = chrom.shape[0]
+    cdef Py_ssize_t i, j, k, offset, row_offset
+    cdef np.int64_t d
+    cdef distance_t trans
+    if distance_t is float:
+        trans = INFINITY
+    else:
+        trans = INT32_MAX
+    with nogil:
+        offset = 0
+        for i in range(row_start,row_stop):
+            row_offset = offset
+            for k in range(n - i - 1):
+                out[row_offset + k] = trans
+            offset += n - i - 1
+            if chrom[i] < 0:
+                continue
+            for k in range(rank[i] + 1,chrom_stop[i]):
+                j = order[k]
+                if start[i] < start[j]: # i is upstream of j
+                    d = start[j] - end[i]
+                else: # j is upstream of i
+                    d = start[i] - end[j]
+                if distance_t is float:
+                    out[row_offset + j - i - 1] = <float>d
+                else:
+                    if d >= INT32_MAX:
+                        d = INT32_MAX - 1
+                    out[row_offset + j - i - 1] = <np.int32_t>d
+    return offset
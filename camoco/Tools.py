@@ -7,8 +7,9 @@ import glob
 import shutil
 
 from termcolor import colored, cprint
-from itertools import chain
+from itertools import chain,islice
 from collections import OrderedDict
+from contextlib import contextmanager
 
 from .Locus import Locus
 from .Config import cf
@@ -23,6 +24,11 @@ import statsmodels.api as sm
 
 import gzip
 import bz2
+import lzma
+import zipfile
+import resource
+import fcntl
+import threading
 
 def mean_confidence_interval(data): # pragma no cover
     '''
@@ -153,6 +159,109 @@ class rawFile(object): # pragma no cover
     def __exit__(self,type,value,traceback): # pragma no cover
         self.handle.close()
 
+def count_lines(filename, block_size=2**20): # pragma no cover
+    '''
+        Counts the lines in a (possibly gzip, bz2, xz or zip
+        compressed) file by streaming it in blocks. The compression
+        is taken from the extension, the same way pandas infers it.
+    '''
+    if filename.endswith('.gz'):
+        handle = gzip.open(filename,'rb')
+    elif filename.endswith('.bz2'):
+        handle = bz2.open(filename,'rb')
+    elif filename.endswith('.xz'):
+        handle = lzma.open(filename,'rb')
+    elif filename.endswith('.zip'):
+        # pandas reads the single file in the archive
+        with zipfile.ZipFile(filename) as archive:
+            handle = archive.open(archive.namelist()[0])
+    else:
+        handle = open(filename,'rb')
+    lines = 0
+    last = b'\n'
+    with handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    # count a last line without a trailing newline
+    if last != b'\n':
+        lines += 1
+    return lines
+
+def read_expr_table(filename, sep='\t', index_col=None, dtype='float32',
+                    chunksize=5000, first_chunk=None): # pragma no cover
+    '''
+        Reads an expression table (genes as rows, accessions as
+        columns) in chunks, parsing each chunk straight into a
+        preallocated matrix. Only one chunk of parsed text is
+        held in memory at a time.
+
+        Parameters
+        ----------
+        filename : str (path)
+            The table to read, can be compressed with any
+            method pandas infers from the extension
+        sep : str (default: \\t)
+            The column delimiter
+        index_col : str or int (default: None)
+            The column containing gene names, passed on to
+            pandas.read_table
+        dtype : str (default: float32)
+            The dtype of the resulting matrix
+        chunksize : int (default: 5000)
+            The number of rows parsed at a time
+        first_chunk : callable (default: None)
+            If not None, this is called with the first chunk (a
+            DataFrame) before the rest of the file is read. This
+            can be used to check the table looks right, e.g. that
+            the separator is correct, by raising an exception.
+
+        Returns
+        -------
+        A DataFrame backed by a single C-contiguous array
+    '''
+    # The number of lines is an upper bound on the number
+    # of rows (the header and blank lines are not rows)
+    max_rows = max(count_lines(filename) - 1, 0)
+    log('Reading {} rows from {}', max_rows, filename)
+    reader = pd.read_table(
+        filename,
+        sep=sep,
+        index_col=index_col,
+        compression='infer',
+        chunksize=chunksize
+    )
+    values = None
+    index = []
+    num_rows = 0
+    for i,chunk in enumerate(reader):
+        if i == 0:
+            if first_chunk is not None:
+                first_chunk(chunk)
+            columns = chunk.columns
+            values = np.empty((max_rows,len(columns)),dtype=dtype)
+        if num_rows + len(chunk) > len(values):
+            # The line count was too small (e.g. a compression
+            # count_lines does not know about), grow the matrix
+            values = np.concatenate([
+                values[0:num_rows],
+                np.empty((max(num_rows,len(chunk)),len(columns)),dtype=dtype)
+            ])
+        values[num_rows:num_rows+len(chunk)] = chunk.values
+        index.append(chunk.index.values)
+        num_rows += len(chunk)
+        log('Read {} of {} rows ({:.0f}%)', 
+            num_rows, max_rows, 100*num_rows/max(max_rows,1)
+        )
+    if values is None:
+        raise ValueError('{} does not contain any rows'.format(filename))
+    return pd.DataFrame(
+        values[0:num_rows],
+        index=np.concatenate(index),
+        columns=columns,
+        copy=False
+    )
+
 
 def redescribe_dataset(type,name,new_desc): # pragma no cover
     c = co.Camoco("Camoco")
@@ -177,6 +286,86 @@ def memoize(obj): # pragma no cover
     return memoizer
 
 
+def random_state(seed=None): # pragma no cover
+    '''
+        Returns a source of random numbers. Passing in a seed
+        gives a reproducible numpy RandomState stream, passing in
+        an existing RandomState returns it unchanged so it can
+        be threaded through several calls. If seed is None, the
+        global numpy random module is used (so np.random.seed
+        still applies).
+    '''
+    if seed is None:
+        return np.random
+    if isinstance(seed,np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+def chunks(items, size=999): # pragma no cover
+    '''
+        Splits items into lists of at most size elements. The
+        default is the maximum number of host parameters sqlite
+        allows in a single statement, so each chunk can be passed
+        straight into an 'IN (?,?,...)' clause. Items can be any
+        iterable (including generators), only one chunk is held
+        in memory at a time.
+    '''
+    items = iter(items)
+    while True:
+        chunk = list(islice(items,size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def peak_memory(): # pragma no cover
+    '''
+        Returns the peak resident memory of the current process
+        in MB (see resource.getrusage).
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes on OSX, kilobytes elsewhere
+        peak = peak / 1024
+    return peak / 1024
+
+# Serializes the threads of this process taking the same file lock
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+# Number of times each file lock is held by the current thread
+_held_locks = threading.local()
+
+@contextmanager
+def file_lock(filename): # pragma no cover
+    '''
+        Holds an exclusive lock on filename (which is created if
+        needed) for the duration of a with block. Other processes,
+        and other threads of this one, trying to take the lock wait
+        until it is released. The lock is reentrant: taking it again
+        in the thread that holds it does not block.
+    '''
+    filename = os.path.abspath(filename)
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(filename, threading.RLock())
+    if not hasattr(_held_locks, 'depth'):
+        _held_locks.depth = {}
+    depth = _held_locks.depth
+    with thread_lock:
+        if depth.get(filename, 0) > 0:
+            depth[filename] += 1
+            try:
+                yield
+            finally:
+                depth[filename] -= 1
+            return
+        with open(filename, 'a') as LOCK:
+            fcntl.flock(LOCK, fcntl.LOCK_EX)
+            depth[filename] = 1
+            try:
+                yield
+            finally:
+                del depth[filename]
+                fcntl.flock(LOCK, fcntl.LOCK_UN)
+
 class log(object): # pragma no cover
     def __init__(self, msg=None, *args, color='green'): # pragma no cover
         if msg is not None and cf.logging.log_level == 'verbose':
@@ -211,7 +400,8 @@ def plot_flanking_vs_inter(cob): # pragma no cover
     log('Getting genes')
     genes = sorted(list(cob.refgen.iter_genes()))
     flanking = np.array([cob.coexpression(genes[i], genes[i-1]).score for i in  range(1, len(genes))])
-    inter = cob.coex[~np.isfinite(cob.coex.distance)].score.values
+    coex = cob._coex_DataFrame(sig_only=False)
+    inter = coex[~np.isfinite(coex.distance)].score.values
     log('Getting flanking KDE')
     # get the KDEs
     flanking_kde = sm.nonparametric.KDEUnivariate(flanking)
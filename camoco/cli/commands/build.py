@@ -1,26 +1,70 @@
 import camoco as co
 import pandas as pd
-from camoco.Tools import DummyRefGen,log,available_datasets
+import json
+from camoco.Tools import DummyRefGen,log,available_datasets,read_expr_table
 from camoco.Locus import Gene
 
 def build_cob(args):
-    try:
-        # Build the refgen
-        refgen = co.RefGen(args.refgen)
-        # Check that the sep is likely right.
-        if len(pd.read_table(args.filename,sep=args.sep).columns) == 1:
+    skip_stages = ['leaves'] if args.no_leaves else []
+    defer_stages = ['clusters'] if args.lazy_clusters else []
+    if args.resume and available_datasets('Expr',args.name):
+        # Pick up where the last build left off, the
+        # expression matrix was already processed
+        cob = co.COB(args.name)
+        manifest = cob._build_manifest()
+        if manifest is None or 'coexpression' not in manifest:
+            # The last build stopped before the network build started
+            # (e.g. during QC), the stored matrix may be half processed
             print(
+                ("Cannot resume {}, the last build did not finish processing "
+                "the expression matrix. Rebuild it without --resume.").format(
+                    args.name
+                )
+            )
+            return None
+        print('Resuming build, stage status: {}'.format(cob.build_status()))
+        cob = co.COB.from_Expr(
+            cob,
+            zscore_cutoff=args.zscore_cutoff,
+            resume=True,
+            skip_stages=skip_stages,
+            defer_stages=defer_stages
+        )
+        print(cob.summary())
+        return None
+    # Check that the sep is likely right as soon as the
+    # first chunk of the table has been read
+    def check_sep(chunk):
+        num_fields = len(chunk.columns)
+        if not isinstance(chunk.index, pd.RangeIndex):
+            num_fields += chunk.index.nlevels
+        if num_fields == 1:
+            raise ValueError(
                 ("Detected only 1 column in {}, are you sure "
                 "colunms are separated by '{}'?").format(args.filename,args.sep)
             )
-            return None
+    try:
+        # Stream the table in once, everything else uses this copy
+        df = read_expr_table(
+            args.filename,
+            sep=args.sep,
+            index_col=args.index_col,
+            dtype='float32' if args.float32 else 'float64',
+            first_chunk=check_sep
+        )
+    except ValueError as e:
+        print(e)
+        return None
+    try:
+        # Build the refgen
+        refgen = co.RefGen(args.refgen)
         if args.allow_non_membership:
             refgen = refgen.copy(
                 '{}_tmp'.format(refgen.name), 
                 'temp refgen'.format(refgen.name)
             )
             # Add non membership genes
-            for gid in pd.read_table(args.filename,sep=args.sep).index:
+            for gid in df.index:
                 refgen.add_gene(Gene(None,None,id=gid))
 
         quality_control = False if args.skip_quality_control else True
@@ -33,13 +77,12 @@ def build_cob(args):
             co.Tools.del_dataset('Expr',args.name,force=args.force)
             
         # Basically just pass all the CLI arguments to the COB class method  
-        cob = co.COB.from_table(
-            args.filename,
+        cob = co.COB.from_DataFrame(
+            df,
             args.name,
             args.description,
             refgen,
             # Optional arguments
-            sep=args.sep,
             rawtype=args.rawtype,
             # Data Processing
             quality_control=quality_control,
@@ -53,12 +96,32 @@ def build_cob(args):
             max_val=args.max_val,
             dry_run=args.dry_run,
             zscore_cutoff=args.zscore_cutoff,
-            index_col=args.index_col
+            float32=args.float32,
+            skip_stages=skip_stages,
+            defer_stages=defer_stages
         )
         print(cob.summary())
     except Exception as e:
-        print("Build failed. Rolling back: removing corrupted files...")
-        co.Tools.del_dataset('Expr',args.name,force=True)
+        # Keep the network around if some of the build stages
+        # finished so the build can be resumed
+        completed = []
+        if available_datasets('Expr',args.name):
+            # opening a COB can kick off calculations, 
+            # read the build manifest from the globals
+            manifest = co.Expr(args.name).build_manifest
+            if manifest is not None:
+                completed = [
+                    stage for stage,entry in json.loads(manifest).items()
+                    if entry['status'] == 'done'
+                ]
+        if len(completed) > 0:
+            print(
+                "Build failed after completing: {}. Rerun with "
+                "--resume to continue.".format(', '.join(completed))
+            )
+        else:
+            print("Build failed. Rolling back: removing corrupted files...")
+            co.Tools.del_dataset('Expr',args.name,force=True)
         raise e
 
 def build_refgen(args):
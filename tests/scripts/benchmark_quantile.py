@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+'''
+    Benchmarks quantile normalization of a random expression matrix.
+
+    The vectorized Expr._quantile_normalize is timed with and without
+    chunking and compared to the previous pandas implementation (which
+    is only run on matrices small enough to finish in reasonable time).
+
+    usage: benchmark_quantile.py [--genes N] [--accessions M] [--chunk-size C]
+'''
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from camoco.Expr import Expr
+
+
+def pandas_quantile(expr):
+    '''
+        The original, cell by cell, implementation of Expr._quantile
+    '''
+    expr_ranks = expr.rank(axis=0, method='first', na_option='keep')
+    expr_ranks = expr_ranks.apply(lambda col: col/np.nanmax(col.values), axis=0)
+    expr_sort = expr.apply(lambda col: Expr.inplace_nansort(col.values), axis=0)
+    rank_average = expr_sort.apply(np.nanmean, axis=1).values
+    rankmax = len(rank_average)
+    return expr_ranks.applymap(
+        lambda x : rank_average[int(x*rankmax)-1] if not np.isnan(x) else np.nan
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--genes', type=int, default=20000)
+    parser.add_argument('--accessions', type=int, default=500)
+    parser.add_argument('--missing', type=float, default=0.05)
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--max-reference-cells', type=int, default=2000000,
+        help='Skip the pandas reference for larger matrices')
+    args = parser.parse_args()
+
+    values = np.random.lognormal(size=(args.genes, args.accessions))
+    values[np.random.rand(*values.shape) < args.missing] = np.nan
+    print('{} genes x {} accessions'.format(*values.shape))
+
+    start = time.time()
+    quantiled,ties = Expr._quantile_normalize(values)
+    print('vectorized: {:.2f}s'.format(time.time()-start))
+
+    start = time.time()
+    chunked,ties = Expr._quantile_normalize(values, chunk_size=args.chunk_size)
+    print('vectorized (chunk_size={}): {:.2f}s'.format(
+        args.chunk_size, time.time()-start
+    ))
+    assert np.allclose(quantiled, chunked, equal_nan=True)
+
+    if values.size <= args.max_reference_cells:
+        start = time.time()
+        reference = pandas_quantile(pd.DataFrame(values))
+        print('pandas reference: {:.2f}s'.format(time.time()-start))
+        assert np.array_equal(reference.values, quantiled, equal_nan=True)
+    else:
+        print('pandas reference: skipped')
+
+
+if __name__ == '__main__':
+    main()
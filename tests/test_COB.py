@@ -3,7 +3,10 @@
 '''
 import camoco as co 
 from camoco import cf
+from camoco import Tools as tools
+from camoco.Exceptions import CamocoAccessionNameError
 
+import json
 import random
 import itertools
 from collections import Counter
@@ -15,7 +18,7 @@ from scipy.misc import comb
 
 def test_coordination_between_expr_and_expr_index(testCOB):
     for i,x in enumerate(testCOB._expr.index):
-        assert i == testCOB._expr_index[x]
+        assert i == testCOB._expr_index.get_loc(x)
 
 def test_coordination_between_expr_index_and_coex_index(testCOB):
     assert True
@@ -48,6 +51,28 @@ def test_coex_distance_concordance(testCOB):
         dis_dif = abs(testCOB.coexpression(a, b).distance - abs(a-b))
         assert np.isnan(dis_dif) or dis_dif < 100
 
+def test_virtual_distance_matches_pairwise_distance(testCOB):
+    genes = testCOB._expr.index[0:50]
+    ids = co.PCCUP.coex_index(np.arange(50),testCOB.num_genes())
+    assert all(
+        testCOB._coex_distance(ids) == testCOB.refgen.pairwise_distance(genes)
+    )
+
+def test_subnetwork_min_distance(testCOB):
+    genes = testCOB.refgen.random_genes(n=cf.test.num)
+    all_edges = testCOB.subnetwork(genes,sig_only=False)
+    far_edges = testCOB.subnetwork(genes,sig_only=False,min_distance=50000)
+    assert len(far_edges) == sum(all_edges.distance >= 50000)
+    assert all(far_edges.distance >= 50000)
+
+def test_full_subnetwork_min_distance(testCOB):
+    distance = testCOB._coex_distance()
+    far_edges = testCOB.subnetwork(
+        sig_only=False, min_distance=50000, names_as_index=False
+    )
+    assert all(far_edges.index.values == np.flatnonzero(distance >= 50000))
+    assert all(far_edges.distance >= 50000)
+
 def test_coex_id_concordance(testCOB):
     for a, b in itertools.combinations(
             [testCOB.refgen.random_gene() for x in range(cf.test.num)], 2
@@ -147,3 +172,140 @@ def test_str(testCOB):
 
 def test_qc_gene(testCOB):
     assert isinstance(testCOB.qc_gene(),pd.DataFrame)
+
+def test_cluster_expression_matches_mean_profiles(testCOB):
+    dm = testCOB.cluster_expression(min_cluster_size=10, normalize=False)
+    cluster = dm.index[0]
+    genes = testCOB.clusters.index[testCOB.clusters.cluster == cluster]
+    genes = [x for x in genes if x in testCOB.expr().index]
+    expected = testCOB.expr().loc[genes].mean()
+    assert np.allclose(dm.loc[cluster].values, expected.values, equal_nan=True)
+
+def test_cluster_eigengenes(testCOB):
+    means = testCOB.cluster_expression(min_cluster_size=10, normalize=False)
+    eigengenes = testCOB.cluster_expression(
+        min_cluster_size=10, normalize=False, method='eigengene'
+    )
+    assert all(means.index == eigengenes.index)
+    assert eigengenes.shape == means.shape
+    for cluster in eigengenes.index:
+        eigengene = eigengenes.loc[cluster]
+        assert np.isclose(eigengene.mean(), 0)
+        assert np.isclose(eigengene.std(ddof=1), 1)
+        # oriented along the average expression of the cluster
+        assert eigengene.corr(means.loc[cluster]) > 0
+
+def test_pair_stats_incremental_update():
+    import camoco.PCCUP as PCCUP
+    x = np.random.rand(60,40)
+    x[np.random.rand(60,40) < 0.1] = np.nan
+    num_pairs = comb(60,2,exact=True)
+    full = np.zeros((6,num_pairs))
+    full_pccs = co.COB._accumulate_pair_stats(x, full, block_size=7)
+    stats = np.zeros((6,num_pairs))
+    co.COB._accumulate_pair_stats(x[:,:25], stats)
+    pccs = co.COB._accumulate_pair_stats(x[:,25:], stats, block_size=13)
+    assert np.allclose(stats, full)
+    assert np.allclose(pccs, full_pccs, equal_nan=True)
+    assert np.allclose(
+        pccs, 1-PCCUP.pair_correlation(x), atol=1e-5, equal_nan=True
+    )
+
+def small_expr(refgen, num_genes=300, num_accessions=40):
+    # A random expression table every gene passes QC on
+    genes = [x.id for x in refgen.random_genes(num_genes, seed=0)]
+    return pd.DataFrame(
+        np.random.RandomState(0).lognormal(size=(num_genes,num_accessions)),
+        index=genes, columns=['acc-{}'.format(i) for i in range(num_accessions)]
+    )
+
+def test_add_accessions_matches_rebuild(Zm5bFGS):
+    df = small_expr(Zm5bFGS)
+    build = dict(
+        rawtype='RNASEQ', quantile=False, min_single_sample_expr=0,
+        store_pair_stats=True, defer_stages=('leaves','clusters')
+    )
+    for name in ('AddAccessions','AddAccessionsFull'):
+        tools.del_dataset('COB', name, force=True)
+        tools.del_dataset('Expr', name, force=True)
+    try:
+        cob = co.COB.from_DataFrame(
+            df.iloc[:,0:25], 'AddAccessions', 'test', Zm5bFGS, **build
+        )
+        full = co.COB.from_DataFrame(
+            df, 'AddAccessionsFull', 'test', Zm5bFGS, **build
+        )
+        # Names are compared the way they are stored
+        with pytest.raises(CamocoAccessionNameError):
+            cob.add_accessions(df.iloc[:,[0,30]].rename(
+                columns={'acc-0':'acc_0'}
+            ))
+        assert int(cob._global('pair_stats_accessions')) == 25
+        cob.add_accessions(df.iloc[:,25:])
+        assert int(cob._global('pair_stats_accessions')) == 40
+        assert all(cob._expr_index == full._expr_index)
+        assert all(cob.accessions() == full.accessions())
+        assert np.allclose(
+            cob.coex.data['score'][:], full.coex.data['score'][:],
+            atol=1e-3, equal_nan=True
+        )
+    finally:
+        for name in ('AddAccessions','AddAccessionsFull'):
+            tools.del_dataset('COB', name, force=True)
+            tools.del_dataset('Expr', name, force=True)
+
+def test_build_status(testCOB):
+    assert all(x == 'done' for x in testCOB.build_status().values())
+
+def test_deferred_clusters_complete_build(Zm5bFGS):
+    tools.del_dataset('COB', 'DeferredBuild', force=True)
+    tools.del_dataset('Expr', 'DeferredBuild', force=True)
+    try:
+        cob = co.COB.from_DataFrame(
+            small_expr(Zm5bFGS), 'DeferredBuild', 'test', Zm5bFGS,
+            rawtype='RNASEQ', quantile=False, min_single_sample_expr=0,
+            defer_stages=('clusters',)
+        )
+        status = cob.build_status()
+        assert status['clusters'] == 'deferred'
+        assert all(status[x] == 'done' for x in ('coexpression','degree','leaves'))
+        assert not cob.has_clusters()
+        cob.complete_build()
+        assert all(x == 'done' for x in cob.build_status().values())
+        assert cob.has_clusters()
+    finally:
+        tools.del_dataset('COB', 'DeferredBuild', force=True)
+        tools.del_dataset('Expr', 'DeferredBuild', force=True)
+
+def test_resume_skips_completed_stages(Zm5bFGS, monkeypatch):
+    tools.del_dataset('COB', 'ResumedBuild', force=True)
+    tools.del_dataset('Expr', 'ResumedBuild', force=True)
+    try:
+        cob = co.COB.from_DataFrame(
+            small_expr(Zm5bFGS), 'ResumedBuild', 'test', Zm5bFGS,
+            rawtype='RNASEQ', quantile=False, min_single_sample_expr=0,
+            skip_stages=('leaves',), defer_stages=('clusters',)
+        )
+        # Fake a build that died after the degree stage
+        manifest = cob._build_manifest()
+        manifest['degree']['status'] = 'failed'
+        cob._global('build_manifest', json.dumps(manifest))
+        def completed(**kwargs):
+            raise AssertionError('completed stage was run again')
+        monkeypatch.setattr(cob, '_calculate_coexpression', completed)
+        cob = co.COB.from_Expr(
+            cob, resume=True,
+            skip_stages=('leaves',), defer_stages=('clusters',)
+        )
+        status = cob.build_status()
+        assert status['coexpression'] == 'done'
+        assert status['degree'] == 'done'
+        assert status['leaves'] == 'skipped'
+        assert status['clusters'] == 'deferred'
+    finally:
+        tools.del_dataset('COB', 'ResumedBuild', force=True)
+        tools.del_dataset('Expr', 'ResumedBuild', force=True)
+
+def test_has_clusters(testCOB):
+    assert testCOB.has_clusters()
+    assert len(testCOB.clusters) > 0
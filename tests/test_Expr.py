@@ -2,6 +2,7 @@
 
 import pytest
 import numpy as np
+import pandas as pd
 
 def test_nans_in_same_place(testCOB):
     norm_expr = testCOB.expr(raw=False)
@@ -15,3 +16,121 @@ def test_inplace_nansort(testCOB):
         x[i] = np.nan
     sorted_x = testCOB.inplace_nansort(x)
     assert all(np.isnan(x) == np.isnan(sorted_x))
+
+def test_qc_gene_flags(testCOB):
+    qc_gene = testCOB._bcolz('qc_gene')
+    flags = qc_gene.drop('PASS_ALL', axis=1)
+    assert all(qc_gene['PASS_ALL'] == flags.all(axis=1))
+    passing = set(str(x).upper() for x in qc_gene.index[qc_gene['PASS_ALL']])
+    assert set(testCOB.expr().index) <= passing
+
+def test_qc_accession_flags(testCOB):
+    qc_accession = testCOB._bcolz('qc_accession')
+    flags = qc_accession.drop('PASS_ALL', axis=1)
+    assert all(qc_accession['PASS_ALL'] == flags.all(axis=1))
+    assert qc_accession['PASS_ALL'].sum() == len(testCOB.expr().columns)
+
+def test_quantile_normalize_matches_ranked_averages(testCOB):
+    values = np.random.rand(500,20)
+    values[np.random.rand(500,20) < 0.1] = np.nan
+    quantiled,ties = testCOB._quantile_normalize(values)
+    assert np.all(np.isnan(values) == np.isnan(quantiled))
+    # reference: rank columns, lay the sorted values over the non-nans
+    # and look up the row means by percentile rank
+    df = pd.DataFrame(values)
+    ranks = df.rank(axis=0, method='first')
+    ranks = ranks / ranks.max(axis=0)
+    expr_sort = df.apply(lambda col: testCOB.inplace_nansort(col.values), axis=0)
+    rank_average = np.nanmean(expr_sort.values, axis=1)
+    for col in range(20):
+        valid = ~np.isnan(values[:,col])
+        index = (ranks.values[valid,col]*500).astype(int) - 1
+        assert np.allclose(quantiled[valid,col], rank_average[index])
+    assert all(ties == 1)
+
+def test_quantile_normalize_chunked(testCOB):
+    values = np.random.rand(500,20).round(1)
+    values[np.random.rand(500,20) < 0.1] = np.nan
+    quantiled,ties = testCOB._quantile_normalize(values)
+    chunked,chunked_ties = testCOB._quantile_normalize(values, chunk_size=3)
+    assert np.allclose(quantiled, chunked, equal_nan=True)
+    assert all(ties == chunked_ties)
+    assert all(ties > 1)
+
+def test_pair_correlation_float32():
+    import camoco.PCCUP as PCCUP
+    x = np.random.rand(50,20)
+    x[np.random.rand(50,20) < 0.1] = np.nan
+    pccs = PCCUP.pair_correlation(x)
+    assert np.allclose(
+        pccs, PCCUP.pair_correlation(x.astype('float32')), equal_nan=True
+    )
+
+def test_float32_frame_is_contiguous(testCOB):
+    df,values = testCOB._float32_frame(testCOB.expr())
+    assert values.dtype == np.float32
+    assert values.flags.c_contiguous
+    assert np.allclose(df.values, testCOB.expr().values, equal_nan=True)
+    # already laid out frames are not copied
+    df2,values2 = testCOB._float32_frame(df, values)
+    assert values2 is values
+
+def test_read_expr_table_matches_read_table(tmpdir):
+    from camoco.Tools import read_expr_table
+    df = pd.DataFrame(
+        np.random.rand(1234,10),
+        index=['GENE{}'.format(i) for i in range(1234)],
+        columns=['acc{}'.format(i) for i in range(10)]
+    )
+    filename = str(tmpdir.join('expr.tsv.gz'))
+    df.to_csv(filename, sep='\t', compression='gzip')
+    tbl = read_expr_table(filename, index_col=0, chunksize=100)
+    assert tbl.values.dtype == np.float32
+    assert all(tbl.index == df.index)
+    assert all(tbl.columns == df.columns)
+    assert np.allclose(tbl.values, df.values)
+
+def test_read_expr_table_inferred_compression(tmpdir):
+    from camoco.Tools import read_expr_table
+    df = pd.DataFrame(
+        np.random.rand(1234,10),
+        index=['GENE{}'.format(i) for i in range(1234)],
+        columns=['acc{}'.format(i) for i in range(10)]
+    )
+    for ext in ('xz','zip'):
+        filename = str(tmpdir.join('expr.tsv.{}'.format(ext)))
+        df.to_csv(filename, sep='\t')
+        tbl = read_expr_table(filename, index_col=0, chunksize=100)
+        assert all(tbl.index == df.index)
+        assert np.allclose(tbl.values, df.values)
+
+def test_expr_rows_match_full_expr(testCOB):
+    ids = [x.id for x in testCOB.genes()[0:10]]
+    rows = testCOB._expr_rows(ids)
+    full = testCOB.expr().loc[ids]
+    assert all(rows.index == full.index)
+    assert np.allclose(rows.values, full.values, equal_nan=True)
+
+def test_expr_index_matches_rows(testCOB):
+    for i,gene in enumerate(testCOB.expr().index[0:10]):
+        assert testCOB._get_gene_index(gene) == i
+
+def test_raw_metadata_matches_raw_table(testCOB):
+    raw = testCOB.expr(raw=True)
+    assert testCOB.num_genes(raw=True) == len(raw.index)
+    assert testCOB.num_accessions(raw=True) == len(raw.columns)
+    genes,accessions = testCOB._raw_metadata()
+    assert genes == [str(x) for x in raw.index]
+    assert accessions == [str(x) for x in raw.columns]
+
+def test_raw_cache_is_read_only(testCOB):
+    raw = testCOB.expr(raw=True)
+    assert testCOB.expr(raw=True) is raw
+    with pytest.raises(ValueError):
+        raw.iloc[0,0] = -1
+    # copies can be changed without touching the cache
+    copy = raw.copy()
+    copy.iloc[0,0] = -1
+    assert testCOB.expr(raw=True).iloc[0,0] != -1
+    testCOB.clear_raw_cache()
+    assert testCOB.expr(raw=True).shape == raw.shape
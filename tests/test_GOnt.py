@@ -1,5 +1,10 @@
+import os
 import pytest
 
+import camoco as co
+from camoco import cf
+from camoco import Tools as tools
+
 # GO Term: Biological Process
 bp_term_id = 'GO:0008150'
 
@@ -51,3 +56,103 @@ def test_get_item(ZmGO):
 def test_biological_process_has_genes(ZmGO):
     assert len(ZmGO['GO:0008150'].loci) != 0
 
+
+def test_enrichment_matches_hypergeom(TestGO):
+    from scipy.stats import hypergeom
+    term = TestGO['GO:0000002']
+    loci = list(term.loci)
+    enriched = TestGO.enrichment(
+        loci,pval_cutoff=1,min_term_size=1,max_term_size=10e10
+    )
+    assert term.id in [x.id for x in enriched]
+    universe = TestGO.num_distinct_loci()
+    for x in enriched:
+        num_common = len(set(l.id for l in x.loci) & set(l.id for l in loci))
+        assert x.attrs['hyper']['num_common'] == num_common
+        assert x.attrs['pval'] == pytest.approx(
+            hypergeom.sf(num_common-1,universe,len(x.loci),len(loci))
+        )
+
+def test_iter_terms_matches_getitem(TestGO):
+    terms = list(TestGO.iter_terms(batch_size=3))
+    assert len(terms) == len(TestGO)
+    for term in terms:
+        stored = TestGO[term.id]
+        assert term.name == stored.name
+        assert term.is_a == stored.is_a
+        assert term.attrs == stored.attrs
+        assert set(x.id for x in term.loci) == set(x.id for x in stored.loci)
+
+def test_terms_containing_filters_sizes(TestGO):
+    term = TestGO['GO:0000001']
+    loci = list(term.loci)
+    ids = TestGO.terms_containing(loci,min_term_size=2,ids_only=True)
+    assert term.id in ids
+    assert all(len(TestGO[x].loci) >= 2 for x in ids)
+    assert TestGO.terms_containing(
+        loci,max_term_size=len(term.loci)-1,ids_only=True
+    ).count(term.id) == 0
+
+def test_num_terms_matches_term_sizes(TestGO):
+    sizes = [len(term.loci) for term in TestGO.terms()]
+    assert TestGO.num_terms(min_term_size=2,max_term_size=10) == \
+        len([x for x in sizes if 2 <= x <= 10])
+    assert len(TestGO.rand(n=3,min_term_size=1)) == 3
+
+def test_rand_seed(TestGO):
+    first = TestGO.rand(n=3,min_term_size=2,max_term_size=10,seed=42)
+    second = TestGO.rand(n=3,min_term_size=2,max_term_size=10,seed=42)
+    assert [x.id for x in first] == [x.id for x in second]
+    assert len(set(x.id for x in first)) == 3
+    assert all(2 <= len(x) <= 10 for x in first)
+
+def test_ancestors_from_closure(TestGO):
+    ancestors = TestGO.ancestors('GO:0000009')
+    assert len(ancestors) == len(set(ancestors))
+    assert set(['GO:0000008','GO:0000003','GO:0000004','GO:0000001']) <= set(ancestors)
+    assert 'GO:0000009' in TestGO.descendants('GO:0000001')
+    assert TestGO.depth('GO:0000001') == 0
+    assert TestGO.depth('GO:0000009') == 3
+    assert 'GO:0000008' in TestGO.common_ancestors(['GO:0000009','GO:0000010'])
+    assert set(x.id for x in TestGO.parents('GO:0000009')) == set(ancestors)
+
+def test_inherited_annotations_flagged(TestGO):
+    direct = set(TestGO.annotated_ids('GO:0000001',inherited=False))
+    propagated = set(TestGO.annotated_ids('GO:0000001'))
+    assert direct < propagated
+    assert len(propagated) == len(TestGO['GO:0000001'].loci)
+
+def test_semantic_similarity(TestGO):
+    ic = TestGO.information_content()
+    terms = ['GO:0000001','GO:0000008','GO:0000009','GO:0000010']
+    resnik = TestGO.term_similarity(terms)
+    assert (resnik.values == resnik.values.T).all()
+    # the most informative common ancestor of 9 and 10 is 8
+    assert resnik.loc['GO:0000009','GO:0000010'] == pytest.approx(ic['GO:0000008'])
+    assert resnik.loc['GO:0000009','GO:0000009'] == pytest.approx(ic['GO:0000009'])
+    lin = TestGO.term_similarity(terms,method='lin')
+    assert lin.loc['GO:0000009','GO:0000009'] == pytest.approx(1)
+    genes = TestGO.annotated_ids('GO:0000001')
+    similarity = TestGO.gene_similarity(genes)
+    assert similarity.shape == (len(genes),len(genes))
+    assert similarity.values == pytest.approx(similarity.values.T)
+
+def test_open_old_layout(Zm5bFGS, TestGO):
+    # Datasets built before the closure and term_sizes tables
+    # existed get them the first time they are opened
+    if tools.available_datasets('GOnt','OldLayoutGO'):
+        tools.del_dataset('GOnt','OldLayoutGO',force=True)
+    go = co.GOnt.from_obo(
+        os.path.join(cf.options.testdir,'raw','GOnt','go.test.obo'),
+        os.path.join(cf.options.testdir,'raw','GOnt','go.test.tsv'),
+        'OldLayoutGO', 'Old layout GO', Zm5bFGS
+    )
+    go.db.cursor().execute('DROP TABLE rels_closure; DROP TABLE term_sizes;')
+    del go
+    go = co.GOnt('OldLayoutGO')
+    assert set(go.ancestors('GO:0000009')) == set(TestGO.ancestors('GO:0000009'))
+    assert go.num_terms(min_term_size=1) == TestGO.num_terms(min_term_size=1)
+    tools.del_dataset('GOnt','OldLayoutGO',force=True)
+
+def test_num_children(TestGO):
+    assert TestGO.num_children('GO:0000008') == len(TestGO.children('GO:0000008'))
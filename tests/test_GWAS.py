@@ -50,3 +50,79 @@ def test_fromDataFrame(testRefGen):
         term_col='Trait'
     ) 
     assert len(gwas) == 2
+
+def test_fromTable(testRefGen,tmpdir):
+    '''
+        Test GWAS creation from a streamed table
+    '''
+    tools.del_dataset('GWAS','testGWASTable',force=True)
+    df = pd.DataFrame({
+        'Trait' : ['a','a','b','b'],
+        'CHR' : ['chr1','chr2','chr3','chr4'],
+        'POS' : [100,200,300,400],
+        'id' : ['snp1','snp2','snp3','snp4'],
+        'pval' : [0.05,0.05,0.01,0.01]
+    }) 
+    filename = str(tmpdir.join('gwas.tsv'))
+    df.to_csv(filename,sep='\t',index=False)
+    gwas = co.GWAS.from_table(
+        filename,
+        'testGWASTable',
+        'Test GWAS Dataset',
+        testRefGen,
+        chunksize=3,
+        chr_col='CHR',
+        pos_col='POS',
+        id_col='id',
+        term_col='Trait'
+    )
+    assert len(gwas) == 2
+    assert sorted(x.id for x in gwas['b'].loci) == ['snp3','snp4']
+    for snp in gwas['b'].loci:
+        assert snp['pval'] == '0.01'
+    tools.del_dataset('GWAS','testGWASTable',force=True)
+
+def test_loci_in_region(testRefGen):
+    tools.del_dataset('GWAS','testGWASRegion',force=True)
+    df = pd.DataFrame({
+        'Trait' : ['a','a','b','b'],
+        'CHR' : ['chr1','chr1','chr1','chr2'],
+        'POS' : [100,200000,250000,250000],
+        'id' : ['snp1','snp2','snp3','snp4'],
+    })
+    gwas = co.GWAS.from_DataFrame(
+        df, 'testGWASRegion', 'Test GWAS Dataset', testRefGen,
+        chr_col='CHR', pos_col='POS', id_col='id', term_col='Trait'
+    )
+    loci = gwas.loci_in_region('chr1',150000,300000)
+    assert sorted(x.id for x in loci) == ['snp2','snp3']
+    assert gwas.terms_near(co.Locus('chr1',1000,2000),window_size=5000) == ['a']
+    assert gwas.terms_near(co.Locus('chr2',260000,270000),window_size=50000) == ['b']
+    tools.del_dataset('GWAS','testGWASRegion',force=True)
+
+def test_loci_in_region_past_binned_range(testRefGen):
+    tools.del_dataset('GWAS','testGWASLongChrom',force=True)
+    positions = [10, 300000, 536870911, 536870912, 600000000, 700000000]
+    df = pd.DataFrame({
+        'Trait' : ['a','a','b','b','a','b'],
+        'CHR' : 'chr1',
+        'POS' : positions,
+        'id' : ['snp{}'.format(i) for i in range(len(positions))],
+        'pval' : [0.01]*len(positions)
+    })
+    gwas = co.GWAS.from_DataFrame(
+        df, 'testGWASLongChrom', 'Test GWAS Dataset', testRefGen,
+        chr_col='CHR', pos_col='POS', id_col='id', term_col='Trait'
+    )
+    table = pd.DataFrame(
+        gwas.db.cursor().execute('SELECT id,start,end FROM term_loci').fetchall(),
+        columns=['id','start','end']
+    )
+    for start,end in [(0,100),(536000000,537000000),(550000000,650000000),
+                      (699990000,700010000),(0,800000000)]:
+        loci = gwas.loci_in_region('chr1',start,end)
+        expected = table.id[(table.start <= end) & (table.end >= start)]
+        assert sorted(x.id for x in loci) == sorted(expected)
+        assert all(x.attr['pval'] == '0.01' for x in loci)
+    assert gwas.terms_near(co.Locus('chr1',700000000,700000000),window_size=1000) == ['b']
+    tools.del_dataset('GWAS','testGWASLongChrom',force=True)
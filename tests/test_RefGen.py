@@ -211,6 +211,52 @@ def test_bootstrap_candidate_length_equal_from_gene(testRefGen):
     bootstraps = testRefGen.bootstrap_candidate_genes(random_gene,window_size=5e10)
     assert len(candidates) == len(bootstraps)
 
+def test_candidate_gene_counts_match_candidates(testRefGen):
+    random_genes = sorted(testRefGen.random_genes(n=10))
+    counts = testRefGen.candidate_gene_counts(
+        random_genes,flank_limit=3,window_size=50e5
+    )
+    candidates = testRefGen.candidate_genes(
+        random_genes,flank_limit=3,window_size=50e5,chain=False
+    )
+    assert list(counts) == [len(x) for x in candidates]
+
+def test_bootstrap_candidates_multiple_bootstraps(testRefGen):
+    random_gene = testRefGen.random_gene()
+    test_snp = Locus(random_gene.chrom,random_gene.start,window=50e5)
+    candidates = testRefGen.candidate_genes(test_snp)
+    bootstraps = testRefGen.bootstrap_candidate_genes(
+        test_snp,num_bootstraps=5,seed=42
+    )
+    assert len(bootstraps) == 5
+    for bootstrap in bootstraps:
+        assert len(bootstrap) == len(candidates)
+    # The same seed gives the same bootstraps
+    assert bootstraps == testRefGen.bootstrap_candidate_genes(
+        test_snp,num_bootstraps=5,seed=42
+    )
+
+def test_random_genes_seed_is_reproducible(testRefGen):
+    a = testRefGen.random_genes(n=10,seed=42,return_table=True)
+    b = testRefGen.random_genes(n=10,seed=42,return_table=True)
+    assert len(a) == 10
+    assert list(a.index) == list(b.index)
+
+def test_genome_random_loci(testRefGen):
+    loci = testRefGen.genome.rLoci(100,length=1000,seed=42)
+    assert len(loci) == 100
+    assert all(loci.end - loci.start == 1000)
+
+def test_pairwise_distance_int32_matches_float32(testRefGen):
+    import numpy as np
+    from camoco.RefGenDist import TRANS_DISTANCE_INT32
+    genes = sorted(testRefGen.random_genes(n=100),key=lambda x: x.id)
+    dist = testRefGen.pairwise_distance(genes)
+    int_dist = testRefGen.pairwise_distance(genes,dtype='int32',block_size=100)
+    assert len(dist) == 100*99/2
+    assert all(np.isinf(dist) == (int_dist == TRANS_DISTANCE_INT32))
+    assert all(dist[~np.isinf(dist)] == int_dist[~np.isinf(dist)])
+
 def test_refgen_length(testRefGen):
     # grab length from sqlite 
     from_sql = testRefGen.db.cursor().execute('''